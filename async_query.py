@@ -0,0 +1,174 @@
+import os
+import json
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any
+from metrics import metrics
+from query import MangaRetrieval, get_genai, model, RERANK_CONCURRENCY
+
+# 异步检索：每个请求的默认超时（秒，0 表示不限），以及向量检索线程数
+ASYNC_REQUEST_TIMEOUT = float(os.getenv("ASYNC_REQUEST_TIMEOUT", "60"))
+ASYNC_SEARCH_WORKERS = int(os.getenv("ASYNC_SEARCH_WORKERS", "4"))
+
+
+class GeminiAsyncLLM:
+    """Default LLM of AsyncMangaRetrieval: Gemini's native async generate_content."""
+
+    def __init__(self, model_name=model):
+        self.model_name = model_name
+        self.model_instance = None
+
+    async def __call__(self, prompt, generation_config):
+        if self.model_instance is None:
+            self.model_instance = get_genai().GenerativeModel(model_name=self.model_name)
+        return await self.model_instance.generate_content_async(
+            contents=prompt,
+            generation_config=generation_config
+        )
+
+
+class AsyncMangaRetrieval:
+    """
+    asyncio front end of MangaRetrieval, so one worker can serve many concurrent searches.
+
+    Embedding and vector search run in a thread pool; the LLM rerank awaits an async LLM.
+    The LLM is any async callable llm(prompt, generation_config) that returns the response
+    text or a response object with a .text attribute, so tests can inject a stand-in.
+    Cancelling a search cancels its pending LLM call; each search has a timeout.
+
+    Usage:
+        retriever = AsyncMangaRetrieval()
+        results = await retriever.search("two girls sharing a scarf", timeout=30)
+    """
+
+    def __init__(self, retriever: MangaRetrieval = None, chroma_db_path: str = "./_chroma", llm=None,
+                 executor=None, request_timeout: float = ASYNC_REQUEST_TIMEOUT,
+                 max_concurrent_reranks: int = RERANK_CONCURRENCY):
+        self.retriever = retriever or MangaRetrieval(chroma_db_path)
+        self.llm = llm or GeminiAsyncLLM()
+        self.executor = executor or ThreadPoolExecutor(max_workers=ASYNC_SEARCH_WORKERS)
+        self.request_timeout = request_timeout
+        self.max_concurrent_reranks = max_concurrent_reranks
+        # The semaphore belongs to the loop it was created on, so one is made per running loop
+        self._rerank_semaphore = None
+        self._rerank_semaphore_loop = None
+
+    async def _run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def raw_search(self, query: str, n_results: int = 5, filter_level: str = None, characters=None,
+                         location=None, emotion=None):
+        """Vector search without LLM reranking, run in the thread pool."""
+        return await self._run_blocking(self.retriever.raw_search, query, n_results=n_results, filter_level=filter_level,
+                                        characters=characters, location=location, emotion=emotion)
+
+    async def rerank_results(self, query: str, candidates: List[Dict[Any, Any]], n: int = 5) -> List[Dict[Any, Any]]:
+        """Re-rank candidates with the async LLM; falls back to vector order if the LLM fails."""
+        if not candidates:
+            return []
+        retriever = self.retriever
+
+        # The rerank cache is SQLite and the cache key reads the index manifest: both block
+        cache_key = await self._run_blocking(retriever._rerank_cache_key, query, candidates, n)
+        if cache_key is not None:
+            cached_results = await self._run_blocking(retriever.rerank_cache.get, cache_key)
+            if cached_results is not None:
+                return retriever._attach_candidate_info(cached_results, candidates)
+
+        prompt = retriever.build_rerank_prompt(query, candidates, n)
+        semaphore = self._get_rerank_semaphore()
+        try:
+            with metrics.track("rerank", prompt) as call:
+                async with semaphore:
+                    call.mark_request_sent()
+                    response = await self.llm(prompt, retriever.generation_config)
+                call.add_usage(response)
+                response_text = response if isinstance(response, str) else response.text
+                try:
+                    ranked_results = retriever.parse_rerank_response(response_text, candidates, call)
+                except json.JSONDecodeError:
+                    call.parse_failures += 1
+                    raise
+        except json.JSONDecodeError as e:
+            print(f"JSON parsing error: {e}")
+            return retriever._fallback_ranking(candidates, n)
+        except Exception as e:
+            print(f"Error during reranking: {e}")
+            return retriever._fallback_ranking(candidates, n)
+
+        # A truncated ranking is served once but not cached
+        if cache_key is not None and not call.truncated:
+            await self._run_blocking(retriever.rerank_cache.put, cache_key, ranked_results)
+        return ranked_results
+
+    def _get_rerank_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if self._rerank_semaphore is None or self._rerank_semaphore_loop is not loop:
+            self._rerank_semaphore = asyncio.Semaphore(self.max_concurrent_reranks)
+            self._rerank_semaphore_loop = loop
+        return self._rerank_semaphore
+
+    async def search(self, query: str, n_results: int = 5, filter_level: str = None,
+                     timeout: float = None, characters=None, location=None, emotion=None) -> List[Dict[Any, Any]]:
+        """
+        Search with LLM reranking.
+
+        Args:
+            query: User's natural language description
+            n_results: Number of top results to return
+            filter_level: Optional filter for level (book, page, panel)
+            timeout: Seconds before the search is cancelled (default request_timeout, 0 = no limit);
+                raises asyncio.TimeoutError when exceeded
+            characters, location, emotion: Optional entity filters, as in MangaRetrieval.search()
+        """
+        timeout = self.request_timeout if timeout is None else timeout
+        filters = {"characters": characters, "location": location, "emotion": emotion}
+        return await asyncio.wait_for(self._search(query, n_results, filter_level, filters), timeout or None)
+
+    async def _search(self, query, n_results, filter_level, filters):
+        retriever = self.retriever
+        semantic_cache = retriever.semantic_cache
+        cache_filter = retriever._semantic_cache_filter(filter_level, **filters)
+        entry = None
+        if semantic_cache is not None:
+            embedding = await self._run_blocking(retriever.embed_query, query)
+            index_version = await self._run_blocking(retriever.index_version)
+            hit = semantic_cache.lookup(embedding, n_results, cache_filter, index_version)
+            if hit is not None:
+                entry, similarity = hit
+                print(f"Semantic cache hit (similarity {similarity:.4f}) for cached query: {entry['query']}")
+                if retriever.semantic_cache_mode != "rerank_new":
+                    return entry["results"]
+
+        candidates = await self.raw_search(query, n_results=n_results*2, filter_level=filter_level, **filters)
+        if not candidates:
+            return []
+
+        if entry is not None:
+            new_candidates = retriever._unseen_candidates(entry, candidates)
+            if not new_candidates:
+                return entry["results"]
+            new_results = await self.rerank_results(query, new_candidates, n=n_results)
+            return retriever._merge_with_cached(entry, new_results, n_results)
+
+        ranked_results = await self.rerank_results(query, candidates, n=n_results)
+        if semantic_cache is not None and not retriever._is_fallback(ranked_results):
+            semantic_cache.store(query, embedding, n_results, cache_filter, index_version,
+                                 ranked_results, [c["id"] for c in candidates])
+        return ranked_results
+
+    async def search_many(self, queries: List[str], n_results: int = 5, filter_level: str = None,
+                          timeout: float = None, characters=None, location=None, emotion=None) -> List[Any]:
+        """
+        Run several searches concurrently. Results are in the order of queries; a search
+        that failed or timed out yields its exception instead of a result list.
+        """
+        return await asyncio.gather(
+            *(self.search(query, n_results, filter_level, timeout, characters, location, emotion) for query in queries),
+            return_exceptions=True
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=False)
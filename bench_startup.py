@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# 每个阶段在新的 Python 进程中运行，测量冷启动耗时
+STAGES = {
+    "import": "import query",
+    "construct": "import query; r = query.MangaRetrieval({chroma_path!r})",
+    "first_search": "import query; r = query.MangaRetrieval({chroma_path!r}); r.raw_search({query!r})",
+}
+
+TIMER = """
+import json, time
+start = time.perf_counter()
+{code}
+print(json.dumps({{"seconds": time.perf_counter() - start}}))
+"""
+
+
+def time_stage(code, cwd):
+    """Run code in a fresh interpreter and return the seconds it took (without interpreter start-up)."""
+    output = subprocess.run(
+        [sys.executable, "-c", TIMER.format(code=code)],
+        cwd=cwd, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])["seconds"]
+
+
+def time_interpreter(cwd):
+    """Bare interpreter start-up, for reference."""
+    import time
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], cwd=cwd, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold-start latency of query.py")
+    parser.add_argument("--runs", type=int, default=5, help="runs per stage")
+    parser.add_argument("--chroma-path", default="./_chroma")
+    parser.add_argument("--query", default="shaaake")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    args = parser.parse_args()
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'stage':<14}{'median s':>10}{'min s':>8}{'max s':>8}")
+    interpreter = [time_interpreter(cwd) for _ in range(args.runs)]
+    print(f"{'interpreter':<14}{statistics.median(interpreter):>10.3f}{min(interpreter):>8.3f}{max(interpreter):>8.3f}")
+    for stage in args.stages:
+        code = STAGES[stage].format(chroma_path=args.chroma_path, query=args.query)
+        times = [time_stage(code, cwd) for _ in range(args.runs)]
+        print(f"{stage:<14}{statistics.median(times):>10.3f}{min(times):>8.3f}{max(times):>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
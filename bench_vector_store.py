@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import argparse
+import statistics
+import numpy as np
+import chromadb
+from vector_store import ChromaVectorStore, NumpyVectorStore, NUMPY_STORE_DIR
+from vectorize import export_numpy_store
+from index_manifest import load_index_manifest
+
+# 对比 Chroma 与 NumPy 检索后端（含 float16/int8 压缩模式）的延迟、召回率与内存；NumPy 精确检索的结果作为基准
+
+
+class _State:
+    """Minimal stand-in for MangaRetrieval's collection state."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.exists = True
+        self.count = collection.count()
+        self.level_counts = {}
+
+
+def load_query_embeddings(args, store):
+    """Test-set queries embedded with the collection's model, or perturbed stored vectors."""
+    if args.query_source == "testset":
+        from chromadb.utils import embedding_functions
+        with open(args.testset, "r", encoding="utf-8") as f:
+            queries = [q for entry in json.load(f) for q in entry.get("query_list", []) if q]
+        embeddings = embedding_functions.DefaultEmbeddingFunction()(queries[:args.num_queries])
+        return np.asarray(embeddings, dtype=np.float32)
+
+    rng = np.random.default_rng(args.seed)
+    rows = rng.choice(store.count, size=min(args.num_queries, store.count), replace=False)
+    queries = np.asarray(store.vectors[rows]) + rng.normal(0, args.noise, size=(len(rows), store.dim)).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def time_queries(store, queries, k, level, batch):
+    """Per-query latency in milliseconds, plus the returned ids."""
+    latencies, ids = [], []
+    for start in range(0, len(queries), batch):
+        chunk = queries[start:start + batch].tolist()
+        t = time.perf_counter()
+        results = store.query(chunk, n_results=k, level=level)
+        latencies.append((time.perf_counter() - t) * 1000 / len(chunk))
+        ids.extend(results["ids"])
+    return latencies, ids
+
+
+def recall_at_k(ids, truth):
+    return statistics.mean(len(set(a) & set(b)) / len(b) for a, b in zip(ids, truth) if b)
+
+
+def report(name, latencies, ids, truth, memory=None):
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+    memory = f"{memory / 1e6:.2f}" if memory is not None else "-"
+    print(f"{name:<26}{statistics.median(latencies):>10.3f}{p95:>10.3f}{recall_at_k(ids, truth):>10.3f}{memory:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Chroma and NumPy vector stores")
+    parser.add_argument("--chroma-path", default="./_chroma")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=1, help="queries per store.query call")
+    parser.add_argument("--query-source", choices=["stored", "testset"], default="stored")
+    parser.add_argument("--testset", default=os.path.join("testset", "test_query.json"))
+    parser.add_argument("--noise", type=float, default=0.05, help="noise added to stored vectors used as queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rescore-factor", type=int, default=4, help="shortlist size of quantized stores, times k")
+    args = parser.parse_args()
+
+    collection = chromadb.PersistentClient(path=args.chroma_path).get_collection("manga_collection")
+    store_dir = os.path.join(args.chroma_path, NUMPY_STORE_DIR)
+    manifest = load_index_manifest(args.chroma_path)
+    index_version = manifest["version"] if manifest else None
+    if NumpyVectorStore.stored_index_version(store_dir) != index_version or not os.path.exists(store_dir):
+        export_numpy_store(collection, store_dir, index_version=index_version)
+
+    t = time.perf_counter()
+    numpy_store = NumpyVectorStore(store_dir, quantization="none")
+    print(f"NumPy store: {numpy_store.count} vectors x {numpy_store.dim}, loaded in {(time.perf_counter() - t) * 1000:.1f} ms")
+    stores = [("numpy", numpy_store)]
+    for quantization in ("float16", "int8"):
+        stores.append((f"numpy-{quantization}",
+                       NumpyVectorStore(store_dir, quantization=quantization, rescore_factor=args.rescore_factor)))
+    stores.append(("chroma", ChromaVectorStore(_State(collection))))
+    queries = load_query_embeddings(args, numpy_store)
+    print(f"{len(queries)} queries, k={args.k}, batch={args.batch}, rescore factor={args.rescore_factor}\n")
+
+    print(f"{'backend':<26}{'p50 ms':>10}{'p95 ms':>10}{'recall':>10}{'memory MB':>12}")
+    for level in [None, "page", "panel"]:
+        _, truth = time_queries(numpy_store, queries, args.k, level, len(queries))
+        label = level or "all"
+        for name, store in stores:
+            store.query(queries[:1].tolist(), n_results=args.k, level=level)  # warm up
+            latencies, ids = time_queries(store, queries, args.k, level, args.batch)
+            memory = store.memory_bytes() if isinstance(store, NumpyVectorStore) else None
+            report(f"{name} ({label})", latencies, ids, truth, memory)
+
+    full = numpy_store.memory_bytes()
+    for name, store in stores[1:-1]:
+        print(f"{name}: {store.memory_bytes() / 1e6:.2f} MB in memory vs {full / 1e6:.2f} MB float32 "
+              f"({1 - store.memory_bytes() / full:.0%} saved)")
+
+
+if __name__ == "__main__":
+    main()
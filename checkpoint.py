@@ -0,0 +1,89 @@
+import os
+import json
+import datetime
+import threading
+
+
+def safe_filename(name):
+    """
+    Sanitize a name (a manga title, a model id, ...) so it can be used as a file or folder name.
+    """
+    return "".join(x for x in name if x.isalnum() or x in (' ', '-', '_'))
+
+
+def write_json_atomic(path, data):
+    """
+    Write JSON to a temporary file first and then move it into place,
+    so a crash never leaves a half-written checkpoint behind.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class CheckpointStore:
+    """
+    Stores each parsed page JSON as soon as it arrives and records per-book completion.
+
+    Layout:
+        <root>/<safe manga name>/page_0001.json   one file per analysed page
+        <root>/<safe manga name>/book.json        written once the schema file is saved
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _book_dir(self, manga_name):
+        return os.path.join(self.root, safe_filename(manga_name))
+
+    def _page_file(self, manga_name, idx):
+        return os.path.join(self._book_dir(manga_name), f"page_{idx + 1:04d}.json")
+
+    def save_page(self, manga_name, idx, image_path, page_object):
+        """Save the parsed JSON of one page."""
+        os.makedirs(self._book_dir(manga_name), exist_ok=True)
+        write_json_atomic(self._page_file(manga_name, idx), {
+            "image_path": image_path,
+            "page_object": page_object,
+        })
+
+    def load_page(self, manga_name, idx, image_path):
+        """
+        Return the checkpointed page object, or None if the page still has to be analysed.
+        A checkpoint recorded for a different image (e.g. files were renamed) is ignored.
+        """
+        page_file = self._page_file(manga_name, idx)
+        if not os.path.exists(page_file):
+            return None
+        try:
+            with open(page_file, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Ignoring unreadable checkpoint {page_file}: {e}")
+            return None
+        if checkpoint.get("image_path") != image_path:
+            return None
+        return checkpoint.get("page_object")
+
+    def mark_book_complete(self, manga_name, output_file, num_pages):
+        """Record that the schema file of a book has been written."""
+        os.makedirs(self._book_dir(manga_name), exist_ok=True)
+        write_json_atomic(os.path.join(self._book_dir(manga_name), "book.json"), {
+            "manga_name": manga_name,
+            "output_file": output_file,
+            "num_pages": num_pages,
+            "completed_at": datetime.datetime.now().isoformat(),
+        })
+
+    def is_book_complete(self, manga_name):
+        """A book is complete when its completion record exists and its schema file is still there."""
+        book_file = os.path.join(self._book_dir(manga_name), "book.json")
+        if not os.path.exists(book_file):
+            return False
+        try:
+            with open(book_file, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return False
+        return os.path.exists(record.get("output_file", ""))
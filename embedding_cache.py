@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from checkpoint import write_json_atomic, safe_filename
+
+# 文档向量缓存目录，不在 _chroma 内，重建索引时保留
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "./.embedding_cache")
+
+# Cache key of the collection's embedding model; change it whenever the model or its settings change
+EMBEDDING_MODEL_ID = os.getenv("EMBEDDING_MODEL_ID", "chroma-onnx/all-MiniLM-L6-v2")
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Document embeddings keyed by (embedding model id, text hash).
+
+    Layout (one directory per model id):
+        <root>/<model id>/meta.json     {"model_id", "dim"}
+        <root>/<model id>/vectors.f32   float32 matrix, one row per cached text, read via memmap
+        <root>/<model id>/index.jsonl   one {"hash", "row"} line per row (append-only)
+
+    Rows are appended before their index lines, so a crash can only leave unreferenced rows.
+    """
+
+    def __init__(self, model_id, root=EMBEDDING_CACHE_DIR):
+        self.model_id = model_id
+        self.dir = os.path.join(root, safe_filename(model_id.replace("/", "_")))
+        self.meta_file = os.path.join(self.dir, "meta.json")
+        self.vectors_file = os.path.join(self.dir, "vectors.f32")
+        self.index_file = os.path.join(self.dir, "index.jsonl")
+        self.lock = threading.Lock()
+        self.rows = {}  # text hash -> row
+        self.dim = None
+        self._matrix = None
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        if self.dim and os.path.exists(self.index_file):
+            num_rows = os.path.getsize(self.vectors_file) // (4 * self.dim) if os.path.exists(self.vectors_file) else 0
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # tolerate a torn last line after a crash
+                    if entry["row"] < num_rows:
+                        self.rows[entry["hash"]] = entry["row"]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _matrix_view(self):
+        """Memmap of the vectors file, reopened after rows were appended."""
+        num_rows = os.path.getsize(self.vectors_file) // (4 * self.dim)
+        if self._matrix is None or self._matrix.shape[0] != num_rows:
+            self._matrix = np.memmap(self.vectors_file, dtype=np.float32, mode="r", shape=(num_rows, self.dim))
+        return self._matrix
+
+    def lookup(self, texts):
+        """
+        Returns:
+            (embeddings, missing) where embeddings has a row per text (zeros for misses)
+            and missing lists the indices of texts that still have to be embedded
+        """
+        with self.lock:
+            hashes = [text_hash(text) for text in texts]
+            found = [(i, self.rows[h]) for i, h in enumerate(hashes) if h in self.rows]
+            missing = [i for i, h in enumerate(hashes) if h not in self.rows]
+            self.hits += len(found)
+            self.misses += len(missing)
+            if not found:
+                return None, missing
+            matrix = self._matrix_view()
+            embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+            positions = [i for i, _ in found]
+            embeddings[positions] = matrix[[row for _, row in found]]
+            return embeddings, missing
+
+    def store(self, texts, embeddings):
+        """Append the embeddings of texts that are not cached yet."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self.lock:
+            if self.dim is None:
+                os.makedirs(self.dir, exist_ok=True)
+                self.dim = int(embeddings.shape[1])
+                write_json_atomic(self.meta_file, {"model_id": self.model_id, "dim": self.dim})
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match cache dimension {self.dim}")
+
+            new_hashes, new_rows = {}, []
+            for i, text in enumerate(texts):
+                h = text_hash(text)
+                if h not in self.rows and h not in new_hashes:
+                    new_hashes[h] = len(new_rows)
+                    new_rows.append(i)
+            if not new_rows:
+                return
+
+            row_bytes = 4 * self.dim
+            if os.path.exists(self.vectors_file) and os.path.getsize(self.vectors_file) % row_bytes:
+                # Drop a partially written row left by a crash so appended rows stay aligned
+                os.truncate(self.vectors_file, os.path.getsize(self.vectors_file) // row_bytes * row_bytes)
+            first_row = os.path.getsize(self.vectors_file) // row_bytes if os.path.exists(self.vectors_file) else 0
+            with open(self.vectors_file, "ab") as f:
+                f.write(np.ascontiguousarray(embeddings[new_rows]).tobytes())
+            with open(self.index_file, "a", encoding="utf-8") as f:
+                for h, offset in new_hashes.items():
+                    f.write(json.dumps({"hash": h, "row": first_row + offset}) + "\n")
+            for h, offset in new_hashes.items():
+                self.rows[h] = first_row + offset
@@ -0,0 +1,180 @@
+import os
+import re
+import json
+import numpy as np
+from checkpoint import write_json_atomic
+from vector_store import LEVELS
+from lexical_index import segment_path, remove_index_files
+
+# 结构化实体索引：vectorize.py 从角色名、场景地点与情绪建立倒排表，供检索前过滤；
+# 匹配文档占比不超过 PREFILTER_MAX_SELECTIVITY 时先过滤再做向量检索，否则先检索 POSTFILTER_OVERFETCH 倍结果再过滤
+ENTITY_INDEX_DIR = "entity_index"
+PREFILTER_MAX_SELECTIVITY = float(os.getenv("PREFILTER_MAX_SELECTIVITY", "0.2"))
+POSTFILTER_OVERFETCH = float(os.getenv("POSTFILTER_OVERFETCH", "2"))
+# Bumped whenever the index layout changes, so vectorize.py rebuilds older indexes
+ENTITY_FORMAT = 3
+
+ENTITY_FIELDS = ("character", "location", "emotion")
+
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_entity(value):
+    """Lower-cased words separated by single spaces, without punctuation."""
+    return " ".join(_WORD_RE.findall(str(value).lower()))
+
+
+def entity_filters(characters=None, location=None, emotion=None):
+    """
+    Normalized filters of a search: field -> tuple of values, without empty fields.
+    Each argument is a string or a list of strings.
+    """
+    filters = {}
+    for field, values in (("character", characters), ("location", location), ("emotion", emotion)):
+        if isinstance(values, str):
+            values = [values]
+        values = tuple(sorted({normalize_entity(v) for v in values or [] if normalize_entity(v)}))
+        if values:
+            filters[field] = values
+    return filters
+
+
+class EntityIndex:
+    """
+    Inverted index from character names, locations and emotions to documents.
+
+    A panel has the entities of its own schema fields; a page has those of its panels and
+    a book those of its pages. A filter value matches every indexed value that contains it
+    as whole words ("classroom" matches "school classroom", "ina" does not match "hina").
+    All characters of a filter must appear in a document, while any of several locations or
+    emotions is enough; fields are combined with AND.
+
+    Layout (written in segments by EntityIndexWriter, joined when loading):
+        <path>/meta.json                   {"count", "segments", "index_version", "format"}, written last
+        <path>/segment_NNN/entities.json   {"ids", "levels", "fields": {field: {value: [document numbers]}}}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("format") != ENTITY_FORMAT:
+            raise ValueError(f"entity index format {self.meta.get('format')}, expected {ENTITY_FORMAT}")
+        self.index_version = self.meta.get("index_version")
+        self.count = self.meta["count"]
+        self.ids = []
+        levels = []
+        fields = {field: {} for field in ENTITY_FIELDS}
+        for segment in range(self.meta["segments"]):
+            with open(os.path.join(segment_path(path, segment), "entities.json"), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            offset = len(self.ids)
+            self.ids.extend(data["ids"])
+            levels.extend(data["levels"])
+            for field, values in data["fields"].items():
+                for value, docs in values.items():
+                    fields[field].setdefault(value, []).append(np.asarray(docs, dtype=np.int32) + offset)
+        self.levels = np.array([LEVELS.index(level) if level in LEVELS else -1 for level in levels], dtype=np.int8)
+        self.fields = {field: {value: np.concatenate(docs) for value, docs in values.items()}
+                       for field, values in fields.items()}
+
+    def _docs_matching(self, field, value):
+        """Documents with an indexed value of field that contains value as whole words."""
+        values = self.fields.get(field, {})
+        padded = f" {value} "
+        matched = [docs for indexed, docs in values.items() if padded in f" {indexed} "]
+        return np.unique(np.concatenate(matched)) if matched else np.zeros(0, dtype=np.int32)
+
+    def match(self, filters, level=None):
+        """Ids of the documents matching filters (see entity_filters), optionally of one level only."""
+        mask = np.ones(self.count, dtype=bool)
+        if level in LEVELS:
+            mask &= self.levels == LEVELS.index(level)
+        for field, values in filters.items():
+            field_mask = np.zeros(self.count, dtype=bool)
+            if field == "character":
+                field_mask[:] = True
+                for value in values:
+                    value_mask = np.zeros(self.count, dtype=bool)
+                    value_mask[self._docs_matching(field, value)] = True
+                    field_mask &= value_mask
+            else:
+                for value in values:
+                    field_mask[self._docs_matching(field, value)] = True
+            mask &= field_mask
+        return [self.ids[d] for d in np.flatnonzero(mask)]
+
+    def stats(self, top=10):
+        """Selectivity statistics: per field the number of distinct values and the most frequent ones."""
+        stats = {"documents": self.count,
+                 "levels": {level: int((self.levels == i).sum()) for i, level in enumerate(LEVELS)}}
+        for field, values in self.fields.items():
+            counts = sorted(((len(docs), value) for value, docs in values.items()), reverse=True)
+            stats[field] = {
+                "distinct_values": len(values),
+                "top_values": [{"value": value, "documents": count, "selectivity": count / max(self.count, 1)}
+                               for count, value in counts[:top]],
+            }
+        return stats
+
+    @staticmethod
+    def stored_index_version(path):
+        """Index version the entity index was built from, or None if there is no complete index."""
+        try:
+            with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta.get("index_version") if meta.get("format") == ENTITY_FORMAT else None
+
+
+class EntityIndexWriter:
+    """
+    Builds an EntityIndex document by document; like LexicalIndexWriter, only the current
+    segment is kept in memory, flush() writes it and close() writes meta.json last.
+    """
+
+    def __init__(self, path, index_version=None):
+        self.path = path
+        self.index_version = index_version
+        self.count = 0
+        self.segments = 0
+        remove_index_files(path)
+        self._reset()
+
+    def _reset(self):
+        self.ids = []
+        self.levels = []
+        self.fields = {field: {} for field in ENTITY_FIELDS}
+
+    def add(self, doc_id, level, entities):
+        """entities: {field: [values]} of the document."""
+        doc = len(self.ids)
+        self.ids.append(doc_id)
+        self.levels.append(level)
+        for field, values in entities.items():
+            for value in {normalize_entity(v) for v in values if normalize_entity(v)}:
+                self.fields[field].setdefault(value, []).append(doc)
+
+    def flush(self):
+        """Write the documents added since the last flush as a segment."""
+        if not self.ids:
+            return
+        path = segment_path(self.path, self.segments)
+        os.makedirs(path, exist_ok=True)
+        write_json_atomic(os.path.join(path, "entities.json"),
+                          {"ids": self.ids, "levels": self.levels, "fields": self.fields})
+        self.count += len(self.ids)
+        self.segments += 1
+        self._reset()
+
+    def close(self):
+        """Write the last segment and meta.json."""
+        self.flush()
+        write_json_atomic(os.path.join(self.path, "meta.json"), {
+            "count": self.count,
+            "segments": self.segments,
+            "index_version": self.index_version,
+            "format": ENTITY_FORMAT,
+        })
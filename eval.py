@@ -1,6 +1,7 @@
 import json
 import os
 import query as RAG
+from metrics import metrics
 from tqdm import tqdm
 
 def read_query_data_from_json(filepath: str) -> list | None:
@@ -35,6 +36,8 @@ def main():
     """Main function to test manga retrieval system."""
     print("Initializing manga retrieval system...")
     retriever = RAG.MangaRetrieval()
+    # Every query must be answered on its own, or cached results of similar queries skew the scores
+    retriever.semantic_cache = None
     
     # Load the query data
     json_file_path = "testset\\test_query.json"
@@ -43,40 +46,49 @@ def main():
     TP = 0
     Total = len(loaded_manga_data)*5
     if loaded_manga_data is not None:
-        for i, manga_entry in tqdm(enumerate(loaded_manga_data)):
-            name = manga_entry.get('name')
-            query_list = manga_entry.get('query_list')
-            for j, query in enumerate(query_list):
-                print(f"Manag Name: {name}, Query{j}: {query}")
-                print("\n===== Manga Retrieval System =====")
-                user_query = query
-                print(f"user_query: {user_query}")
+        # Run all queries through one batched search (batched embedding + concurrent reranks)
+        eval_queries = [(manga_entry.get('name'), j, query)
+                        for manga_entry in loaded_manga_data
+                        for j, query in enumerate(manga_entry.get('query_list'))]
+        filter_level = None
+        print("\nSearching for matching manga...")
+        all_ranked_results = retriever.search_many([query for _, _, query in eval_queries if query],
+                                                   filter_level=filter_level)
+        all_ranked_results = iter(all_ranked_results)
+
+        for name, j, query in tqdm(eval_queries):
+            print(f"Manag Name: {name}, Query{j}: {query}")
+            print("\n===== Manga Retrieval System =====")
+            user_query = query
+            print(f"user_query: {user_query}")
+            
+            T = False
+            if user_query:
+                ranked_results = next(all_ranked_results)
                 
-                if user_query:
-                    filter_level = None
-                    print("\nSearching for matching manga...")
-                    ranked_results = retriever.search(user_query, filter_level=filter_level)
-                    
-                    T = False
-                    if ranked_results:
-                        print("\n===== Search Results =====\n")
-                        for i, result in enumerate(ranked_results):
-                            print(f"{i+1}. {result['identifier']}")
-                            print(f"   Relevance Score: {result['relevance_score']}")
-                            print(f"   Vector Similarity: {result.get('vector_similarity', 'N/A'):.4f}" if result.get('vector_similarity') is not None else f"   Vector Similarity: N/A")
-                            print(f"   Match Type: {result.get('match_type', 'overall')}")
-                            print(f"   Image Path: {result.get('image_path', 'N/A')}")
-                            print(f"   {result['explanation']}")
-                            if name in result['identifier']:
-                                print(f"Match found")
-                                T = True
-                    else:
-                        print("No matching results found.")
-                print("-" * 50)
-                if T:
-                    TP += 1
+                if ranked_results:
+                    print("\n===== Search Results =====\n")
+                    for i, result in enumerate(ranked_results):
+                        print(f"{i+1}. {result['identifier']}")
+                        print(f"   Relevance Score: {result['relevance_score']}")
+                        print(f"   Vector Similarity: {result.get('vector_similarity', 'N/A'):.4f}" if result.get('vector_similarity') is not None else f"   Vector Similarity: N/A")
+                        print(f"   Match Type: {result.get('match_type', 'overall')}")
+                        print(f"   Image Path: {result.get('image_path', 'N/A')}")
+                        print(f"   {result['explanation']}")
+                        if name in result['identifier']:
+                            print(f"Match found")
+                            T = True
+                else:
+                    print("No matching results found.")
+            print("-" * 50)
+            if T:
+                TP += 1
         accuracy = TP / Total
         print(f"TP: {TP}, Total: {Total}, Accuracy: {accuracy:.4f}")
+        metrics.print_summary()
+        for cache_name, stats in retriever.cache_stats().items():
+            print(f"{cache_name} cache: {stats['hits']} hits, {stats['misses']} misses "
+                  f"(hit rate {stats['hit_rate']:.1%}, {stats['entries']} entries)")
 
     else:
         print("Fail to load query data from JSON file.")
@@ -0,0 +1,100 @@
+import os
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+# 上传前的图片规格：最长边像素、WebP 质量，以及缓存目录
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1600"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "./.image_cache")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "0")) or os.cpu_count()
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """
+    Hash a file's content without loading it into memory at once.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalized_cache_path(cache_dir, content_hash, max_side, quality):
+    """
+    The cache key contains the settings, so changing them never serves stale images.
+    """
+    return os.path.join(cache_dir, content_hash[:2], f"{content_hash}_{max_side}_q{quality}.webp")
+
+
+def normalize_image(image_path, cache_dir=IMAGE_CACHE_DIR, max_side=IMAGE_MAX_SIDE, quality=IMAGE_QUALITY):
+    """
+    Downscale an image so its longest side is at most max_side and re-encode it as WebP.
+
+    Returns the path of the cached normalized image. Identical files share one cache
+    entry because the cache is keyed by content hash.
+    """
+    cache_path = normalized_cache_path(cache_dir, file_sha256(image_path), max_side, quality)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with Image.open(image_path) as img:
+        img.load()
+        if img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        # Threads of one process may normalize the same content at once, so the name includes the thread
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, format="WEBP", quality=quality, method=4)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def _normalize_or_original(args):
+    """Process-pool worker: fall back to the original file if it cannot be decoded."""
+    image_path, cache_dir, max_side, quality = args
+    try:
+        return normalize_image(image_path, cache_dir, max_side, quality)
+    except (OSError, ValueError) as e:
+        print(f"Could not normalize {image_path}, uploading original: {e}")
+        return image_path
+
+
+# One process pool shared by all books, created on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _shared_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: book and page worker threads are running, and forking those is unsafe
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def normalize_images(image_paths, cache_dir=IMAGE_CACHE_DIR, max_side=IMAGE_MAX_SIDE, quality=IMAGE_QUALITY,
+                     workers=IMAGE_WORKERS):
+    """
+    Normalize a batch of images in the shared process pool, so books processed at the same
+    time share its workers instead of starting one pool each.
+
+    Args:
+        workers: size of the shared pool, fixed by its first use; 1 or less normalizes in this thread
+
+    Returns:
+        dict mapping each original path to the path that should be uploaded
+    """
+    if not image_paths:
+        return {}
+    jobs = [(path, cache_dir, max_side, quality) for path in image_paths]
+    if workers <= 1 or len(jobs) == 1:
+        results = [_normalize_or_original(job) for job in jobs]
+    else:
+        results = list(_shared_pool(workers).map(_normalize_or_original, jobs))
+    return dict(zip(image_paths, results))
@@ -0,0 +1,24 @@
+import os
+import json
+from checkpoint import write_json_atomic
+
+# Manifest of indexed schema files, kept next to the Chroma data
+MANIFEST_FILE = "index_manifest.json"
+
+
+def load_index_manifest(chroma_path):
+    """
+    Load the manifest of indexed schema files:
+        {"version": int, "files": {schema_file: {"hash": str, "ids": [str]}}}
+    Returns None when the index was never built incrementally.
+    """
+    manifest_file = os.path.join(chroma_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_index_manifest(chroma_path, manifest):
+    os.makedirs(chroma_path, exist_ok=True)
+    write_json_atomic(os.path.join(chroma_path, MANIFEST_FILE), manifest)
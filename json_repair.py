@@ -0,0 +1,172 @@
+import json
+
+# How many truncation points to try before giving up on a response
+MAX_REPAIR_ATTEMPTS = 64
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def clean_json_response(response_text):
+    """
+    Remove markdown code block formatting if present.
+    """
+    response_text = response_text.strip()
+    if response_text.startswith('```'):
+        # Find the end of the opening markdown delimiter
+        first_newline = response_text.find('\n')
+        if first_newline > 0:
+            # Find the closing markdown delimiter
+            last_triple_backtick = response_text.rfind('```')
+            if last_triple_backtick > first_newline:
+                # Extract just the JSON content
+                response_text = response_text[first_newline+1:last_triple_backtick].strip()
+            else:
+                # Only remove the opening delimiter if no closing one is found
+                response_text = response_text[first_newline+1:].strip()
+    return response_text
+
+
+def _extract_json_text(text):
+    """
+    Cut the first JSON object/array out of text that may have prose around it.
+    Returns (json_text, complete) where complete is False when the value never closes.
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        return text, True
+    start = min(starts)
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1], True
+    return text[start:], False
+
+
+def _remove_trailing_commas(text):
+    """
+    Drop commas that are directly followed by a closing bracket, e.g. [1, 2,] or {"a": 1,}.
+    """
+    out = []
+    in_string = False
+    escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "}]":
+            # Walk back over whitespace to find a dangling comma
+            j = len(out) - 1
+            while j >= 0 and out[j].isspace():
+                j -= 1
+            if j >= 0 and out[j] == ",":
+                del out[j]
+        out.append(ch)
+    return "".join(out)
+
+
+def _truncation_candidates(text):
+    """
+    Yield closed-off versions of a truncated JSON text, longest first.
+
+    The first candidate closes whatever is open at the very end; the following ones cut
+    the text back to each earlier comma, dropping the partially written element.
+    """
+    stack = []
+    in_string = False
+    escaped = False
+    cut_points = []
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(_CLOSERS[ch])
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+        elif ch == "," and stack:
+            cut_points.append((i, "".join(reversed(stack))))
+
+    tail = text.rstrip()
+    if in_string:
+        tail += '"'
+    yield tail.rstrip(",") + "".join(reversed(stack))
+
+    for pos, closers in reversed(cut_points[-MAX_REPAIR_ATTEMPTS:]):
+        yield text[:pos] + closers
+
+
+# Repair status of a parsed response: the JSON was fixed up without losing anything
+# (prose around it, trailing commas), or it was cut off and closed, dropping its unfinished tail
+REPAIRED = "repaired"
+TRUNCATED = "truncated"
+
+
+def parse_json_with_status(response_text):
+    """
+    Parse an LLM response as JSON, repairing it locally when possible.
+
+    Handles markdown fences, text before/after the JSON value, trailing commas and
+    responses truncated in the middle of an array or object.
+
+    Returns:
+        (value, status) where status is None for valid JSON, REPAIRED or TRUNCATED;
+        raises json.JSONDecodeError if the response cannot be repaired
+    """
+    cleaned = clean_json_response(response_text)
+    try:
+        return json.loads(cleaned), None
+    except json.JSONDecodeError as e:
+        first_error = e
+
+    json_text, complete = _extract_json_text(cleaned)
+    json_text = _remove_trailing_commas(json_text)
+    try:
+        return json.loads(json_text), REPAIRED if complete else TRUNCATED
+    except json.JSONDecodeError:
+        if complete:
+            raise first_error
+
+    for candidate in _truncation_candidates(json_text):
+        try:
+            return json.loads(_remove_trailing_commas(candidate)), TRUNCATED
+        except json.JSONDecodeError:
+            continue
+    raise first_error
+
+
+def parse_json_response(response_text):
+    """
+    Parse an LLM response as JSON, repairing it locally when possible (see parse_json_with_status).
+    Returns the parsed value; raises json.JSONDecodeError if the response cannot be repaired.
+    """
+    return parse_json_with_status(response_text)[0]
@@ -0,0 +1,248 @@
+import os
+import re
+import json
+import math
+import shutil
+import numpy as np
+from checkpoint import write_json_atomic
+from vector_store import LEVELS
+
+# 词法检索：vectorize.py 用对白、画面文字与角色名建立 BM25 倒排索引，查询时与向量结果做倒数排名融合（RRF）
+LEXICAL_SEARCH = os.getenv("LEXICAL_SEARCH", "1") == "1"
+LEXICAL_INDEX_DIR = "lexical_index"
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Rank constant of reciprocal-rank fusion: score = sum of 1 / (RRF_K + rank) over both result lists
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Bumped whenever the index layout changes, so vectorize.py rebuilds older indexes
+LEXICAL_FORMAT = 2
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Lower-cased word tokens; onomatopoeia and names are kept as written ("shaaake", "vivio")."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+class _Segment:
+    """One segment of a LexicalIndex: CSR postings over its own documents."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "terms.txt"), "r", encoding="utf-8") as f:
+            self.terms = {term: i for i, term in enumerate(f.read().split("\n")) if term}
+        with open(os.path.join(path, "ids.json"), "r", encoding="utf-8") as f:
+            self.ids = json.load(f)
+        with np.load(os.path.join(path, "postings.npz")) as postings:
+            self.offsets = postings["offsets"]
+            self.docs = postings["docs"]
+            self.tfs = postings["tfs"].astype(np.float32)
+            self.levels = postings["levels"]
+            self.lengths = postings["lengths"].astype(np.float32)
+        self.count = len(self.ids)
+        self.length_norms = None
+
+    def postings(self, term):
+        """(docs, term frequencies) of a term, or None if the segment does not have it."""
+        t = self.terms.get(term)
+        if t is None:
+            return None
+        start, end = self.offsets[t], self.offsets[t + 1]
+        return self.docs[start:end], self.tfs[start:end]
+
+
+class LexicalIndex:
+    """
+    BM25 over the dialogue, text elements and character names of each document.
+
+    The index is written in segments (see LexicalIndexWriter), so building it never holds
+    more than one segment's postings in memory; searches score every segment with the
+    document frequencies and average length of the whole index, so the scores are the
+    same as for a single segment.
+
+    Layout:
+        <path>/meta.json            {"count", "avg_length", "segments", "index_version", "format"}, written last
+        <path>/segment_NNN/terms.txt     vocabulary, one term per line, sorted; line number = term number
+        <path>/segment_NNN/postings.npz  CSR postings: offsets (per term), docs and term frequencies,
+                                         plus the length and level code of each document
+        <path>/segment_NNN/ids.json      document ids in document order (the same ids as the vector index)
+
+    Loading reads the vocabularies, the ids and a handful of arrays, so it takes milliseconds.
+    """
+
+    def __init__(self, path, k1=BM25_K1, b=BM25_B):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("format") != LEXICAL_FORMAT:
+            raise ValueError(f"lexical index format {self.meta.get('format')}, expected {LEXICAL_FORMAT}")
+        self.index_version = self.meta.get("index_version")
+        self.count = self.meta["count"]
+        self.segments = [_Segment(segment_path(path, i)) for i in range(self.meta["segments"])]
+        self.doc_of_id = None
+        self.k1 = k1
+        avg_length = self.meta["avg_length"] or 1.0
+        for segment in self.segments:
+            # Per-document part of the BM25 denominator
+            segment.length_norms = k1 * (1.0 - b + b * segment.lengths / avg_length)
+
+    def search(self, queries, n_results, level=None, ids=None):
+        """
+        Top documents of each query by BM25 score, among ids only if given.
+
+        Returns:
+            One list of (id, score) per query, best first; documents without any query term are left out
+        """
+        level_code = LEVELS.index(level) if level in LEVELS else None
+        allowed = None
+        if ids is not None:
+            if self.doc_of_id is None:
+                self.doc_of_id = {doc_id: (s, doc) for s, segment in enumerate(self.segments)
+                                  for doc, doc_id in enumerate(segment.ids)}
+            allowed = [np.zeros(segment.count, dtype=bool) for segment in self.segments]
+            for doc_id in ids:
+                if doc_id in self.doc_of_id:
+                    s, doc = self.doc_of_id[doc_id]
+                    allowed[s][doc] = True
+        results = []
+        for query in queries:
+            terms = []
+            for term in set(tokenize(query)):
+                postings = [segment.postings(term) for segment in self.segments]
+                df = sum(len(p[0]) for p in postings if p is not None)
+                if df:
+                    terms.append((math.log(1.0 + (self.count - df + 0.5) / (df + 0.5)), postings))
+            hits = []
+            for s, segment in enumerate(self.segments):
+                scores = np.zeros(segment.count, dtype=np.float32)
+                for idf, postings in terms:
+                    if postings[s] is None:
+                        continue
+                    docs, tfs = postings[s]
+                    scores[docs] += idf * tfs * (self.k1 + 1.0) / (tfs + segment.length_norms[docs])
+                if level_code is not None:
+                    scores[segment.levels != level_code] = 0.0
+                if allowed is not None:
+                    scores[~allowed[s]] = 0.0
+                matched = np.flatnonzero(scores > 0)
+                if len(matched) > n_results:
+                    matched = matched[np.argpartition(-scores[matched], n_results - 1)[:n_results]]
+                matched = matched[np.argsort(-scores[matched], kind="stable")]
+                hits.extend((segment.ids[d], float(scores[d])) for d in matched)
+            # Segments are in document order, so a stable sort keeps ties in document order
+            hits.sort(key=lambda hit: -hit[1])
+            results.append(hits[:n_results])
+        return results
+
+    @staticmethod
+    def stored_index_version(path):
+        """Index version the lexical index was built from, or None if there is no complete index."""
+        try:
+            with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta.get("index_version") if meta.get("format") == LEXICAL_FORMAT else None
+
+
+def segment_path(path, segment):
+    return os.path.join(path, f"segment_{segment:03d}")
+
+
+def remove_index_files(path):
+    """
+    Empty the directory of a segmented side index: meta.json goes first, so readers never see
+    a half-written index as complete, then the old segments (and files of older layouts).
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_file = os.path.join(path, "meta.json")
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
+
+
+class LexicalIndexWriter:
+    """
+    Builds a LexicalIndex document by document. Postings are kept in memory for the current
+    segment only; flush() writes the segment, close() the last one and then meta.json.
+
+    Usage:
+        writer = LexicalIndexWriter(path, index_version)
+        for doc_id, level, text in documents:
+            writer.add(doc_id, level, text)
+        writer.close()
+    """
+
+    def __init__(self, path, index_version=None):
+        self.path = path
+        self.index_version = index_version
+        self.count = 0
+        self.total_length = 0
+        self.segments = 0
+        remove_index_files(path)
+        self._reset()
+
+    def _reset(self):
+        self.ids = []
+        self.levels = []
+        self.lengths = []
+        self.postings = {}  # term -> {doc: term frequency}
+
+    def add(self, doc_id, level, text):
+        doc = len(self.ids)
+        tokens = tokenize(text)
+        self.ids.append(doc_id)
+        self.levels.append(LEVELS.index(level) if level in LEVELS else -1)
+        self.lengths.append(len(tokens))
+        for token in tokens:
+            doc_tfs = self.postings.setdefault(token, {})
+            doc_tfs[doc] = doc_tfs.get(doc, 0) + 1
+
+    def flush(self):
+        """Write the documents added since the last flush as a segment."""
+        if not self.ids:
+            return
+        path = segment_path(self.path, self.segments)
+        os.makedirs(path, exist_ok=True)
+        postings = self.postings
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        for t, term in enumerate(terms):
+            offsets[t + 1] = offsets[t] + len(postings[term])
+        docs = np.empty(offsets[-1], dtype=np.int32)
+        tfs = np.empty(offsets[-1], dtype=np.uint16)
+        for t, term in enumerate(terms):
+            doc_tfs = postings[term]
+            docs[offsets[t]:offsets[t + 1]] = list(doc_tfs)
+            tfs[offsets[t]:offsets[t + 1]] = np.minimum(list(doc_tfs.values()), np.iinfo(np.uint16).max)
+
+        tmp_path = os.path.join(path, f"postings.{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, offsets=offsets, docs=docs, tfs=tfs, lengths=np.array(self.lengths, dtype=np.int32),
+                 levels=np.array(self.levels, dtype=np.int8))
+        os.replace(tmp_path, os.path.join(path, "postings.npz"))
+        tmp_path = os.path.join(path, f"terms.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(terms))
+        os.replace(tmp_path, os.path.join(path, "terms.txt"))
+        write_json_atomic(os.path.join(path, "ids.json"), self.ids)
+
+        self.count += len(self.ids)
+        self.total_length += sum(self.lengths)
+        self.segments += 1
+        self._reset()
+
+    def close(self):
+        """Write the last segment and meta.json."""
+        self.flush()
+        write_json_atomic(os.path.join(self.path, "meta.json"), {
+            "count": self.count,
+            "avg_length": self.total_length / self.count if self.count else 0.0,
+            "segments": self.segments,
+            "index_version": self.index_version,
+            "format": LEXICAL_FORMAT,
+        })
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from json_repair import REPAIRED, TRUNCATED
+
+# 每次 LLM 调用的指标以 JSONL 形式追加到该文件
+METRICS_FILE = os.getenv("METRICS_FILE", "./llm_metrics.jsonl")
+
+
+def request_size(contents):
+    """
+    Approximate the number of bytes sent for a request: UTF-8 text plus raw image data.
+    """
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return len(contents.encode("utf-8"))
+    if isinstance(contents, (bytes, bytearray)):
+        return len(contents)
+    if isinstance(contents, dict):
+        return sum(request_size(v) for k, v in contents.items() if k != "mime_type")
+    if isinstance(contents, (list, tuple)):
+        return sum(request_size(c) for c in contents)
+    return 0
+
+
+class LLMCallRecord:
+    """
+    Metrics of one logical LLM call; retries of the same call are accumulated into it.
+    """
+
+    def __init__(self, stage, request_bytes=0):
+        self.stage = stage
+        self.started_at = time.time()
+        self.wall_time = None
+        self.queue_time = 0.0
+        self.time_to_first_chunk = None
+        self.request_bytes = request_bytes
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.retries = 0
+        self.parse_failures = 0
+        self.repaired = 0
+        self.truncated = 0
+        self.error = None
+        self._start = time.perf_counter()
+        self._request_start = None
+
+    def mark_request_sent(self):
+        """Call once a (possibly rate-limited) request actually starts; earlier time is queueing."""
+        if self._request_start is None:
+            self._request_start = time.perf_counter()
+            self.queue_time = self._request_start - self._start
+
+    def mark_first_chunk(self):
+        """Record time-to-first-chunk for streamed calls (only the first call counts)."""
+        if self.time_to_first_chunk is None:
+            start = self._request_start or self._start
+            self.time_to_first_chunk = time.perf_counter() - start
+
+    def add_usage(self, response):
+        """Add token counts from a Gemini response (or the last streamed chunk), if reported."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_token_count", 0) or 0
+        self.response_tokens += getattr(usage, "candidates_token_count", 0) or 0
+
+    def record_repair(self, status):
+        """Count a response that only parsed after a local repair (see json_repair.parse_json_with_status)."""
+        if status == REPAIRED:
+            self.repaired += 1
+        elif status == TRUNCATED:
+            self.truncated += 1
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "started_at": self.started_at,
+            "wall_time": self.wall_time,
+            "queue_time": self.queue_time,
+            "time_to_first_chunk": self.time_to_first_chunk,
+            "request_bytes": self.request_bytes,
+            "prompt_tokens": self.prompt_tokens,
+            "response_tokens": self.response_tokens,
+            "retries": self.retries,
+            "parse_failures": self.parse_failures,
+            "repaired": self.repaired,
+            "truncated": self.truncated,
+            "error": self.error,
+        }
+
+
+class MetricsRecorder:
+    """
+    Collects LLM call records, appends them to a JSONL file and prints a per-stage summary.
+    """
+
+    def __init__(self, path=METRICS_FILE):
+        self.path = path
+        self.records = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def track(self, stage, contents=None):
+        """
+        Usage:
+            with metrics.track("rerank", prompt) as call:
+                response = model.generate_content(prompt)
+                call.add_usage(response)
+        """
+        record = LLMCallRecord(stage, request_size(contents))
+        try:
+            yield record
+        except BaseException as e:
+            record.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record.wall_time = time.perf_counter() - record._start
+            self._save(record)
+
+    def _save(self, record):
+        line = json.dumps(record.to_dict(), ensure_ascii=False)
+        with self.lock:
+            self.records.append(record)
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+
+    def summary_table(self):
+        """Return a plain-text table with one row per stage."""
+        with self.lock:
+            records = list(self.records)
+        if not records:
+            return "No LLM calls recorded."
+
+        stages = {}
+        for record in records:
+            stages.setdefault(record.stage, []).append(record)
+
+        header = (f"{'stage':<18}{'calls':>7}{'errors':>8}{'total s':>10}{'avg s':>8}{'p95 s':>8}"
+                  f"{'avg ttfc':>10}{'MB sent':>9}{'in tok':>10}{'out tok':>10}{'retries':>9}{'parse fail':>12}"
+                  f"{'repaired':>10}{'truncated':>11}")
+        lines = [header, "-" * len(header)]
+        for stage, stage_records in sorted(stages.items()):
+            times = sorted(r.wall_time for r in stage_records)
+            ttfcs = [r.time_to_first_chunk for r in stage_records if r.time_to_first_chunk is not None]
+            p95 = times[min(len(times) - 1, int(0.95 * len(times)))]
+            avg_ttfc = f"{sum(ttfcs) / len(ttfcs):.2f}" if ttfcs else "-"
+            lines.append(
+                f"{stage:<18}{len(stage_records):>7}{sum(1 for r in stage_records if r.error):>8}"
+                f"{sum(times):>10.1f}{sum(times) / len(times):>8.2f}{p95:>8.2f}{avg_ttfc:>10}"
+                f"{sum(r.request_bytes for r in stage_records) / 1e6:>9.2f}"
+                f"{sum(r.prompt_tokens for r in stage_records):>10}{sum(r.response_tokens for r in stage_records):>10}"
+                f"{sum(r.retries for r in stage_records):>9}{sum(r.parse_failures for r in stage_records):>12}"
+                f"{sum(r.repaired for r in stage_records):>10}{sum(r.truncated for r in stage_records):>11}"
+            )
+        return "\n".join(lines)
+
+    def print_summary(self):
+        print("\n===== LLM Call Metrics =====")
+        print(self.summary_table())
+        if self.path:
+            print(f"Per-call metrics appended to {self.path}")
+
+
+# Shared recorder used by preprocessing.py and query.py
+metrics = MetricsRecorder()
@@ -0,0 +1,142 @@
+import os
+import json
+import threading
+import numpy as np
+from PIL import Image
+from image_cache import file_sha256
+from checkpoint import write_json_atomic
+
+# 感知哈希（dHash，256位）的最大汉明距离，不超过该距离的页面视为同一页
+# 重新压缩/缩放后的同一页面通常在 0-5 之间；注意同一插画的差分页面距离也可能很小
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "4"))
+
+
+# A 256-bit dHash is kept as four 64-bit words, most significant first
+_DHASH_WORDS = 4
+_WORD_MASK = (1 << 64) - 1
+
+
+def _dhash_words(value):
+    return np.array([(value >> (64 * i)) & _WORD_MASK for i in reversed(range(_DHASH_WORDS))], dtype=np.uint64)
+
+
+def dhash(image_path, hash_size=16):
+    """
+    Difference hash: compares neighbouring pixels of a tiny grayscale thumbnail.
+    Survives re-encoding and resizing, so re-uploaded scans of the same page match.
+    """
+    with Image.open(image_path) as img:
+        pixels = np.asarray(img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS))
+    bits = pixels[:, :-1] > pixels[:, 1:]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class PageAnalysisCache:
+    """
+    Page JSON keyed by exact content hash, with a perceptual hash for near-identical copies.
+
+    The perceptual hashes are rows of one uint64 matrix, so a lookup computes the Hamming
+    distances to all stored pages in a single vectorized pass, outside the lock.
+
+    Layout:
+        <root>/index.jsonl          one {"sha256", "dhash"} line per stored page (append-only)
+        <root>/pages/<sha256>.json  the page object as returned by the model
+    """
+
+    def __init__(self, root, max_distance=PHASH_MAX_DISTANCE):
+        self.root = root
+        self.max_distance = max_distance
+        self.index_file = os.path.join(root, "index.jsonl")
+        self.pages_dir = os.path.join(root, "pages")
+        self.lock = threading.Lock()
+        self.rows = {}  # sha256 -> row of self.words
+        self.shas = []  # row -> sha256
+        # Grown by doubling; rows below len(self.shas) never change, so lookups can read a snapshot
+        self.words = np.zeros((0, _DHASH_WORDS), dtype=np.uint64)
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # tolerate a torn last line after a crash
+                    self._add(entry["sha256"], int(entry["dhash"], 16))
+
+    def _page_file(self, sha256):
+        return os.path.join(self.pages_dir, f"{sha256}.json")
+
+    def _image_hashes(self, image_path):
+        try:
+            return file_sha256(image_path), dhash(image_path)
+        except (OSError, ValueError) as e:
+            print(f"Could not hash {image_path}: {e}")
+            return None, None
+
+    def _add(self, sha256, phash):
+        if sha256 in self.rows:
+            return
+        count = len(self.shas)
+        if count == len(self.words):
+            words = np.zeros((max(64, 2 * count), _DHASH_WORDS), dtype=np.uint64)
+            words[:count] = self.words[:count]
+            self.words = words
+        self.words[count] = _dhash_words(phash)
+        self.rows[sha256] = count
+        self.shas.append(sha256)
+
+    def _find_match(self, sha256, phash):
+        with self.lock:
+            if sha256 in self.rows:
+                self.hits += 1
+                return sha256
+            count = len(self.shas)
+            words = self.words
+        best = None
+        if count:
+            distances = np.bitwise_count(words[:count] ^ _dhash_words(phash)).sum(axis=1)
+            row = int(np.argmin(distances))
+            if distances[row] <= self.max_distance:
+                best = self.shas[row]
+        with self.lock:
+            if best is not None:
+                self.near_hits += 1
+            else:
+                self.misses += 1
+        return best
+
+    def lookup(self, image_path, page_number):
+        """
+        Return a copy of the stored analysis of an identical or near-identical page,
+        with image_path and page_number rewritten for this page; None on a miss.
+        """
+        sha256, phash = self._image_hashes(image_path)
+        if sha256 is None:
+            return None
+        match = self._find_match(sha256, phash)
+        if match is None:
+            return None
+        try:
+            with open(self._page_file(match), "r", encoding="utf-8") as f:
+                page_object = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        page_object["image_path"] = image_path
+        page_object["page_number"] = page_number
+        return page_object
+
+    def store(self, image_path, page_object):
+        """Remember the analysis of a page so later copies can reuse it."""
+        sha256, phash = self._image_hashes(image_path)
+        if sha256 is None:
+            return
+        with self.lock:
+            if sha256 in self.rows:
+                return
+            os.makedirs(self.pages_dir, exist_ok=True)
+            write_json_atomic(self._page_file(sha256), page_object)
+            with open(self.index_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"sha256": sha256, "dhash": f"{phash:064x}"}) + "\n")
+            self._add(sha256, phash)
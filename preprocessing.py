@@ -5,49 +5,68 @@ import google.generativeai as genai  # Changed import pattern
 from dotenv import load_dotenv
 from tqdm import tqdm
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from checkpoint import CheckpointStore, safe_filename
+from json_repair import clean_json_response, parse_json_with_status, TRUNCATED
+from image_cache import normalize_images
+from page_cache import PageAnalysisCache
+from metrics import metrics, request_size
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
+MODEL_NAME = "gemini-2.0-flash"
 
+# 并发设置：默认逐本、逐页处理，可通过环境变量调大
+BOOK_WORKERS = int(os.getenv("BOOK_WORKERS", "1"))
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", "1"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "0")) or None
 
-def generate_json_with_retry(model, prompt, retries=3):
+# 书籍摘要：超过该页数的漫画先分段摘要（map），再合并为整本摘要（reduce）
+BOOK_SUMMARY_CHUNK_PAGES = int(os.getenv("BOOK_SUMMARY_CHUNK_PAGES", "30"))
+
+# 每个请求分析的页面数量，大于1时 schema 只发送一次，返回页面对象数组
+PAGE_BATCH_SIZE = int(os.getenv("PAGE_BATCH_SIZE", "1"))
+
+# 上传前先缩放/重新压缩页面图片（设置见 image_cache.py）
+NORMALIZE_IMAGES = os.getenv("NORMALIZE_IMAGES", "1") == "1"
+
+# 重复页面（完全相同或感知哈希相近）直接复用已有的分析结果
+PAGE_CACHE = os.getenv("PAGE_CACHE", "1") == "1"
+
+
+def generate_json_with_retry(model, prompt, retries=3, generation_config=None, request_semaphore=None,
+                             stage="book_summary"):
     """
     Generate JSON with retries in case of failure.
+    Responses are repaired locally first, so only unrepairable ones cost another request.
+    All attempts are recorded as one call of the given metrics stage.
     """
-    for attempt in range(retries):
-        try:
-            response = model.send_message(prompt)
-            cleaned_response = clean_json_response(response.text)
-            return json.loads(cleaned_response)  # Parse JSON
-        except json.JSONDecodeError as e:
-            print(f"Attempt {attempt + 1} failed: {e}")
-            print("Retrying...")
+    with metrics.track(stage) as call:
+        for attempt in range(retries):
+            call.retries = attempt
+            call.request_bytes += request_size(prompt)
+            try:
+                with request_semaphore or nullcontext():
+                    call.mark_request_sent()
+                    response = model.generate_content(prompt, generation_config=generation_config)
+                call.add_usage(response)
+                result, status = parse_json_with_status(response.text)  # Parse (and repair) JSON
+                call.record_repair(status)
+                # A truncated response lost its tail; ask again while attempts remain
+                if status == TRUNCATED and attempt + 1 < retries:
+                    print(f"Attempt {attempt + 1} returned truncated JSON, retrying...")
+                    continue
+                return result
+            except json.JSONDecodeError as e:
+                call.parse_failures += 1
+                print(f"Attempt {attempt + 1} failed: {e}")
+                print("Retrying...")
     print("Failed to generate valid JSON after retries.")
     return None
 
-# Helper function to clean JSON responses from markdown formatting
-def clean_json_response(response_text):
-    """
-    Remove markdown code block formatting if present.
-    """
-    if response_text.startswith('```'):
-        # Find the end of the opening markdown delimiter
-        first_newline = response_text.find('\n')
-        if first_newline > 0:
-            # Find the closing markdown delimiter
-            last_triple_backtick = response_text.rfind('```')
-            if last_triple_backtick > first_newline:
-                # Extract just the JSON content
-                response_text = response_text[first_newline+1:last_triple_backtick].strip()
-            else:
-                # Only remove the opening delimiter if no closing one is found
-                response_text = response_text[first_newline+1:].strip()
-    return response_text
-
 # Updated prompt to match the specific schema requirements
-prompt_page_level = """ 
-You are analyzing a manga page image. Output a JSON object that follows EXACTLY this schema:
-
-{
+page_schema = """{
   "page_number": integer,     // The page number 
   "image_path": "string",     // Path to the image file
   "summary": "string",        // 1-2 sentence gist of this page
@@ -74,23 +93,47 @@ You are analyzing a manga page image. Output a JSON object that follows EXACTLY
       "summary": "string"       // 1-2 concise sentences
     }
   ]
-}
+}"""
+
+prompt_page_level = """ 
+You are analyzing a manga page image. Output a JSON object that follows EXACTLY this schema:
+
+""" + page_schema + """
 
 Return ONLY valid JSON – no markdown, no code blocks, no triple backticks, just the raw JSON object.
 """
+
+# Batched mode: the schema is sent once for several pages
+prompt_page_batch = """
+You are analyzing {count} manga page images. Each image is preceded by a line giving its page number and image path.
+Output a JSON array with exactly {count} page objects, one per image and in the same order.
+Each page object follows EXACTLY this schema:
+
+""" + page_schema + """
+
+Return ONLY valid JSON – no markdown, no code blocks, no triple backticks, just the raw JSON array.
+"""
     
 prompt_book_level = """
-Based on all the manga pages you've analyzed, create a complete manga book JSON object that follows EXACTLY this schema:
+Below are the page-by-page notes of a manga you've analyzed (or summaries of consecutive sections of it).
+Write the overall summary of the manga and output a JSON object that follows EXACTLY this schema:
 
 {
   "manga_name": "string",    // The name of the manga
-  "summary": "string",       // Overall summary of the manga
-  "pages": [                 // Array of all analyzed pages
-    // Each page object you've already analyzed
-  ]
+  "summary": "string"        // Overall summary of the manga
+}
+
+Return ONLY valid JSON – no markdown, no code blocks, no triple backticks, just the raw JSON object.
+"""
+
+prompt_section_level = """
+Below are the page-by-page notes of one section of a manga.
+Summarize what happens in this section and output a JSON object that follows EXACTLY this schema:
+
+{
+  "summary": "string"        // 2-4 sentences covering the characters and events of this section
 }
 
-Your response should be a single, complete JSON object that combines all the pages you've analyzed into a coherent manga book object.
 Return ONLY valid JSON – no markdown, no code blocks, no triple backticks, just the raw JSON object.
 """
 def numerical_sort_key(filename):
@@ -144,151 +187,461 @@ def get_manga_folders(root_folder):
             manga_folders.append(item_path)
     return sorted(manga_folders)
 
-def generate_schema_compliant_manga(image_paths, manga_name):
+def get_output_dir(manga_root_folder):
+    """
+    分析结果保存在 manga_images 同级的 manga_analyses 目录中。
+    """
+    return os.path.join(os.path.dirname(manga_root_folder), "manga_analyses")
+
+def get_schema_path(output_dir, manga_name):
+    """
+    返回一本漫画的 schema 文件路径。
+    """
+    return os.path.join(output_dir, f"{safe_filename(manga_name)}_schema.json")
+
+def build_page_request(image_path, idx, upload_path=None):
+    """
+    读取图片并构造单页分析请求的 (image_part, prompt)。
+    upload_path 为缩放后的缓存图片路径；prompt 中仍然使用原始的 image_path。
+    """
+    upload_path = upload_path or image_path
+    with open(upload_path, "rb") as f:
+        image_data = f.read()
+
+    # Create image part with correct MIME type
+    mime_type = get_mime_type(upload_path)
+    image_part = {"mime_type": mime_type, "data": image_data}
+
+    # Modified prompt to include specific page information
+    page_specific_prompt = prompt_page_level + f"\nThis is page {idx + 1} and the image path is '{image_path}'"
+    return image_part, page_specific_prompt
+
+def stream_response_text(gemini_model, contents, generation_config, request_semaphore=None, call=None):
+    """
+    发送一个流式请求并拼接返回的文本。
+    call 为 metrics.track 返回的记录，用于记录排队时间、首个 chunk 的延迟和 token 数。
+    """
+    partial_response = ""
+    last_chunk = None
+    with request_semaphore or nullcontext():
+        if call is not None:
+            call.mark_request_sent()
+        for chunk in gemini_model.generate_content(
+            contents,
+            generation_config=generation_config,
+            stream=True
+        ):
+            if call is not None:
+                call.mark_first_chunk()
+            last_chunk = chunk
+            if hasattr(chunk, 'text'):
+                partial_response += chunk.text
+    # Streamed responses report cumulative usage on the final chunk
+    if call is not None and last_chunk is not None:
+        call.add_usage(last_chunk)
+    return partial_response
+
+def analyze_page(gemini_model, image_path, idx, manga_name, generation_config, request_semaphore=None,
+                 checkpoint_store=None, upload_path=None, page_cache=None):
+    """
+    分析单张漫画页面。
+
+    Args:
+        gemini_model: 带有 generate_content 方法的模型（或本地的 fake client）
+        image_path: 图片路径
+        idx: 页面在阅读顺序中的下标（从0开始）
+        manga_name: 漫画名称
+        generation_config: 生成参数
+        request_semaphore: 可选的全局信号量，用于限制同时进行的请求数量
+        checkpoint_store: 可选的 CheckpointStore，解析成功后立即保存该页结果
+        upload_path: 实际上传的图片路径（例如缩放后的缓存图片），默认上传原图
+        page_cache: 可选的 PageAnalysisCache，解析成功后记录该页结果供重复页面复用
+
+    Returns:
+        解析后的 page_object，解析失败时为 None
+    """
+    image_part, page_specific_prompt = build_page_request(image_path, idx, upload_path)
+    contents = [image_part, page_specific_prompt]
+
+    with metrics.track("page_analysis", contents) as call:
+        # Generate content with streaming for page analysis
+        partial_response = stream_response_text(gemini_model, contents, generation_config,
+                                                request_semaphore, call)
+
+        print(f"\n{manga_name} 第 {idx + 1} 张图分析结果：\n{partial_response[:500]}...\n")
+
+        try:
+            # Clean the response and then parse the JSON
+            cleaned_response = clean_json_response(partial_response)
+            page_object, status = parse_json_with_status(cleaned_response)
+            call.record_repair(status)
+            if status == TRUNCATED:
+                print(f"Warning: the response for page {idx + 1} was truncated and repaired; its last panels may be missing")
+        except json.JSONDecodeError as e:
+            call.parse_failures += 1
+            print(f"Error parsing JSON for page {idx + 1}: {e}")
+            print("Response was:", partial_response[:1000])
+            print("Cleaned response was:", cleaned_response[:1000])
+            return None
+
+    if checkpoint_store is not None:
+        checkpoint_store.save_page(manga_name, idx, image_path, page_object)
+    if page_cache is not None:
+        page_cache.store(image_path, page_object)
+
+    return page_object
+
+def _batch_page_index(page_object, batch):
+    """
+    批量结果中的页面对象对应 batch 中的哪一页：先按图片路径，再按页码匹配；
+    模型跳过或合并页面时，其余页面仍能对上。对不上时返回 None。
+    """
+    if not isinstance(page_object, dict):
+        return None
+    for idx, image_path in batch:
+        if page_object.get("image_path") == image_path:
+            return idx
+    try:
+        page_number = int(page_object.get("page_number"))
+    except (TypeError, ValueError):
+        return None
+    return next((idx for idx, _ in batch if idx + 1 == page_number), None)
+
+def analyze_page_batch(gemini_model, batch, manga_name, generation_config, request_semaphore=None,
+                       checkpoint_store=None, upload_paths=None, page_cache=None):
+    """
+    在一个请求中分析多张页面，schema 只发送一次。
+
+    Args:
+        batch: [(idx, image_path), ...]，按阅读顺序排列
+        upload_paths: 原图路径到实际上传图片路径的映射
+        其余参数同 analyze_page
+
+    Returns:
+        {idx: page_object}；批量结果无法使用的页面会退回到逐页请求
+    """
+    upload_paths = upload_paths or {}
+    contents = []
+    for idx, image_path in batch:
+        image_part, _ = build_page_request(image_path, idx, upload_paths.get(image_path))
+        contents.append(f"Page {idx + 1}, image path '{image_path}':")
+        contents.append(image_part)
+    contents.append(prompt_page_batch.replace("{count}", str(len(batch))))
+
+    first_page, last_page = batch[0][0] + 1, batch[-1][0] + 1
+    with metrics.track("page_batch", contents) as call:
+        partial_response = stream_response_text(gemini_model, contents, generation_config,
+                                                request_semaphore, call)
+        print(f"\n{manga_name} 第 {first_page}-{last_page} 张图批量分析结果：\n{partial_response[:500]}...\n")
+
+        cleaned_response = clean_json_response(partial_response)
+        truncated = False
+        try:
+            pages, status = parse_json_with_status(cleaned_response)
+            call.record_repair(status)
+            truncated = status == TRUNCATED
+        except json.JSONDecodeError as e:
+            call.parse_failures += 1
+            print(f"Error parsing batch JSON for pages {first_page}-{last_page}: {e}")
+            pages = []
+    if isinstance(pages, dict):
+        pages = pages.get("pages", [pages])
+    if not isinstance(pages, list):
+        pages = []
+
+    # A truncated response may have cut its last object off mid-way, so that one is not trusted
+    usable = pages[:-1] if truncated else pages
+    image_paths = dict(batch)
+    results = {}
+    for page_object in usable:
+        idx = _batch_page_index(page_object, batch)
+        if idx is None or idx in results:
+            continue
+        image_path = image_paths[idx]
+        page_object["page_number"] = idx + 1
+        page_object["image_path"] = image_path
+        results[idx] = page_object
+        if checkpoint_store is not None:
+            checkpoint_store.save_page(manga_name, idx, image_path, page_object)
+        if page_cache is not None:
+            page_cache.store(image_path, page_object)
+
+    missing = [(idx, image_path) for idx, image_path in batch if idx not in results]
+    if missing:
+        print(f"Batch for pages {first_page}-{last_page} returned {len(results)}/{len(batch)} usable pages, "
+              f"falling back to per-page requests for the rest")
+    for idx, image_path in missing:
+        results[idx] = analyze_page(gemini_model, image_path, idx, manga_name, generation_config,
+                                    request_semaphore, checkpoint_store, upload_paths.get(image_path), page_cache)
+    return results
+
+def page_digest(page_object):
+    """
+    把单页的 JSON 压缩成书籍摘要所需的文字笔记（页面摘要、角色、各分镜摘要和对白）。
+    """
+    lines = [f"Page {page_object.get('page_number', '?')}: {page_object.get('summary', '')}"]
+    for panel in page_object.get("panels", []):
+        names = sorted({c.get("name", "") for c in panel.get("characters", []) if c.get("name")})
+        dialogue = " / ".join(panel.get("narrative", {}).get("dialogue", []))
+        line = f"  - Panel {panel.get('panel_id', '?')}: {panel.get('summary', '')}"
+        if names:
+            line += f" Characters: {', '.join(names)}."
+        if dialogue:
+            line += f" Dialogue: {dialogue}"
+        lines.append(line)
+    return "\n".join(lines)
+
+def summarize_book(gemini_model, manga_name, page_objects, generation_config, request_semaphore=None,
+                   chunk_pages=BOOK_SUMMARY_CHUNK_PAGES):
+    """
+    只根据已解析的 page_objects 生成整本漫画的摘要，不再重新上传页面图片。
+
+    短篇漫画直接一次请求；超过 chunk_pages 页的漫画先对每一段做摘要（map），
+    再把各段摘要合并成整本摘要（reduce）。
+
+    Returns:
+        {"manga_name": ..., "summary": ...}，失败时为 None
+    """
+    digests = [page_digest(page) for page in page_objects]
+
+    if len(digests) > chunk_pages:
+        notes = []
+        for start in range(0, len(digests), chunk_pages):
+            section_prompt = prompt_section_level + "\n" + "\n".join(digests[start:start + chunk_pages])
+            section = generate_json_with_retry(gemini_model, section_prompt, generation_config=generation_config,
+                                               request_semaphore=request_semaphore, stage="section_summary")
+            if not section or not section.get("summary"):
+                print(f"Failed to summarize pages {start + 1}-{start + chunk_pages} of '{manga_name}'.")
+                return None
+            end = min(start + chunk_pages, len(digests))
+            notes.append(f"Pages {start + 1}-{end}: {section['summary']}")
+    else:
+        notes = digests
+
+    final_prompt = prompt_book_level + f"\nThe manga name is '{manga_name}' and it has {len(page_objects)} pages.\n\n" + "\n".join(notes)
+    return generate_json_with_retry(gemini_model, final_prompt, generation_config=generation_config,
+                                    request_semaphore=request_semaphore)
+
+def generate_schema_compliant_manga(image_paths, manga_name, gemini_model=None, page_workers=PAGE_WORKERS,
+                                    request_semaphore=None, output_dir=None, checkpoint_store=None,
+                                    normalize=NORMALIZE_IMAGES, page_cache=None, page_batch_size=PAGE_BATCH_SIZE):
     """
     分析单本漫画的所有页面，并生成符合schema的JSON对象
     
     Args:
-        image_paths: 一本漫画的所有图片路径
+        image_paths: 一本漫画的所有图片路径（已按 numerical_sort_key 排序）
         manga_name: 漫画名称（文件夹名）
+        gemini_model: 可选的模型实例，默认创建 Gemini 模型；测试时可传入本地 fake client
+        page_workers: 同一本漫画内并发分析的页面数量，1 表示逐页分析
+        request_semaphore: 可选的全局信号量，限制所有漫画同时进行的请求数量
+        output_dir: schema 文件的保存目录，默认为 manga_images 同级的 manga_analyses
+        checkpoint_store: 逐页保存结果的 CheckpointStore，默认保存在 output_dir/.checkpoints
+        normalize: 上传前是否缩放并重新压缩页面图片
+        page_cache: 重复页面的分析缓存，默认保存在 output_dir/.page_cache；PAGE_CACHE=0 时不使用
+        page_batch_size: 每个请求分析的页面数量，1 表示每页一个请求
     """
     if not image_paths:
         print(f"漫画 '{manga_name}' 没有找到任何图片文件")
         return
 
-    # Configure the API
-    genai.configure(api_key=API_KEY)
+    if output_dir is None:
+        # image_paths[0] 位于 <manga_images>/<漫画>/ 下，get_output_dir 需要的是 manga_images 目录
+        output_dir = get_output_dir(os.path.dirname(os.path.dirname(image_paths[0])))
+    if checkpoint_store is None:
+        checkpoint_store = CheckpointStore(os.path.join(output_dir, ".checkpoints"))
+    if page_cache is None and PAGE_CACHE:
+        page_cache = PageAnalysisCache(os.path.join(output_dir, ".page_cache"))
 
     print(f"漫画 '{manga_name}' 共找到 {len(image_paths)} 张图片：")
     for f in image_paths:
         print(" -", os.path.basename(f))
 
-    # Initialize a list to store page objects
-    page_objects = []
-
     # Create a generative model instance
-    gemini_model = genai.GenerativeModel(model_name="gemini-2.0-flash")
+    if gemini_model is None:
+        # Configure the API
+        genai.configure(api_key=API_KEY)
+        gemini_model = genai.GenerativeModel(model_name=MODEL_NAME)
     generation_config = {
         "temperature": 0.7,
         "top_p": 0.95,
         "max_output_tokens": 81920,
     }
-    
-    # Initialize content for conversation
-    conversation = []
- 
+
+    # Results are stored by index so that pages stay in reading order
+    # no matter in which order the requests finish
+    page_results = [None] * len(image_paths)
+
+    # Pages already checkpointed by a previous run are not analysed again
+    pending = []
     for idx, image_path in enumerate(image_paths):
-        with open(image_path, "rb") as f:
-            image_data = f.read()
-        
-        # Create image part with correct MIME type
-        mime_type = get_mime_type(image_path)
-        image_part = {"mime_type": mime_type, "data": image_data}
-        
-        # Modified prompt to include specific page information
-        page_specific_prompt = prompt_page_level + f"\nThis is page {idx + 1} and the image path is '{image_path}'"
-        
-        # Generate content with streaming for page analysis
-        partial_response = ""
-        for chunk in gemini_model.generate_content(
-            [image_part, page_specific_prompt],
-            generation_config=generation_config,
-            stream=True
-        ):
-            if hasattr(chunk, 'text'):
-                partial_response += chunk.text
+        page_results[idx] = checkpoint_store.load_page(manga_name, idx, image_path)
+        if page_results[idx] is None:
+            pending.append((idx, image_path))
+    if len(pending) < len(image_paths):
+        print(f"漫画 '{manga_name}' 从检查点恢复了 {len(image_paths) - len(pending)} 页，剩余 {len(pending)} 页需要分析")
 
-        print(f"\n{manga_name} 第 {idx + 1} 张图分析结果：\n{partial_response[:500]}...\n")
-        
+    # Duplicate pages (e.g. copied folders, shared credit pages) reuse an earlier analysis
+    if page_cache is not None:
+        remaining = []
+        for idx, image_path in pending:
+            page_object = page_cache.lookup(image_path, idx + 1)
+            if page_object is None:
+                remaining.append((idx, image_path))
+                continue
+            page_results[idx] = page_object
+            checkpoint_store.save_page(manga_name, idx, image_path, page_object)
+        if len(remaining) < len(pending):
+            print(f"漫画 '{manga_name}' 有 {len(pending) - len(remaining)} 页与已分析的页面重复，直接复用结果")
+        pending = remaining
+
+    # Downscaled copies come from the on-disk cache; only new images are re-encoded
+    upload_paths = normalize_images([image_path for _, image_path in pending]) if normalize else {}
+
+    def analyze_unit(unit):
+        # A failed request (network error, blocked response, ...) only loses its own pages;
+        # they have no checkpoint yet, so a re-run retries them
         try:
-            # Clean the response and then parse the JSON
-            cleaned_response = clean_json_response(partial_response)
-            page_object = json.loads(cleaned_response)
-            page_objects.append(page_object)
-            
-            # Add model response to conversation for book-level analysis
-            conversation.append({"role": "user", "parts": [image_part, page_specific_prompt]})
-            conversation.append({"role": "model", "parts": [{"text": partial_response}]})
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON for page {idx + 1}: {e}")
-            print("Response was:", partial_response[:1000])
-            print("Cleaned response was:", cleaned_response[:1000])
-    
+            if len(unit) == 1:
+                idx, image_path = unit[0]
+                return {idx: analyze_page(gemini_model, image_path, idx, manga_name, generation_config,
+                                          request_semaphore, checkpoint_store, upload_paths.get(image_path),
+                                          page_cache)}
+            return analyze_page_batch(gemini_model, unit, manga_name, generation_config, request_semaphore,
+                                      checkpoint_store, upload_paths, page_cache)
+        except Exception as e:
+            pages = ", ".join(str(idx + 1) for idx, _ in unit)
+            print(f"漫画 '{manga_name}' 第 {pages} 页分析失败: {e}")
+            return {}
+
+    # Each unit is one request: a single page, or page_batch_size consecutive pages
+    batch_size = max(1, page_batch_size)
+    units = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    if page_workers > 1:
+        with ThreadPoolExecutor(max_workers=page_workers) as executor:
+            futures = [executor.submit(analyze_unit, unit) for unit in units]
+            for future in as_completed(futures):
+                for idx, page_object in future.result().items():
+                    page_results[idx] = page_object
+    else:
+        for unit in units:
+            for idx, page_object in analyze_unit(unit).items():
+                page_results[idx] = page_object
+
+    page_objects = [page_object for page_object in page_results if page_object is not None]
+
     # Skip book-level processing if no valid pages were found
     if not page_objects:
         print(f"No valid page objects were parsed for manga '{manga_name}'. Skipping book-level analysis.")
         return None
         
-    # Add book-level prompt to create the final manga object
-    final_prompt = prompt_book_level + f"\nThe manga name is '{manga_name}' and it has {len(page_objects)} pages."
-    conversation.append({"role": "user", "parts": [{"text": final_prompt}]})
-
-    # Create a conversation for book-level analysis
-    chat = gemini_model.start_chat(history=conversation)
-    
-    # Generate complete manga object
-    final_response = chat.send_message(final_prompt)
-    manga_json_text = final_response.text
-
-    # Generate complete manga object with retries
-    manga_object = generate_json_with_retry(chat, final_prompt)
+    # The book-level summary only needs the parsed pages, which are then attached locally
+    book_summary = summarize_book(gemini_model, manga_name, page_objects, generation_config, request_semaphore)
+    manga_object = None
+    if book_summary and book_summary.get("summary"):
+        manga_object = {
+            "manga_name": manga_name,
+            "summary": book_summary["summary"],
+            "pages": page_objects,
+        }
     if manga_object:
         print(f"\n{manga_name} 生成完整manga对象成功")
-        # Save the manga object as before
     else:
+        # Page checkpoints are kept, so a re-run only repeats the book-level step
         print(f"Failed to generate manga object for '{manga_name}'.")
-    
-    try:
-        # Clean and parse the final manga object
-        
-        # Save results to a JSON file with manga name
-        output_dir = os.path.join(os.path.dirname(manga_root_folder), "manga_analyses")
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Sanitize manga name for filename
-        safe_manga_name = "".join(x for x in manga_name if x.isalnum() or x in (' ', '-', '_'))
-        output_file = os.path.join(output_dir, f"{safe_manga_name}_schema.json")
-        
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(manga_object, f, ensure_ascii=False, indent=2)
-        
-        print(f"\n{manga_name} schema对象已保存到 {output_file}")
-        
-        return manga_object
-    except json.JSONDecodeError as e:
-        print(f"Error parsing final manga JSON: {e}")
-        print("Response was:", manga_json_text[:1000])
         return None
+    
+    # Save results to a JSON file with manga name
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = get_schema_path(output_dir, manga_name)
+    
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(manga_object, f, ensure_ascii=False, indent=2)
+    
+    print(f"\n{manga_name} schema对象已保存到 {output_file}")
+    checkpoint_store.mark_book_complete(manga_name, output_file, len(page_objects))
+    
+    return manga_object
 
-def process_all_manga(manga_root_folder):
+def process_all_manga(manga_root_folder, book_workers=BOOK_WORKERS, page_workers=PAGE_WORKERS,
+                      max_concurrent_requests=MAX_CONCURRENT_REQUESTS, skip_existing=True, gemini_model=None,
+                      normalize=NORMALIZE_IMAGES):
     """
     处理所有漫画文件夹
+
+    Args:
+        manga_root_folder: 包含多个漫画子文件夹的根目录
+        book_workers: 同时处理的漫画数量
+        page_workers: 每本漫画内同时分析的页面数量
+        max_concurrent_requests: 全局同时进行的页面请求上限，None 表示不限制
+        skip_existing: 跳过已经完成（或已有 schema 文件）的漫画
+        gemini_model: 可选的模型（或本地的 fake client），默认按 MODEL_NAME 创建
+        normalize: 上传前是否缩放页面图片
+
+    Returns:
+        漫画名称 -> 成功生成的 manga 对象
     """
     manga_folders = get_manga_folders(manga_root_folder)
     
     if not manga_folders:
         print(f"在 {manga_root_folder} 中没有找到任何漫画文件夹")
-        return
+        return {}
+
+    output_dir = get_output_dir(manga_root_folder)
+    checkpoint_store = CheckpointStore(os.path.join(output_dir, ".checkpoints"))
+    page_cache = PageAnalysisCache(os.path.join(output_dir, ".page_cache")) if PAGE_CACHE else None
+    if skip_existing:
+        remaining = [
+            folder for folder in manga_folders
+            if not checkpoint_store.is_book_complete(os.path.basename(folder))
+            and not os.path.exists(get_schema_path(output_dir, os.path.basename(folder)))
+        ]
+        if len(remaining) < len(manga_folders):
+            print(f"跳过 {len(manga_folders) - len(remaining)} 本已完成的漫画")
+        manga_folders = remaining
     
     print(f"找到 {len(manga_folders)} 本漫画需要处理:")
     for folder in manga_folders:
         print(f" - {os.path.basename(folder)}")
     
-    all_manga_objects = {}
-    
-    for manga_folder in tqdm(manga_folders):
+    # Configure once and share the model across all books and worker threads
+    if gemini_model is None:
+        genai.configure(api_key=API_KEY)
+        gemini_model = genai.GenerativeModel(model_name=MODEL_NAME)
+    request_semaphore = threading.BoundedSemaphore(max_concurrent_requests) if max_concurrent_requests else None
+
+    def process_manga_folder(manga_folder):
         manga_name = os.path.basename(manga_folder)
         print(f"\n开始处理漫画: {manga_name}")
         
         image_files = get_image_files(manga_folder)
-        if image_files:
-            manga_object = generate_schema_compliant_manga(image_files, manga_name)
+        if not image_files:
+            print(f"漫画 '{manga_name}' 文件夹中没有找到图片文件")
+            return manga_name, None
+        manga_object = generate_schema_compliant_manga(
+            image_files, manga_name, gemini_model=gemini_model,
+            page_workers=page_workers, request_semaphore=request_semaphore,
+            output_dir=output_dir, checkpoint_store=checkpoint_store, normalize=normalize,
+            page_cache=page_cache
+        )
+        return manga_name, manga_object
+
+    all_manga_objects = {}
+    
+    with ThreadPoolExecutor(max_workers=max(1, book_workers)) as executor:
+        futures = {executor.submit(process_manga_folder, folder): folder for folder in manga_folders}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            # One failing book is logged and left for the next run; the others keep going
+            try:
+                manga_name, manga_object = future.result()
+            except Exception as e:
+                print(f"漫画 '{os.path.basename(futures[future])}' 处理失败: {e}")
+                continue
             if manga_object:
                 all_manga_objects[manga_name] = manga_object
-        else:
-            print(f"漫画 '{manga_name}' 文件夹中没有找到图片文件")
     
     print(f"\n所有漫画处理完成。成功处理了 {len(all_manga_objects)} 本漫画。")
+    metrics.print_summary()
+    return all_manga_objects
 
 
 if __name__ == "__main__":
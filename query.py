@@ -1,23 +1,120 @@
 import os
 import json
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
-import chromadb
-import google.generativeai as genai
 from dotenv import load_dotenv
+from json_repair import clean_json_response, parse_json_with_status, TRUNCATED
+from metrics import metrics
+from rerank_cache import RerankCache, rerank_cache_key, RERANK_CACHE, RERANK_CACHE_FILE
+from index_manifest import MANIFEST_FILE, load_index_manifest
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
 
-# Initialize Google Generative AI
-genai.configure(api_key=API_KEY)
 model = "gemini-2.0-flash"
 
+# chromadb and google.generativeai take seconds to import, so they are loaded on first use;
+# the caches and indexes import numpy, so they are imported where they are first used
+_genai = None
+_genai_lock = threading.Lock()
+
+def get_genai():
+    """Import and configure Google Generative AI on first use."""
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            import google.generativeai as genai
+            genai.configure(api_key=API_KEY)
+            _genai = genai
+    return _genai
+
+# Bump whenever the rerank prompt changes, so cached rerank results are not reused
+RERANK_PROMPT_VERSION = "1"
+
+# Explanation used when results are ranked by vector similarity only (LLM rerank failed)
+FALLBACK_EXPLANATION = "Ranked by vector similarity."
+
+# Maximum number of concurrent LLM rerank calls in search_many
+RERANK_CONCURRENCY = int(os.getenv("RERANK_CONCURRENCY", "4"))
+
+class CollectionState:
+    """
+    Collection handle, existence, size and per-level document counts, read once per index
+    version instead of on every query.
+    """
+    def __init__(self, chroma_client, name: str = "manga_collection"):
+        self.chroma_client = chroma_client
+        self.name = name
+        self.collection = None
+        self.exists = False
+        self.count = 0
+        self.level_counts = {}
+        self.index_version = None
+    
+    def refresh(self, index_version: int = None):
+        """Re-read the collection (it may have been recreated by vectorize.py) and its counts."""
+        from vector_store import LEVELS
+        try:
+            self.collection = self.chroma_client.get_collection(self.name)
+        except Exception:
+            self.collection = None
+        self.exists = self.collection is not None
+        self.count = self.collection.count() if self.exists else 0
+        self.level_counts = {
+            level: len(self.collection.get(where={"level": level}, include=[])["ids"]) if self.count else 0
+            for level in LEVELS
+        }
+        self.index_version = index_version
+
 class MangaRetrieval:
     def __init__(self, chroma_db_path: str = "./_chroma"):
-        """Initialize the manga retrieval system with a Chroma DB."""
-        # Connect to Chroma
-        self.chroma_client = chromadb.PersistentClient(path=chroma_db_path)
-        self.collection = self.chroma_client.get_collection("manga_collection")
+        """
+        Initialize the manga retrieval system with a Chroma DB.
+        
+        The Chroma client, the embedding model and the rerank cache are created on first use,
+        so constructing a MangaRetrieval is cheap.
+        """
+        from embedding_cache import EMBEDDING_MODEL_ID
+        from query_cache import (QueryEmbeddingCache, QUERY_CACHE_PERSIST, QUERY_CACHE_FILE,
+                                 SemanticQueryCache, SEMANTIC_CACHE, SEMANTIC_CACHE_MODE)
+        from vector_store import VECTOR_STORE
+        from lexical_index import LEXICAL_SEARCH
+        self.chroma_db_path = chroma_db_path
+        self._init_lock = threading.RLock()
+        self._chroma_client = None
+        self._embedding_function = None
+        self._rerank_cache = None
+        self._rerank_cache_enabled = RERANK_CACHE
+        self._collection_state = None
+        self._numpy_store = None
+        self._numpy_store_loaded_for = None
+        self._sharded_store = None
+        self._sharded_store_loaded_for = None
+        self._lexical_index = None
+        self._lexical_index_loaded_for = None
+        # BM25 results over dialogue, text elements and character names are fused with the vector results
+        self.lexical_search = LEXICAL_SEARCH
+        self._entity_index = None
+        self._entity_index_loaded_for = None
+        # How searches with entity filters were run (see _filtered_query)
+        self.filter_plans = {"prefilter": 0, "postfilter": 0, "postfilter_fallback": 0}
+        self.vector_store_backend = VECTOR_STORE
+        
+        # Queries are embedded here (same model as the collection) so repeated queries skip the model
+        self.query_cache = QueryEmbeddingCache(
+            EMBEDDING_MODEL_ID,
+            path=os.path.join(chroma_db_path, QUERY_CACHE_FILE) if QUERY_CACHE_PERSIST else None
+        )
+        
+        # Rerank results are cached per index version; re-indexing invalidates them
+        self._manifest_mtime = None
+        self._index_version = 0
+        
+        # Near-duplicate queries reuse the final results of an earlier query
+        self.semantic_cache = SemanticQueryCache() if SEMANTIC_CACHE else None
+        self.semantic_cache_mode = SEMANTIC_CACHE_MODE
         
         # Configure LLM
         self.generation_config = {
@@ -27,27 +124,246 @@ class MangaRetrieval:
             "max_output_tokens": 4096,
         }
     
+    @property
+    def chroma_client(self):
+        """Persistent Chroma client, connected on first use."""
+        with self._init_lock:
+            if self._chroma_client is None:
+                import chromadb
+                self._chroma_client = chromadb.PersistentClient(path=self.chroma_db_path)
+            return self._chroma_client
+    
+    @property
+    def embedding_function(self):
+        """The collection's embedding function, loaded on first use."""
+        with self._init_lock:
+            if self._embedding_function is None:
+                from chromadb.utils import embedding_functions
+                self._embedding_function = embedding_functions.DefaultEmbeddingFunction()
+            return self._embedding_function
+    
+    @property
+    def rerank_cache(self):
+        """Rerank result cache (None when disabled), opened on first use."""
+        if not self._rerank_cache_enabled:
+            return None
+        with self._init_lock:
+            if self._rerank_cache is None:
+                self._rerank_cache = RerankCache(
+                    os.path.join(self.chroma_db_path, RERANK_CACHE_FILE),
+                    index_version=self.index_version()
+                )
+            return self._rerank_cache
+    
+    @rerank_cache.setter
+    def rerank_cache(self, cache):
+        """Replace the rerank cache, or disable it with None."""
+        self._rerank_cache = cache
+        self._rerank_cache_enabled = cache is not None
+    
+    @property
+    def collection_state(self) -> CollectionState:
+        """Collection handle and counts, refreshed on reload() or when the index version changes."""
+        with self._init_lock:
+            if self._collection_state is None:
+                self._collection_state = CollectionState(self.chroma_client)
+            return self._collection_state
+    
+    @property
+    def collection(self):
+        return self.current_collection_state().collection
+    
+    def embed_query(self, query: str) -> List[float]:
+        """Return the embedding of a query, from the query cache when possible."""
+        return self.embed_queries([query])[0]
+    
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Embed several queries, sending only the ones missing from the query cache to the model in one batch."""
+        embeddings = [self.query_cache.get(query) for query in queries]
+        missing = list(dict.fromkeys(q for q, e in zip(queries, embeddings) if e is None))
+        if missing:
+            new_embeddings = dict(zip(missing, self.embedding_function(missing)))
+            for query, embedding in new_embeddings.items():
+                self.query_cache.put(query, embedding)
+            embeddings = [e if e is not None else new_embeddings[q] for q, e in zip(queries, embeddings)]
+        return [[float(x) for x in e] for e in embeddings]
+    
+    def index_version(self) -> int:
+        """Version of the index from the vectorize manifest, re-read only when the manifest changes."""
+        manifest_file = os.path.join(self.chroma_db_path, MANIFEST_FILE)
+        try:
+            mtime = os.path.getmtime(manifest_file)
+        except OSError:
+            return self._index_version
+        if mtime != self._manifest_mtime:
+            manifest = load_index_manifest(self.chroma_db_path)
+            self._index_version = manifest["version"] if manifest else 0
+            self._manifest_mtime = mtime
+        return self._index_version
+    
+    def reload(self):
+        """Re-read the collection handle and its counts, e.g. after re-indexing without a manifest."""
+        self.collection_state.refresh(self.index_version())
+    
+    def current_collection_state(self) -> CollectionState:
+        """The cached collection state, reloaded first if the index version changed."""
+        if self.collection_state.index_version != self.index_version():
+            self.reload()
+        return self.collection_state
+    
+    def current_vector_store(self):
+        """
+        The vector index to search: the shard collections of a sharded index, the Chroma
+        collection, or with VECTOR_STORE=numpy the exported NumPy store (reloaded when the
+        index version changes).
+        """
+        from vector_store import (ChromaVectorStore, NumpyVectorStore, ShardedVectorStore, NUMPY_STORE_DIR,
+                                  read_shard_count)
+        with self._init_lock:
+            index_version = self.index_version()
+            if self._sharded_store_loaded_for != index_version:
+                # New shard workers per index version, so they open the re-indexed shards
+                if self._sharded_store is not None:
+                    self._sharded_store.close()
+                num_shards = read_shard_count(self.chroma_db_path)
+                self._sharded_store = ShardedVectorStore(self.chroma_db_path, num_shards) if num_shards > 1 else None
+                self._sharded_store_loaded_for = index_version
+            if self._sharded_store is not None:
+                return self._sharded_store
+        if self.vector_store_backend == "numpy":
+            store_dir = os.path.join(self.chroma_db_path, NUMPY_STORE_DIR)
+            with self._init_lock:
+                index_version = self.index_version()
+                if self._numpy_store is None or self._numpy_store_loaded_for != index_version:
+                    try:
+                        self._numpy_store = NumpyVectorStore(store_dir)
+                        self._numpy_store_loaded_for = index_version
+                        if self._numpy_store.index_version != index_version:
+                            print(f"Warning: NumPy vector store is from index version {self._numpy_store.index_version}, "
+                                  f"the index is at version {index_version}; re-run vectorize.py to export it")
+                    except (OSError, ValueError, KeyError) as e:
+                        if self._numpy_store is None:
+                            print(f"Warning: Could not load NumPy vector store from {store_dir} ({e}), using Chroma")
+                            self.vector_store_backend = "chroma"
+                if self._numpy_store is not None:
+                    return self._numpy_store
+        return ChromaVectorStore(self.current_collection_state())
+    
+    def current_lexical_index(self):
+        """The BM25 index built by vectorize.py (reloaded when the index version changes), or None."""
+        if not self.lexical_search:
+            return None
+        from lexical_index import LexicalIndex, LEXICAL_INDEX_DIR
+        with self._init_lock:
+            index_version = self.index_version()
+            if self._lexical_index_loaded_for != index_version:
+                index_dir = os.path.join(self.chroma_db_path, LEXICAL_INDEX_DIR)
+                try:
+                    self._lexical_index = LexicalIndex(index_dir)
+                    if self._lexical_index.index_version != index_version:
+                        print(f"Warning: Lexical index is from index version {self._lexical_index.index_version}, "
+                              f"the index is at version {index_version}; re-run vectorize.py to rebuild it")
+                except (OSError, ValueError, KeyError) as e:
+                    if self._lexical_index is None:
+                        print(f"Warning: Could not load lexical index from {index_dir} ({e}), using vector search only")
+                self._lexical_index_loaded_for = index_version
+            return self._lexical_index
+    
+    def current_entity_index(self):
+        """The entity index built by vectorize.py (reloaded when the index version changes), or None."""
+        from entity_index import EntityIndex, ENTITY_INDEX_DIR
+        with self._init_lock:
+            index_version = self.index_version()
+            if self._entity_index_loaded_for != index_version:
+                index_dir = os.path.join(self.chroma_db_path, ENTITY_INDEX_DIR)
+                try:
+                    self._entity_index = EntityIndex(index_dir)
+                    if self._entity_index.index_version != index_version:
+                        print(f"Warning: Entity index is from index version {self._entity_index.index_version}, "
+                              f"the index is at version {index_version}; re-run vectorize.py to rebuild it")
+                except (OSError, ValueError, KeyError) as e:
+                    if self._entity_index is None:
+                        print(f"Warning: Could not load entity index from {index_dir} ({e})")
+                self._entity_index_loaded_for = index_version
+            return self._entity_index
+    
+    def entity_stats(self) -> Dict[str, Any]:
+        """Selectivity statistics of the entity index and how filtered searches were run."""
+        entity_index = self.current_entity_index()
+        return {"index": entity_index.stats() if entity_index is not None else None,
+                "plans": dict(self.filter_plans)}
+    
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Hit/miss counters of the retrieval caches."""
+        stats = {"query_embeddings": self.query_cache.stats()}
+        if self._rerank_cache is not None:
+            stats["rerank"] = self._rerank_cache.stats()
+        if self.semantic_cache is not None:
+            stats["semantic"] = self.semantic_cache.stats()
+        return stats
+    
     def clean_json_response(self, response_text):
         """Remove markdown code block formatting if present."""
-        if response_text.startswith('```'):
-            # Find the end of the opening markdown delimiter
-            first_newline = response_text.find('\n')
-            if first_newline > 0:
-                # Find the closing markdown delimiter
-                last_triple_backtick = response_text.rfind('```')
-                if last_triple_backtick > first_newline:
-                    # Extract just the JSON content
-                    response_text = response_text[first_newline+1:last_triple_backtick].strip()
-                else:
-                    # Only remove the opening delimiter if no closing one is found
-                    response_text = response_text[first_newline+1:].strip()
-        return response_text
+        return clean_json_response(response_text)
     
     def rerank_results(self, query: str, candidates: List[Dict[Any, Any]], n: int = 5) -> List[Dict[Any, Any]]:
         """Re-rank candidates using the LLM and provide explanations."""
         if not candidates:
             return []
         
+        cache_key = self._rerank_cache_key(query, candidates, n)
+        if cache_key is not None:
+            cached_results = self.rerank_cache.get(cache_key)
+            if cached_results is not None:
+                return self._attach_candidate_info(cached_results, candidates)
+        
+        prompt = self.build_rerank_prompt(query, candidates, n)
+        
+        try:
+            # Create a generative model instance
+            model_instance = get_genai().GenerativeModel(model_name=model)
+            
+            with metrics.track("rerank", prompt) as call:
+                # Generate reranking and explanations
+                call.mark_request_sent()
+                response = model_instance.generate_content(
+                    contents=prompt,
+                    generation_config=self.generation_config
+                )
+                call.add_usage(response)
+                
+                # Get response text
+                response_text = response.text
+                
+                try:
+                    ranked_results = self.parse_rerank_response(response_text, candidates, call)
+                except json.JSONDecodeError:
+                    call.parse_failures += 1
+                    raise
+            
+            # A truncated ranking is served once but not cached
+            if cache_key is not None and not call.truncated:
+                self.rerank_cache.put(cache_key, ranked_results)
+            return ranked_results
+        except json.JSONDecodeError as e:
+            print(f"JSON parsing error: {e}")
+            print(f"Cleaned response was: {self.clean_json_response(response_text)[:500]}...")
+            # Fallback to original ranking
+            return self._fallback_ranking(candidates, n)
+        except Exception as e:
+            print(f"Error during reranking: {e}")
+            # Fallback to original ranking if LLM fails
+            return self._fallback_ranking(candidates, n)
+    
+    def _rerank_cache_key(self, query, candidates, n):
+        """Key of a rerank in the rerank cache, or None when the cache is disabled."""
+        if self.rerank_cache is None:
+            return None
+        self.rerank_cache.set_index_version(self.index_version())
+        return rerank_cache_key(query, [c["id"] for c in candidates], n, f"{RERANK_PROMPT_VERSION}/{model}")
+    
+    def build_rerank_prompt(self, query: str, candidates: List[Dict[Any, Any]], n: int = 5) -> str:
+        """Build the LLM prompt that re-ranks and explains the candidates."""
         # Prepare candidate data with hierarchical information
         candidate_info = []
         for c in candidates:
@@ -114,52 +430,44 @@ Return a JSON object with the following structure:
 Only include the top {n} most relevant results in descending order of relevance.
 Return ONLY valid JSON, no additional text.
 """
+        return prompt
+    
+    def parse_rerank_response(self, response_text: str, candidates: List[Dict[Any, Any]], call=None) -> List[Dict[Any, Any]]:
+        """
+        Parse the LLM rerank response into ranked results.
+        call is the metrics record of the request; local repairs are counted on it.
+        Raises json.JSONDecodeError or KeyError if the response is unusable.
+        """
+        # Clean the response text
+        cleaned_response = self.clean_json_response(response_text)
         
-        try:
-            # Create a generative model instance
-            model_instance = genai.GenerativeModel(model_name=model)
-            
-            # Generate reranking and explanations
-            response = model_instance.generate_content(
-                contents=prompt,
-                generation_config=self.generation_config
-            )
-            
-            # Get response text
-            response_text = response.text
-            
-            # Clean the response text
-            cleaned_response = self.clean_json_response(response_text)
-            
-            # Parse as JSON
-            result_json = json.loads(cleaned_response.strip())
-            
-            # Verify the expected structure exists
-            if "ranked_results" not in result_json:
-                print("Warning: 'ranked_results' key not found in response.")
-                raise KeyError("ranked_results key not found in response")
-                
-            # Add image path and vector similarity back to results from original candidates
-            id_to_info = {c["id"]: {"image_path": c["metadata"].get("image_path", ""), 
-                                     "vector_similarity": c.get("similarity", None)} 
-                          for c in candidates}
-            
-            for result in result_json["ranked_results"]:
-                result_id = result["id"]
-                if result_id in id_to_info:
-                    result["image_path"] = id_to_info[result_id]["image_path"]
-                    result["vector_similarity"] = id_to_info[result_id]["vector_similarity"]
-            
-            return result_json["ranked_results"]
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {e}")
-            print(f"Cleaned response was: {cleaned_response[:500]}...")
-            # Fallback to original ranking
-            return self._fallback_ranking(candidates, n)
-        except Exception as e:
-            print(f"Error during reranking: {e}")
-            # Fallback to original ranking if LLM fails
-            return self._fallback_ranking(candidates, n)
+        # Parse as JSON, repairing truncated or wrapped responses locally
+        result_json, status = parse_json_with_status(cleaned_response)
+        if call is not None:
+            call.record_repair(status)
+        if status == TRUNCATED:
+            print("Warning: rerank response was truncated and repaired; the last results may be missing.")
+        
+        # Verify the expected structure exists
+        if "ranked_results" not in result_json:
+            print("Warning: 'ranked_results' key not found in response.")
+            raise KeyError("ranked_results key not found in response")
+        
+        return self._attach_candidate_info(result_json["ranked_results"], candidates)
+    
+    def _attach_candidate_info(self, ranked_results, candidates):
+        """Add image path and vector similarity back to results from original candidates"""
+        id_to_info = {c["id"]: {"image_path": c["metadata"].get("image_path", ""), 
+                                 "vector_similarity": c.get("similarity", None)} 
+                      for c in candidates}
+        
+        for result in ranked_results:
+            result_id = result["id"]
+            if result_id in id_to_info:
+                result["image_path"] = id_to_info[result_id]["image_path"]
+                result["vector_similarity"] = id_to_info[result_id]["vector_similarity"]
+        
+        return ranked_results
     
     def _fallback_ranking(self, candidates, n):
         """Create a fallback ranking when LLM reranking fails"""
@@ -169,7 +477,7 @@ Return ONLY valid JSON, no additional text.
             "title": c["metadata"].get("manga_title", "Unknown"),
             "identifier": self._create_identifier(c["metadata"]),
             "relevance_score": 100 - i*10,
-            "explanation": "Ranked by vector similarity.",
+            "explanation": FALLBACK_EXPLANATION,
             "match_type": "overall",
             "image_path": c["metadata"].get("image_path", ""),
             "vector_similarity": c.get("similarity", None)  # Include vector similarity
@@ -190,7 +498,8 @@ Return ONLY valid JSON, no additional text.
         
         return identifier
 
-    def search(self, query: str, n_results: int = 5, filter_level: str = None) -> List[Dict[Any, Any]]:
+    def search(self, query: str, n_results: int = 5, filter_level: str = None, characters=None,
+               location=None, emotion=None) -> List[Dict[Any, Any]]:
         """
         Search for manga based on a natural language query with LLM reranking.
         
@@ -198,22 +507,120 @@ Return ONLY valid JSON, no additional text.
             query: User's natural language description
             n_results: Number of top results to return
             filter_level: Optional filter for level (book, page, panel)
+            characters: Optional character name or names that must all appear
+            location: Optional location or locations, any of which must match
+            emotion: Optional emotion or emotions, any of which must match
             
         Returns:
             List of manga results with explanations
         """
-        # First-stage retrieval: Get candidates from vector DB
-        results = self.raw_search(query, n_results=n_results*2, filter_level=filter_level)
+        return self.search_many([query], n_results=n_results, filter_level=filter_level, characters=characters,
+                                location=location, emotion=emotion)[0]
+    
+    def search_many(self, queries: List[str], n_results: int = 5, filter_level: str = None,
+                    max_concurrent_reranks: int = RERANK_CONCURRENCY, characters=None, location=None,
+                    emotion=None) -> List[List[Dict[Any, Any]]]:
+        """
+        Search for several queries at once: one embedding batch, one multi-query vector
+        search and concurrent LLM reranks (at most max_concurrent_reranks at a time).
         
-        if not results:
+        Args:
+            queries: User's natural language descriptions
+            n_results: Number of top results to return per query
+            filter_level: Optional filter for level (book, page, panel)
+            max_concurrent_reranks: Maximum number of LLM rerank calls in flight
+            characters, location, emotion: Optional entity filters, as in search()
+            
+        Returns:
+            One list of manga results with explanations per query, in the order of queries
+        """
+        if not queries:
             return []
+        embeddings = self.embed_queries(queries)
+        index_version = self.index_version()
+        cache_filter = self._semantic_cache_filter(filter_level, characters, location, emotion)
+        ranked = [None] * len(queries)
         
-        # Second-stage re-ranking: Use LLM to rerank and explain
-        ranked_results = self.rerank_results(query, results, n=n_results)
+        # Queries close enough to an earlier one are answered from the semantic cache
+        cached_entries = {}
+        to_search = []
+        for i, (query, embedding) in enumerate(zip(queries, embeddings)):
+            if self.semantic_cache is not None:
+                hit = self.semantic_cache.lookup(embedding, n_results, cache_filter, index_version)
+                if hit is not None:
+                    entry, similarity = hit
+                    print(f"Semantic cache hit (similarity {similarity:.4f}) for cached query: {entry['query']}")
+                    if self.semantic_cache_mode != "rerank_new":
+                        ranked[i] = entry["results"]
+                        continue
+                    cached_entries[i] = entry
+            to_search.append(i)
+        if not to_search:
+            return ranked
         
-        return ranked_results
+        # First-stage retrieval: Get candidates from vector DB for all remaining queries at once
+        candidate_lists = self.raw_search_many(
+            [queries[i] for i in to_search], n_results=n_results*2, filter_level=filter_level,
+            query_embeddings=[embeddings[i] for i in to_search], characters=characters, location=location,
+            emotion=emotion
+        )
+        
+        # Second-stage re-ranking: Use LLM to rerank and explain, several queries in parallel
+        def rerank_one(i, candidates):
+            if not candidates:
+                return []
+            if i in cached_entries:
+                return self._rerank_new_candidates(queries[i], cached_entries[i], candidates, n_results)
+            ranked_results = self.rerank_results(queries[i], candidates, n=n_results)
+            if self.semantic_cache is not None and not self._is_fallback(ranked_results):
+                self.semantic_cache.store(queries[i], embeddings[i], n_results, cache_filter, index_version,
+                                          ranked_results, [c["id"] for c in candidates])
+            return ranked_results
+        
+        if len(to_search) == 1 or max_concurrent_reranks <= 1:
+            for i, candidates in zip(to_search, candidate_lists):
+                ranked[i] = rerank_one(i, candidates)
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_concurrent_reranks, len(to_search))) as executor:
+                futures = {i: executor.submit(rerank_one, i, candidates) for i, candidates in zip(to_search, candidate_lists)}
+                for i, future in futures.items():
+                    ranked[i] = future.result()
+        return ranked
+    
+    def _semantic_cache_filter(self, filter_level, characters=None, location=None, emotion=None):
+        """Semantic cache entries are only shared between searches with the same filters."""
+        from entity_index import entity_filters
+        filters = entity_filters(characters, location, emotion)
+        return (filter_level, tuple(sorted(filters.items()))) if filters else filter_level
+    
+    def _is_fallback(self, ranked_results):
+        """Fallback rankings are not worth caching: the next query should try the LLM again."""
+        return all(r.get("explanation") == FALLBACK_EXPLANATION for r in ranked_results)
+    
+    def _rerank_new_candidates(self, query, entry, candidates, n_results):
+        """
+        Reuse the cached ranking of a similar query and send only candidates it did not
+        already see to the LLM, then merge both lists by relevance score.
+        """
+        new_candidates = self._unseen_candidates(entry, candidates)
+        if not new_candidates:
+            return entry["results"]
+        
+        new_results = self.rerank_results(query, new_candidates, n=n_results)
+        return self._merge_with_cached(entry, new_results, n_results)
+    
+    def _unseen_candidates(self, entry, candidates):
+        seen_ids = set(entry["candidate_ids"])
+        return [c for c in candidates if c["id"] not in seen_ids]
+    
+    def _merge_with_cached(self, entry, new_results, n_results):
+        if self._is_fallback(new_results):
+            return entry["results"]
+        merged = sorted(entry["results"] + new_results, key=lambda r: r.get("relevance_score", 0), reverse=True)
+        return merged[:n_results]
       
-    def raw_search(self, query: str, n_results: int = 5, filter_level: str = None):
+    def raw_search(self, query: str, n_results: int = 5, filter_level: str = None, characters=None,
+                   location=None, emotion=None):
         """
         Perform a direct vector search without LLM reranking.
         Return raw results with similarity scores.
@@ -222,69 +629,184 @@ Return ONLY valid JSON, no additional text.
             query: User's natural language description
             n_results: Number of top results to return
             filter_level: Optional filter for level (book, page, panel)
+            characters, location, emotion: Optional entity filters, as in search()
+        """
+        return self.raw_search_many([query], n_results=n_results, filter_level=filter_level, characters=characters,
+                                    location=location, emotion=emotion)[0]
+    
+    def raw_search_many(self, queries: List[str], n_results: int = 5, filter_level: str = None,
+                        query_embeddings: List[List[float]] = None, characters=None, location=None, emotion=None):
         """
+        Vector search for several queries with a single collection query, fused with BM25
+        results when the lexical index is available.
+        
+        Args:
+            queries: User's natural language descriptions
+            n_results: Number of top results to return per query
+            filter_level: Optional filter for level (book, page, panel)
+            query_embeddings: Embeddings of the queries, if already computed
+            characters, location, emotion: Optional entity filters, as in search()
+            
+        Returns:
+            One list of raw results with similarity scores per query, in the order of queries
+        """
+        if not queries:
+            return []
+        from entity_index import entity_filters
         try:
             # Check if the collection exists
-            collection_names = [c.name for c in self.chroma_client.list_collections()]
+            state = self.current_vector_store()
             
-            if "manga_collection" not in collection_names:
+            if not state.exists:
                 print("Error: manga_collection does not exist in the database")
-                return []
+                return [[] for _ in queries]
             
-            if self.collection.count() == 0:
+            if state.count == 0:
                 print("Warning: Collection is empty")
-                return []
+                return [[] for _ in queries]
+            
+            # Prepare filter if needed; fall back to all levels if the level has no documents
+            available = state.count
+            if filter_level and state.level_counts.get(filter_level, 0) == 0:
+                print(f"Warning: No {filter_level}-level documents, searching all levels")
+                filter_level = None
+            elif filter_level:
+                available = state.level_counts[filter_level]
             
-            # Prepare filter if needed
-            where_filter = {"level": filter_level} if filter_level else None
+            # Documents allowed by the entity filters, None when unfiltered
+            allowed_ids = None
+            filters = entity_filters(characters, location, emotion)
+            if filters:
+                entity_index = self.current_entity_index()
+                if entity_index is None:
+                    print("Warning: No entity index, ignoring the entity filters")
+                else:
+                    allowed_ids = set(entity_index.match(filters, level=filter_level))
+                    if not allowed_ids:
+                        print("No documents match the entity filters")
+                        return [[] for _ in queries]
             
             # Query the collection
-            results = self.collection.query(
-                query_texts=[query],
-                n_results=min(n_results, self.collection.count()),
-                where=where_filter,
-                include=["metadatas", "documents", "distances"]
-            )
+            query_embeddings = query_embeddings or self.embed_queries(queries)
+            if allowed_ids is None:
+                results = state.query(query_embeddings, n_results=min(n_results, available), level=filter_level)
+            else:
+                results = self._filtered_query(state, query_embeddings, n_results, filter_level, available, allowed_ids)
             
             # Check if results contain data
-            if not results or "ids" not in results or not results["ids"] or not results["ids"][0]:
+            if not results or "ids" not in results or not results["ids"]:
                 print("Query returned no results")
-                return []
+                return [[] for _ in queries]
             
-            # Process results
-            candidates = []
-            for i in range(len(results["ids"][0])):
-                try:
-                    manga_id = results["ids"][0][i]
-                    metadata = results["metadatas"][0][i] if "metadatas" in results and results["metadatas"] and i < len(results["metadatas"][0]) else {}
-                    distance = results["distances"][0][i] if "distances" in results and results["distances"] and i < len(results["distances"][0]) else None
-                    document = results["documents"][0][i] if "documents" in results and results["documents"] and i < len(results["documents"][0]) else None
-                    
-                    # Calculate cosine similarity from distance
-                    similarity = 1 - distance if distance is not None else None
-                    
-                    candidates.append({
-                        "id": manga_id,
-                        "metadata": metadata,
-                        "content": document,
-                        "similarity": similarity,
-                        "distance": distance
-                    })
-                except IndexError as e:
-                    print(f"Index error at position {i}: {e}")
-            
-            return candidates
+            candidate_lists = [self._candidates_from_results(results, q) for q in range(len(queries))]
+            lexical_index = self.current_lexical_index()
+            if lexical_index is not None:
+                candidate_lists = self._fuse_lexical(state, candidate_lists,
+                                                     lexical_index.search(queries, n_results, level=filter_level,
+                                                                          ids=allowed_ids),
+                                                     n_results)
+            return candidate_lists
         except Exception as e:
             print(f"Error retrieving candidates: {e}")
             import traceback
             traceback.print_exc()
+            return [[] for _ in queries]
+    
+    def _filtered_query(self, state, query_embeddings, n_results, filter_level, available, allowed_ids):
+        """
+        Vector search restricted to allowed_ids, planned by selectivity: a rare filter value
+        restricts the search to its documents up front (pre-filtering); a common one is cheaper
+        as an ordinary search for more results that are filtered afterwards (post-filtering),
+        redone as pre-filtering if too few results survive.
+        """
+        from entity_index import PREFILTER_MAX_SELECTIVITY, POSTFILTER_OVERFETCH
+        selectivity = len(allowed_ids) / max(available, 1)
+        if selectivity > PREFILTER_MAX_SELECTIVITY:
+            k = min(available, math.ceil(n_results / selectivity * POSTFILTER_OVERFETCH))
+            results = state.query(query_embeddings, n_results=k, level=filter_level)
+            filtered = {"ids": [], "metadatas": [], "documents": [], "distances": []}
+            complete = True
+            for q in range(len(results["ids"])):
+                keep = [i for i, doc_id in enumerate(results["ids"][q]) if doc_id in allowed_ids][:n_results]
+                for key in filtered:
+                    filtered[key].append([results[key][q][i] for i in keep])
+                complete = complete and len(keep) >= min(n_results, len(allowed_ids))
+            if complete:
+                print(f"Entity filters match {len(allowed_ids)} of {available} documents ({selectivity:.1%}), post-filtered")
+                self.filter_plans["postfilter"] += 1
+                return filtered
+            self.filter_plans["postfilter_fallback"] += 1
+        else:
+            self.filter_plans["prefilter"] += 1
+        print(f"Entity filters match {len(allowed_ids)} of {available} documents ({selectivity:.1%}), pre-filtered")
+        return state.query(query_embeddings, n_results=min(n_results, len(allowed_ids)), level=filter_level,
+                           ids=sorted(allowed_ids))
+    
+    def _fuse_lexical(self, state, candidate_lists, lexical_hits, n_results):
+        """
+        Reciprocal-rank fusion of the vector candidates with the BM25 hits of each query.
+        Documents found only by BM25 are fetched from the vector store and have no similarity.
+        """
+        from lexical_index import RRF_K
+        seen = {c["id"] for candidates in candidate_lists for c in candidates}
+        missing = sorted({doc_id for hits in lexical_hits for doc_id, _ in hits} - seen)
+        fetched = {}
+        if missing:
+            records = state.get(missing)
+            for doc_id, metadata, document in zip(records["ids"], records["metadatas"], records["documents"]):
+                fetched[doc_id] = {"id": doc_id, "metadata": metadata or {}, "content": document,
+                                   "similarity": None, "distance": None}
+        
+        fused = []
+        for candidates, hits in zip(candidate_lists, lexical_hits):
+            by_id = {c["id"]: c for c in candidates}
+            scores = {c["id"]: 1.0 / (RRF_K + rank + 1) for rank, c in enumerate(candidates)}
+            for rank, (doc_id, lexical_score) in enumerate(hits):
+                candidate = by_id.get(doc_id) or fetched.get(doc_id)
+                if candidate is None:
+                    continue  # lexical index is older than the vector index
+                by_id[doc_id] = dict(candidate, lexical_score=lexical_score)
+                scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+            fused.append([by_id[doc_id] for doc_id in sorted(scores, key=scores.get, reverse=True)[:n_results]])
+        return fused
+    
+    def _candidates_from_results(self, results, q):
+        """Turn the results of query number q of a collection query into candidate dicts."""
+        if q >= len(results["ids"]) or not results["ids"][q]:
+            print("Query returned no results")
             return []
+        
+        # Process results
+        candidates = []
+        for i in range(len(results["ids"][q])):
+            try:
+                manga_id = results["ids"][q][i]
+                metadata = results["metadatas"][q][i] if "metadatas" in results and results["metadatas"] and i < len(results["metadatas"][q]) else {}
+                distance = results["distances"][q][i] if "distances" in results and results["distances"] and i < len(results["distances"][q]) else None
+                document = results["documents"][q][i] if "documents" in results and results["documents"] and i < len(results["documents"][q]) else None
+                
+                # Calculate cosine similarity from distance
+                similarity = 1 - distance if distance is not None else None
+                
+                candidates.append({
+                    "id": manga_id,
+                    "metadata": metadata,
+                    "content": document,
+                    "similarity": similarity,
+                    "distance": distance
+                })
+            except IndexError as e:
+                print(f"Index error at position {i}: {e}")
+        
+        return candidates
 
 def main():
-    """Main function to test manga retrieval system."""
-    print("Initializing manga retrieval system...")
-    retriever = MangaRetrieval()
+    """
+    Main function to test manga retrieval system.
     
+    Searches go to the query daemon (python query_daemon.py) when it is running, which
+    keeps the models loaded; otherwise the retrieval system is loaded in this process.
+    """
     print("\n===== Manga Retrieval System =====")
     print("\nEnter a description of what you're looking for:")
     user_query = input("> ") or "shaaake"
@@ -307,7 +829,16 @@ def main():
             filter_level = "panel"
         
         print("\nSearching for matching manga...")
-        ranked_results = retriever.search(user_query, filter_level=filter_level)
+        from query_daemon import daemon_search
+        try:
+            ranked_results = daemon_search(user_query, filter_level=filter_level)
+        except RuntimeError as e:
+            print(f"Search failed: {e}")
+            return
+        if ranked_results is None:
+            print("Query daemon not running, initializing manga retrieval system...")
+            retriever = MangaRetrieval()
+            ranked_results = retriever.search(user_query, filter_level=filter_level)
         
         if ranked_results:
             print("\n===== Search Results =====\n")
@@ -0,0 +1,182 @@
+import os
+import json
+import copy
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# 查询向量缓存：最多保留的查询数，以及是否持久化到 Chroma 目录下的文件
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_PERSIST = os.getenv("QUERY_CACHE_PERSIST", "1") == "1"
+QUERY_CACHE_FILE = "query_embeddings.jsonl"
+
+# 语义缓存（默认关闭，会返回其他查询的结果）：余弦相似度不低于阈值的查询直接复用结果；mode 为 "rerank_new" 时只对新候选重排序
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+SEMANTIC_CACHE_MODE = os.getenv("SEMANTIC_CACHE_MODE", "reuse")
+
+
+class QueryEmbeddingCache:
+    """
+    LRU cache of query embeddings keyed by (embedding model id, query text).
+
+    With a path, every newly embedded query is appended to a JSONL file and the most
+    recent max_entries queries are loaded again on start-up. The file is rewritten
+    without evicted entries once it holds twice as many lines as the cache.
+    """
+
+    def __init__(self, model_id, max_entries=QUERY_CACHE_SIZE, path=None):
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()  # query -> embedding (list of floats)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._file_lines = 0
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                self._file_lines += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # tolerate a torn last line after a crash
+                if entry.get("model_id") != self.model_id:
+                    continue
+                self.entries[entry["query"]] = entry["embedding"]
+                self.entries.move_to_end(entry["query"])
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+    def get(self, query):
+        """Return the cached embedding of a query, or None on a miss."""
+        with self.lock:
+            embedding = self.entries.get(query)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(query)
+            self.hits += 1
+            return embedding
+
+    def put(self, query, embedding):
+        embedding = [float(x) for x in embedding]
+        with self.lock:
+            self.entries[query] = embedding
+            self.entries.move_to_end(query)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.path:
+                self._persist(query, embedding)
+
+    def _persist(self, query, embedding):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if self._file_lines >= 2 * self.max_entries:
+            # Compact: keep only the entries still in the cache, least recently used first
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for cached_query, cached_embedding in self.entries.items():
+                    f.write(json.dumps({"model_id": self.model_id, "query": cached_query,
+                                        "embedding": cached_embedding}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+            self._file_lines = len(self.entries)
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"model_id": self.model_id, "query": query, "embedding": embedding},
+                               ensure_ascii=False) + "\n")
+        self._file_lines += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class SemanticQueryCache:
+    """
+    Final ranked results of past queries, reused for new queries whose embedding is within
+    a cosine-similarity threshold of a cached one.
+
+    Entries are grouped by (n_results, filter_level, index version); entries of an older
+    index version are dropped on the next lookup.
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_SIZE):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.groups = {}  # (n_results, filter_level, index_version) -> OrderedDict query -> entry
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Running statistics of hit similarities; a long-running daemon must not keep one value per hit
+        self.hit_similarity_sum = 0.0
+        self.min_similarity = None
+        self.last_similarity = None
+
+    @staticmethod
+    def _unit(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding, n_results, filter_level, index_version):
+        """
+        Returns:
+            (entry, similarity) of the most similar cached query above the threshold, or None.
+            entry is a dict with "query", "results" and "candidate_ids".
+        """
+        vector = self._unit(embedding)
+        with self.lock:
+            for key in [k for k in self.groups if k[2] != index_version]:
+                del self.groups[key]
+            group = self.groups.get((n_results, filter_level, index_version))
+            best, best_similarity = None, None
+            if group:
+                entries = list(group.values())
+                similarities = np.stack([entry["embedding"] for entry in entries]) @ vector
+                i = int(np.argmax(similarities))
+                if similarities[i] >= self.threshold:
+                    best, best_similarity = entries[i], float(similarities[i])
+                    group.move_to_end(best["query"])
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.hit_similarity_sum += best_similarity
+            self.min_similarity = best_similarity if self.min_similarity is None else min(self.min_similarity, best_similarity)
+            self.last_similarity = best_similarity
+            return copy.deepcopy(best), best_similarity
+
+    def store(self, query, embedding, n_results, filter_level, index_version, results, candidate_ids):
+        with self.lock:
+            group = self.groups.setdefault((n_results, filter_level, index_version), OrderedDict())
+            group[query] = {
+                "query": query,
+                "embedding": self._unit(embedding),
+                "results": copy.deepcopy(results),
+                "candidate_ids": list(candidate_ids),
+            }
+            group.move_to_end(query)
+            if len(group) > self.max_entries:
+                group.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": sum(len(group) for group in self.groups.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "avg_hit_similarity": self.hit_similarity_sum / self.hits if self.hits else None,
+            "min_hit_similarity": self.min_similarity,
+            "last_hit_similarity": self.last_similarity,
+        }
@@ -0,0 +1,185 @@
+import os
+import json
+import queue
+import socket
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 常驻查询服务：监听地址、微批等待时间（秒）、单批最大查询数、并发批次数
+QUERY_DAEMON_HOST = os.getenv("QUERY_DAEMON_HOST", "127.0.0.1")
+QUERY_DAEMON_PORT = int(os.getenv("QUERY_DAEMON_PORT", "8765"))
+QUERY_DAEMON_BATCH_WAIT = float(os.getenv("QUERY_DAEMON_BATCH_WAIT", "0.01"))
+QUERY_DAEMON_MAX_BATCH = int(os.getenv("QUERY_DAEMON_MAX_BATCH", "32"))
+QUERY_DAEMON_WORKERS = int(os.getenv("QUERY_DAEMON_WORKERS", "4"))
+# Searches include an LLM rerank, so the client waits a while before giving up
+QUERY_DAEMON_TIMEOUT = float(os.getenv("QUERY_DAEMON_TIMEOUT", "120"))
+
+
+class MicroBatcher:
+    """
+    Collects concurrent search requests for up to batch_wait seconds and runs each group
+    of requests with the same (n_results, filter_level, entity filters) as one search_many
+    call, so their queries share one embedding call and one collection query.
+    """
+
+    def __init__(self, retriever, batch_wait=QUERY_DAEMON_BATCH_WAIT, max_batch=QUERY_DAEMON_MAX_BATCH,
+                 workers=QUERY_DAEMON_WORKERS):
+        self.retriever = retriever
+        self.batch_wait = batch_wait
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        # Batches run on a pool so a slow LLM rerank does not hold up the next batch
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, query, n_results=5, filter_level=None, characters=None, location=None, emotion=None):
+        """Queue one search; returns a Future with its ranked results."""
+        from entity_index import entity_filters
+        future = Future()
+        filters = entity_filters(characters, location, emotion)
+        self.requests.put((query, n_results, filter_level, tuple(sorted(filters.items())), future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self.requests.get(timeout=self.batch_wait))
+            except queue.Empty:
+                pass
+
+            groups = {}
+            for query, n_results, filter_level, filters, future in batch:
+                groups.setdefault((n_results, filter_level, filters), []).append((query, future))
+            for (n_results, filter_level, filters), requests in groups.items():
+                self.executor.submit(self._search, requests, n_results, filter_level, dict(filters))
+
+    def _search(self, requests, n_results, filter_level, filters):
+        try:
+            results = self.retriever.search_many([query for query, _ in requests],
+                                                 n_results=n_results, filter_level=filter_level,
+                                                 characters=filters.get("character"), location=filters.get("location"),
+                                                 emotion=filters.get("emotion"))
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        print(f"Served a batch of {len(requests)} queries")
+        for (_, future), ranked_results in zip(requests, results):
+            future.set_result(ranked_results)
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health  -> {"status": "ok"}
+    POST /search  {"query": str, "n_results": int, "filter_level": str|null,
+                   "characters": str|[str], "location": str|[str], "emotion": str|[str]} -> {"results": [...]}
+    """
+    batcher = None
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            query = request["query"]
+            n_results = int(request.get("n_results", 5))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+            return
+
+        future = self.batcher.submit(query, n_results, request.get("filter_level"),
+                                     request.get("characters"), request.get("location"), request.get("emotion"))
+        try:
+            results = future.result(timeout=QUERY_DAEMON_TIMEOUT)
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._send_json(200, {"results": results})
+
+    def log_message(self, format, *args):
+        pass  # the batcher already prints one line per batch
+
+
+def daemon_url(host=QUERY_DAEMON_HOST, port=QUERY_DAEMON_PORT):
+    return f"http://{host}:{port}"
+
+
+def daemon_search(query, n_results=5, filter_level=None, url=None, timeout=QUERY_DAEMON_TIMEOUT, characters=None,
+                  location=None, emotion=None):
+    """
+    Run a search on the query daemon; characters, location and emotion are entity filters
+    as in MangaRetrieval.search().
+    
+    Returns the ranked results, or None if no daemon is listening so the caller can search
+    locally. Raises RuntimeError if the daemon failed or did not answer in time: the search
+    ran (or is still running) there, and repeating it locally would pay for it twice.
+    """
+    url = url or daemon_url()
+    data = json.dumps({"query": query, "n_results": n_results, "filter_level": filter_level, "characters": characters,
+                       "location": location, "emotion": emotion}).encode("utf-8")
+    request = urllib.request.Request(f"{url}/search", data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())["results"]
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"Query daemon error: {e.read().decode('utf-8', 'replace')}") from e
+    except (TimeoutError, socket.timeout) as e:
+        raise RuntimeError(f"Query daemon did not answer within {timeout} s") from e
+    except (urllib.error.URLError, ConnectionError):
+        # Connection refused or dropped: no daemon is serving
+        return None
+
+
+def serve(chroma_db_path="./_chroma", host=QUERY_DAEMON_HOST, port=QUERY_DAEMON_PORT):
+    """Load the retrieval system once and serve searches until interrupted."""
+    from query import MangaRetrieval, get_genai
+
+    print("Initializing manga retrieval system...")
+    retriever = MangaRetrieval(chroma_db_path)
+    # Warm up everything a first search would otherwise load
+    retriever.embed_queries(["warm up"])
+    retriever.current_vector_store()
+    get_genai()
+
+    QueryRequestHandler.batcher = MicroBatcher(retriever)
+    server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+    print(f"Query daemon listening on {daemon_url(host, port)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Query daemon stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident manga search daemon")
+    parser.add_argument("--chroma-path", default="./_chroma")
+    parser.add_argument("--host", default=QUERY_DAEMON_HOST)
+    parser.add_argument("--port", type=int, default=QUERY_DAEMON_PORT)
+    args = parser.parse_args()
+    serve(args.chroma_path, args.host, args.port)
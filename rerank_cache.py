@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+# 重排序结果缓存：存活时间（秒）与最大条目数，超出后按最近使用时间淘汰
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", str(7 * 24 * 3600)))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "10000"))
+RERANK_CACHE = os.getenv("RERANK_CACHE", "1") == "1"
+RERANK_CACHE_FILE = "rerank_cache.sqlite3"
+
+
+def normalize_query(query):
+    """Case and whitespace differences should not cause a cache miss."""
+    return " ".join(query.lower().split())
+
+
+def rerank_cache_key(query, candidate_ids, n, prompt_version):
+    key = json.dumps([normalize_query(query), sorted(candidate_ids), n, prompt_version], ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class RerankCache:
+    """
+    SQLite cache of LLM rerank results.
+
+    Entries are keyed by normalized query, candidate id set, n and prompt version, and are
+    tagged with the index version of the collection they were computed against; entries of
+    any other index version are dropped, so re-indexing invalidates the cache.
+    """
+
+    def __init__(self, path, index_version=0, ttl=RERANK_CACHE_TTL, max_entries=RERANK_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rerank ("
+                " key TEXT PRIMARY KEY,"
+                " index_version INTEGER NOT NULL,"
+                " results TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS rerank_last_used ON rerank (last_used)")
+        self.index_version = None
+        self.set_index_version(index_version)
+
+    def set_index_version(self, index_version):
+        """Drop entries computed against a different version of the index."""
+        if index_version == self.index_version:
+            return
+        with self.lock, self.conn:
+            deleted = self.conn.execute("DELETE FROM rerank WHERE index_version != ?", (index_version,)).rowcount
+        if deleted:
+            print(f"Rerank cache: dropped {deleted} entries from an older index")
+        self.index_version = index_version
+
+    def get(self, key):
+        """Return cached results, or None on a miss or an expired entry."""
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT results, created_at FROM rerank WHERE key = ? AND index_version = ?",
+                (key, self.index_version),
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE rerank SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, results):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rerank (key, index_version, results, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, self.index_version, json.dumps(results, ensure_ascii=False), now, now),
+            )
+            self.conn.execute("DELETE FROM rerank WHERE created_at < ?", (now - self.ttl,))
+            excess = self.conn.execute("SELECT COUNT(*) FROM rerank").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    "DELETE FROM rerank WHERE key IN (SELECT key FROM rerank ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM rerank").fetchone()[0]
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,142 @@
+import os
+import re
+import sys
+import json
+import zlib
+import threading
+import numpy as np
+import pytest
+
+# The modules live at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EMBEDDING_DIM = 64
+BOOKS = 10
+
+
+class HashEmbedding:
+    """
+    Bag-of-words embedding: every word counts towards one of EMBEDDING_DIM dimensions.
+    A little noise seeded by the text keeps similar documents from being exactly as close
+    to a query, so results do not depend on how ties are broken.
+    """
+
+    def __call__(self, texts):
+        vectors = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                vectors[row, zlib.crc32(word.encode("utf-8")) % EMBEDDING_DIM] += 1.0
+            vectors[row] += np.random.default_rng(zlib.crc32(text.encode("utf-8"))).normal(0, 0.01, EMBEDDING_DIM)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.tolist()
+
+
+class HashEmbeddingEngine:
+    """Stands in for vectorize.EmbeddingEngine."""
+
+    def __init__(self, cache=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def embed(self, documents):
+        return HashEmbedding()(documents)
+
+
+class RerankLLM:
+    """
+    Stands in for the Gemini rerank model: keeps the candidates in the order of the prompt
+    and records every prompt it was sent.
+    """
+
+    def __init__(self):
+        self.prompts = []
+        self.lock = threading.Lock()
+
+    def GenerativeModel(self, model_name):
+        return self
+
+    def rank(self, prompt):
+        with self.lock:
+            self.prompts.append(prompt)
+        n = int(re.search(r"Only include the top (\d+)", prompt).group(1))
+        candidates = json.loads(prompt.split("Here are the candidate results:\n", 1)[1].split("\n\nFor each", 1)[0])
+        return json.dumps({"ranked_results": [
+            {"id": c["id"], "level": c["level"], "title": c["title"], "identifier": c["identifier"],
+             "relevance_score": 100 - i, "explanation": "Matches the query.", "match_type": "overall"}
+            for i, c in enumerate(candidates[:n])]})
+
+    def generate_content(self, contents, generation_config=None):
+        return type("Response", (), {"text": self.rank(contents), "usage_metadata": None})()
+
+
+def write_book(analyses_dir, book):
+    """
+    Four pages of two panels. Hina is in every first panel, Misaki only in one panel of
+    Book 3, and "shaaake" is written in one panel of Book 7.
+    """
+    title = f"Book {book}"
+    pages = []
+    for p in range(1, 5):
+        panels = []
+        for panel in (1, 2):
+            rare = (book, p, panel) == (3, 2, 2)
+            panels.append({
+                "panel_id": str(panel),
+                "summary": f"{title} scene {p} {'festival' if p % 2 else 'rain'}.",
+                "characters": [{"name": "Hina" if panel == 1 else ("Misaki" if rare else "Kokoro"),
+                                "expression": "smiling", "pose": "standing"}],
+                "setting": {"location": "classroom" if panel == 1 else "rooftop", "background_elements": []},
+                "narrative": {"actions": ["talks"], "dialogue": [f"line {book} {p} {panel}"],
+                              "emotion": "happy" if panel == 1 else "tense"},
+                "text_elements": ["shaaake"] if (book, p, panel) == (7, 4, 2) else [],
+            })
+        pages.append({"page_number": p, "image_path": f"./manga_images/{title}/{p}.png",
+                      "summary": f"Page {p} of {title}.", "panels": panels})
+    with open(os.path.join(analyses_dir, f"{title}_schema.json"), "w", encoding="utf-8") as f:
+        json.dump({"manga_name": title, "summary": f"The story of {title}.", "pages": pages}, f)
+    return f"{title}_schema.json"
+
+
+@pytest.fixture(scope="session")
+def manga_index(tmp_path_factory):
+    """Chroma path of a small indexed library with its lexical and entity indexes."""
+    import vectorize
+    root = tmp_path_factory.mktemp("library")
+    analyses_dir = str(root / "manga_analyses")
+    os.makedirs(analyses_dir)
+    files = sorted(write_book(analyses_dir, book) for book in range(BOOKS))
+    chroma_path = str(root / "chroma")
+    _, manifest, _, _ = vectorize.index_schema_files(chroma_path, analyses_dir, files, HashEmbeddingEngine())
+    vectorize.build_side_indexes(chroma_path, analyses_dir, files, manifest["version"])
+    return chroma_path
+
+
+@pytest.fixture
+def rerank_llm(monkeypatch):
+    import query
+    llm = RerankLLM()
+    monkeypatch.setattr(query, "get_genai", lambda: llm)
+    return llm
+
+
+def make_retriever(chroma_path):
+    """MangaRetrieval with the hash embedding and no persistent caches."""
+    from query import MangaRetrieval
+    from query_cache import QueryEmbeddingCache
+    retriever = MangaRetrieval(chroma_path)
+    retriever._embedding_function = HashEmbedding()
+    retriever.query_cache = QueryEmbeddingCache("hash")
+    retriever.rerank_cache = None
+    return retriever
+
+
+@pytest.fixture
+def retriever(manga_index, rerank_llm, monkeypatch):
+    from metrics import metrics
+    monkeypatch.setattr(metrics, "path", None)
+    return make_retriever(manga_index)
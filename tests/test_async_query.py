@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+from async_query import AsyncMangaRetrieval
+from query import FALLBACK_EXPLANATION
+
+
+class AsyncLLM:
+    """Async stand-in for Gemini, ranking like the rerank_llm fixture."""
+
+    def __init__(self, rerank_llm, delay=0.05, fail=False):
+        self.rerank_llm = rerank_llm
+        self.delay = delay
+        self.fail = fail
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled = 0
+
+    async def __call__(self, prompt, generation_config):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        if self.fail:
+            raise RuntimeError("503 Service Unavailable")
+        return self.rerank_llm.rank(prompt)
+
+
+def ids(results):
+    return [r["id"] for r in results]
+
+
+def test_concurrent_searches_match_sync_search(retriever, rerank_llm):
+    llm = AsyncLLM(rerank_llm, delay=0.2)
+    async_retriever = AsyncMangaRetrieval(retriever, llm=llm, max_concurrent_reranks=2)
+    queries = ["Book 3 festival", "Book 5 rain", "shaaake", "Hina in the classroom", "Page 2 of Book 4"]
+    try:
+        ranked = asyncio.run(async_retriever.search_many(queries, n_results=3, filter_level="panel"))
+    finally:
+        async_retriever.close()
+    assert llm.max_in_flight == 2
+    for query, results in zip(queries, ranked):
+        assert ids(results) == ids(retriever.search(query, n_results=3, filter_level="panel"))
+
+
+def test_timeout_cancels_the_llm_call(retriever, rerank_llm):
+    llm = AsyncLLM(rerank_llm, delay=5)
+    async_retriever = AsyncMangaRetrieval(retriever, llm=llm)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await async_retriever.search("Book 3 festival", timeout=0.5)
+        # search_many reports a timed-out search as its exception
+        return await async_retriever.search_many(["Book 3 festival", "Book 5 rain"], timeout=0.5)
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        async_retriever.close()
+    assert all(isinstance(r, asyncio.TimeoutError) for r in results)
+    assert llm.cancelled == 3 and llm.in_flight == 0
+
+
+def test_llm_failure_falls_back_to_vector_order(retriever, rerank_llm):
+    async_retriever = AsyncMangaRetrieval(retriever, llm=AsyncLLM(rerank_llm, delay=0, fail=True))
+    try:
+        results = asyncio.run(async_retriever.search("Book 3 festival", n_results=3))
+    finally:
+        async_retriever.close()
+    assert ids(results) == ids(retriever.raw_search("Book 3 festival", n_results=6))[:3]
+    assert all(r["explanation"] == FALLBACK_EXPLANATION for r in results)
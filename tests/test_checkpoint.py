@@ -0,0 +1,36 @@
+from checkpoint import CheckpointStore, safe_filename
+
+
+def test_safe_filename():
+    assert safe_filename("Bang Dream! Vol. 1/2") == "Bang Dream Vol 12"
+
+
+def test_pages_resume_only_for_the_same_image(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    page = {"page_number": 1, "summary": "A page."}
+    assert store.load_page("Alpha", 0, "a/1.png") is None
+    store.save_page("Alpha", 0, "a/1.png", page)
+    assert store.load_page("Alpha", 0, "a/1.png") == page
+    # Renamed or reordered images are analysed again
+    assert store.load_page("Alpha", 0, "a/2.png") is None
+    assert store.load_page("Alpha", 1, "a/1.png") is None
+    assert store.load_page("Beta", 0, "a/1.png") is None
+
+
+def test_unreadable_checkpoint_is_ignored(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    store.save_page("Alpha", 0, "a/1.png", {"page_number": 1})
+    (tmp_path / "checkpoints" / "Alpha" / "page_0001.json").write_text('{"image_path": "a/1.png", "page_ob')
+    assert store.load_page("Alpha", 0, "a/1.png") is None
+    assert not list((tmp_path / "checkpoints").rglob("*.tmp"))
+
+
+def test_book_is_complete_while_its_schema_file_exists(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    schema_file = tmp_path / "Alpha_schema.json"
+    assert not store.is_book_complete("Alpha")
+    schema_file.write_text("{}")
+    store.mark_book_complete("Alpha", str(schema_file), 8)
+    assert store.is_book_complete("Alpha")
+    schema_file.unlink()
+    assert not store.is_book_complete("Alpha")
@@ -0,0 +1,66 @@
+import json
+import numpy as np
+import pytest
+import onnxruntime
+from tokenizers import Tokenizer, models, pre_tokenizers
+from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+import vectorize
+
+DOCUMENTS = [
+    "Shaaake!",
+    "Vivio runs across the rooftop at sunset, shouting to her friends below.",
+    "a",
+    "Two girls share a scarf on a snowy street while the shop lights flicker behind them.",
+    "Misaki hands over a small wrapped present.",
+    "Page 3, Panel 2. " * 20,
+    "Rain.",
+]
+
+WORDS = sorted({w for d in DOCUMENTS for w in d.lower().replace(",", " ").replace(".", " ").replace("!", " ").split()})
+
+
+class FakeSession:
+    """Stands in for the ONNX model: position-dependent hidden states from a fixed embedding table."""
+
+    def __init__(self, path, providers=None, sess_options=None):
+        self.table = np.random.default_rng(0).normal(size=(len(WORDS) + 2, 8)).astype(np.float32)
+
+    def run(self, output_names, inputs):
+        ids = inputs["input_ids"]
+        positions = 1.0 + 0.01 * np.arange(ids.shape[1], dtype=np.float32)
+        return [self.table[ids] * positions[None, :, None]]
+
+
+@pytest.fixture
+def fake_model(tmp_path, monkeypatch):
+    """A model directory in chromadb's layout with a word-level tokenizer and a fake ONNX session."""
+    model_dir = tmp_path / ONNXMiniLM_L6_V2.EXTRACTED_FOLDER_NAME
+    model_dir.mkdir()
+    vocab = {"[PAD]": 0, "[UNK]": 1, **{w: i + 2 for i, w in enumerate(WORDS)}}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.save(str(model_dir / "tokenizer.json"))
+    for name in ["config.json", "special_tokens_map.json", "tokenizer_config.json", "vocab.txt", "model.onnx"]:
+        (model_dir / name).write_text(json.dumps({}))
+    monkeypatch.setattr(ONNXMiniLM_L6_V2, "DOWNLOAD_PATH", tmp_path)
+    monkeypatch.setattr(onnxruntime, "InferenceSession", FakeSession)
+
+
+def test_bucketed_embeddings_match_default_embedding_function(fake_model):
+    expected = np.asarray(DefaultEmbeddingFunction()(DOCUMENTS), dtype=np.float32)
+    with vectorize.EmbeddingEngine(batch_size=3, workers=1) as engine:
+        embeddings = engine.embed(DOCUMENTS)
+    assert embeddings.shape == expected.shape
+    np.testing.assert_allclose(embeddings, expected, atol=1e-5)
+
+
+def test_bucketed_embeddings_match_default_embedding_function_real_model():
+    try:
+        vectorize.embedding_model_dir()
+    except Exception as e:
+        pytest.skip(f"all-MiniLM-L6-v2 is not available: {e}")
+    expected = np.asarray(DefaultEmbeddingFunction()(DOCUMENTS), dtype=np.float32)
+    with vectorize.EmbeddingEngine(batch_size=3, workers=1) as engine:
+        embeddings = engine.embed(DOCUMENTS)
+    np.testing.assert_allclose(embeddings, expected, atol=1e-5)
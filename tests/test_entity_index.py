@@ -0,0 +1,61 @@
+from entity_index import EntityIndex, EntityIndexWriter, entity_filters, normalize_entity
+
+DOCS = [
+    ("b_book", "book", {"character": ["Hina", "Misaki Okusawa"], "location": ["School classroom"], "emotion": ["happy"]}),
+    ("b_page_1", "page", {"character": ["Hina"], "location": ["school classroom"], "emotion": ["Happy"]}),
+    ("b_page_1_panel_1", "panel", {"character": ["Hina"], "location": ["classroom"], "emotion": []}),
+    ("b_page_1_panel_2", "panel", {"character": ["Misaki Okusawa", "Hina"], "location": ["street"], "emotion": ["tense"]}),
+    ("c_page_1_panel_1", "panel", {"character": ["Ina"], "location": ["Street corner"], "emotion": ["sad"]}),
+]
+
+
+def write_index(path, flush_every=None, index_version=1):
+    writer = EntityIndexWriter(str(path), index_version=index_version)
+    for n, doc in enumerate(DOCS, 1):
+        writer.add(*doc)
+        if flush_every and n % flush_every == 0:
+            writer.flush()
+    writer.close()
+    return EntityIndex(str(path))
+
+
+def test_filters_are_normalized():
+    assert normalize_entity("  Misaki, Okusawa! ") == "misaki okusawa"
+    assert entity_filters(characters="Hina", location=["Street", ""], emotion=None) == {
+        "character": ("hina",), "location": ("street",)}
+
+
+def test_whole_word_matching(tmp_path):
+    index = write_index(tmp_path / "entities")
+    assert index.match({"character": ("ina",)}) == ["c_page_1_panel_1"]
+    assert index.match({"character": ("hina",)}) == ["b_book", "b_page_1", "b_page_1_panel_1", "b_page_1_panel_2"]
+    assert index.match({"character": ("misaki",)}) == ["b_book", "b_page_1_panel_2"]
+    assert index.match({"location": ("classroom",)}) == ["b_book", "b_page_1", "b_page_1_panel_1"]
+    assert index.match({"location": ("class",)}) == []
+
+
+def test_fields_and_levels_combine(tmp_path):
+    index = write_index(tmp_path / "entities")
+    # All characters must appear; any of several locations is enough
+    assert index.match({"character": ("hina", "misaki")}, level="panel") == ["b_page_1_panel_2"]
+    assert index.match({"location": ("classroom", "street")}, level="panel") == [
+        "b_page_1_panel_1", "b_page_1_panel_2", "c_page_1_panel_1"]
+    assert index.match({"character": ("hina",), "emotion": ("happy",)}) == ["b_book", "b_page_1"]
+
+
+def test_segments_are_joined(tmp_path):
+    single = write_index(tmp_path / "single")
+    segmented = write_index(tmp_path / "segmented", flush_every=2)
+    assert segmented.meta["segments"] == 3
+    for filters in [{"character": ("hina",)}, {"location": ("street",)}, {"emotion": ("sad", "tense")}]:
+        for level in (None, "panel"):
+            assert segmented.match(filters, level) == single.match(filters, level)
+    assert segmented.stats() == single.stats()
+    assert segmented.stats()["character"]["top_values"][0] == {"value": "hina", "documents": 4, "selectivity": 0.8}
+
+
+def test_stored_index_version(tmp_path):
+    path = tmp_path / "entities"
+    assert EntityIndex.stored_index_version(str(path)) is None
+    write_index(path, index_version=7)
+    assert EntityIndex.stored_index_version(str(path)) == 7
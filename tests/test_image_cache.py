@@ -0,0 +1,57 @@
+import threading
+import numpy as np
+from PIL import Image
+import image_cache
+from image_cache import normalize_image, normalize_images
+
+
+def save_page(path, size=(1200, 1800), seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 256, size=(size[1] // 100, size[0] // 100, 3), dtype=np.uint8)
+    Image.fromarray(pixels).resize(size, Image.BILINEAR).save(path)
+    return str(path)
+
+
+def test_normalize_downscales_and_caches(tmp_path):
+    page = save_page(tmp_path / "page.png")
+    cached = normalize_image(page, cache_dir=str(tmp_path / "cache"), max_side=600, quality=80)
+    with Image.open(cached) as img:
+        assert img.format == "WEBP"
+        assert img.size == (400, 600)
+    mtime = (tmp_path / cached).stat().st_mtime_ns
+    assert normalize_image(page, cache_dir=str(tmp_path / "cache"), max_side=600, quality=80) == cached
+    assert (tmp_path / cached).stat().st_mtime_ns == mtime
+    # Other settings get their own entry
+    assert normalize_image(page, cache_dir=str(tmp_path / "cache"), max_side=300, quality=80) != cached
+
+
+def test_threads_normalizing_the_same_content(tmp_path):
+    pages = []
+    for i in range(8):
+        pages.append(save_page(tmp_path / f"copy{i}.png"))
+    results = {}
+
+    def run(page):
+        results[page] = normalize_images([page], cache_dir=str(tmp_path / "cache"), max_side=500, workers=1)[page]
+
+    threads = [threading.Thread(target=run, args=(page,)) for page in pages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Every copy gets the one normalized image, none falls back to its original
+    assert len(set(results.values())) == 1
+    assert next(iter(results.values())).endswith("_500_q80.webp")
+    assert not [p for p in (tmp_path / "cache").rglob("*.tmp")]
+
+
+def test_pool_is_shared_and_broken_images_fall_back(tmp_path):
+    pages = [save_page(tmp_path / f"page{i}.png", size=(800, 800), seed=i) for i in range(3)]
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    result = normalize_images(pages + [str(broken)], cache_dir=str(tmp_path / "cache"), max_side=200, workers=2)
+    assert result[str(broken)] == str(broken)
+    assert all(result[page].endswith("_200_q80.webp") for page in pages)
+    pool = image_cache._pool
+    assert pool is not None
+    normalize_images(pages[:2], cache_dir=str(tmp_path / "cache"), max_side=100, workers=2)
+    assert image_cache._pool is pool
@@ -0,0 +1,59 @@
+import json
+import pytest
+import preprocessing
+from json_repair import REPAIRED, TRUNCATED, parse_json_response, parse_json_with_status
+from metrics import MetricsRecorder
+
+
+@pytest.mark.parametrize("text, expected, status", [
+    ('{"a": 1}', {"a": 1}, None),
+    ('```json\n{"a": 1}\n```', {"a": 1}, None),
+    ('Here you go: {"a": [1, 2,]} hope it helps', {"a": [1, 2]}, REPAIRED),
+    ('[{"p": 1}, {"p": 2},]', [{"p": 1}, {"p": 2}], REPAIRED),
+    ('{"a": [1, 2], "b": [{"x": 1}, {"x": 2', {"a": [1, 2], "b": [{"x": 1}, {"x": 2}]}, TRUNCATED),
+    ('[{"p": 1}, {"p": 2, "s": "unfinish', [{"p": 1}, {"p": 2, "s": "unfinish"}], TRUNCATED),
+])
+def test_parse_json_with_status(text, expected, status):
+    assert parse_json_with_status(text) == (expected, status)
+    assert parse_json_response(text) == expected
+
+
+def test_unrepairable_response_raises():
+    with pytest.raises(json.JSONDecodeError):
+        parse_json_with_status("Sorry, I cannot help with that.")
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class ScriptedModel:
+    def __init__(self, *texts):
+        self.texts = list(texts)
+        self.requests = 0
+
+    def generate_content(self, prompt, generation_config=None):
+        self.requests += 1
+        return Response(self.texts.pop(0))
+
+
+@pytest.mark.parametrize("texts, requests, expected, counts", [
+    # Repaired responses are used as they are
+    (['Sure! {"summary": "ok",}'], 1, {"summary": "ok"}, (1, 0, 0)),
+    # A truncated response is asked for again while attempts remain
+    (['{"pages": [1, 2', '{"pages": [1, 2, 3]}'], 2, {"pages": [1, 2, 3]}, (0, 1, 0)),
+    # ... and kept when it is the last attempt
+    (['{"pages": [1', '{"pages": [1, 2', '{"pages": [1, 2, 3'], 3, {"pages": [1, 2, 3]}, (0, 3, 0)),
+    # Only unrepairable responses count as parse failures
+    (['no json', '{"summary": "ok"}'], 2, {"summary": "ok"}, (0, 0, 1)),
+])
+def test_generate_json_with_retry_records_repairs(monkeypatch, texts, requests, expected, counts):
+    recorder = MetricsRecorder(path=None)
+    monkeypatch.setattr(preprocessing, "metrics", recorder)
+    model = ScriptedModel(*texts)
+    assert preprocessing.generate_json_with_retry(model, "prompt", retries=3) == expected
+    assert model.requests == requests
+    [call] = recorder.records
+    assert (call.repaired, call.truncated, call.parse_failures) == counts
+    assert call.retries == requests - 1
@@ -0,0 +1,71 @@
+import random
+import pytest
+from lexical_index import LexicalIndex, LexicalIndexWriter, tokenize
+
+WORDS = [f"w{i}" for i in range(200)]
+
+
+def corpus(count=600, seed=0):
+    rng = random.Random(seed)
+    return [(f"doc{i}", rng.choice(["book", "page", "panel"]),
+             " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 25)))) for i in range(count)]
+
+
+def write_index(path, docs, flush_every=None, index_version=1):
+    writer = LexicalIndexWriter(str(path), index_version=index_version)
+    for n, doc in enumerate(docs, 1):
+        writer.add(*doc)
+        if flush_every and n % flush_every == 0:
+            writer.flush()
+    writer.close()
+    return LexicalIndex(str(path))
+
+
+def test_tokenize():
+    assert tokenize("Shaaake! Vivio's rooftop") == ["shaaake", "vivio", "s", "rooftop"]
+
+
+def test_bm25_ranks_rare_terms_and_short_documents_higher(tmp_path):
+    index = write_index(tmp_path / "lexical", [
+        ("a", "panel", "girl girl girl shaaake"),
+        ("b", "panel", "girl"),
+        ("c", "panel", "girl walks down the long street with her friends"),
+        ("d", "page", "street"),
+    ])
+    assert [doc_id for doc_id, _ in index.search(["shaaake"], 5)[0]] == ["a"]
+    # Same term frequency: the shorter document wins
+    assert [doc_id for doc_id, _ in index.search(["girl"], 5)[0]][-1] == "c"
+    assert index.search(["street"], 5, level="page")[0][0][0] == "d"
+    assert index.search(["nothing"], 5) == [[]]
+
+
+@pytest.mark.parametrize("flush_every", [1, 37, 250])
+def test_segments_score_like_one_index(tmp_path, flush_every):
+    docs = corpus()
+    single = write_index(tmp_path / "single", docs)
+    segmented = write_index(tmp_path / "segmented", docs, flush_every=flush_every)
+    assert len(segmented.segments) == -(-len(docs) // flush_every)
+    assert segmented.count == single.count == len(docs)
+
+    rng = random.Random(1)
+    queries = [" ".join(rng.choice(WORDS) for _ in range(3)) for _ in range(20)]
+    allowed = {doc_id for doc_id, _, _ in rng.sample(docs, 100)}
+    for kwargs in [{}, {"level": "panel"}, {"ids": allowed}, {"level": "page", "ids": allowed}]:
+        # A large n_results compares the full ranking, ties included
+        for expected, actual in zip(single.search(queries, 1000, **kwargs), segmented.search(queries, 1000, **kwargs)):
+            assert [doc_id for doc_id, _ in actual] == [doc_id for doc_id, _ in expected]
+            assert [score for _, score in actual] == pytest.approx([score for _, score in expected], rel=1e-5)
+        for hits in segmented.search(queries, 5, **kwargs):
+            assert len(hits) <= 5
+            assert all(kwargs.get("ids") is None or doc_id in allowed for doc_id, _ in hits)
+
+
+def test_rewrite_replaces_old_segments(tmp_path):
+    path = tmp_path / "lexical"
+    write_index(path, corpus(), flush_every=50, index_version=1)
+    assert LexicalIndex.stored_index_version(str(path)) == 1
+    index = write_index(path, [("only", "book", "w1")], index_version=2)
+    assert LexicalIndex.stored_index_version(str(path)) == 2
+    assert len(index.segments) == 1
+    assert [doc_id for doc_id, _ in index.search(["w1"], 5)[0]] == ["only"]
+    assert sorted(p.name for p in path.iterdir()) == ["meta.json", "segment_000"]
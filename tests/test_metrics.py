@@ -0,0 +1,50 @@
+import json
+import pytest
+from json_repair import REPAIRED, TRUNCATED
+from metrics import MetricsRecorder, request_size
+
+
+class Usage:
+    prompt_token_count = 120
+    candidates_token_count = 30
+
+
+class Response:
+    usage_metadata = Usage()
+
+
+def test_request_size_counts_text_and_image_bytes():
+    image = {"mime_type": "image/webp", "data": b"\x00" * 1000}
+    assert request_size(["héllo", image, None]) == 6 + 1000
+    assert request_size(None) == 0
+
+
+def test_calls_are_recorded_and_summarized(tmp_path):
+    recorder = MetricsRecorder(path=str(tmp_path / "metrics.jsonl"))
+    with recorder.track("page_analysis", ["prompt"]) as call:
+        call.mark_request_sent()
+        call.mark_first_chunk()
+        call.add_usage(Response())
+        call.add_usage(Response())
+        call.record_repair(REPAIRED)
+        call.record_repair(TRUNCATED)
+        call.record_repair(None)
+    with pytest.raises(RuntimeError):
+        with recorder.track("page_analysis") as call:
+            raise RuntimeError("503 Service Unavailable")
+    with recorder.track("rerank", "prompt"):
+        pass
+
+    lines = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [line["stage"] for line in lines] == ["page_analysis", "page_analysis", "rerank"]
+    first = lines[0]
+    assert (first["request_bytes"], first["prompt_tokens"], first["response_tokens"]) == (6, 240, 60)
+    assert (first["repaired"], first["truncated"], first["error"]) == (1, 1, None)
+    assert first["time_to_first_chunk"] is not None and first["wall_time"] >= first["queue_time"]
+    assert lines[1]["error"] == "RuntimeError: 503 Service Unavailable"
+
+    table = recorder.summary_table().splitlines()
+    assert table[0].split()[:3] == ["stage", "calls", "errors"]
+    assert table[2].split()[:3] == ["page_analysis", "2", "1"]
+    assert table[3].split()[:3] == ["rerank", "1", "0"]
+    assert MetricsRecorder(path=None).summary_table() == "No LLM calls recorded."
@@ -0,0 +1,60 @@
+import json
+import numpy as np
+from PIL import Image
+from page_cache import PageAnalysisCache, dhash
+
+
+def save_page(path, seed, size=(400, 600)):
+    """A smooth random page; the same seed gives the same drawing."""
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 256, size=(12, 8), dtype=np.uint8)
+    Image.fromarray(blocks).resize(size, Image.BILINEAR).save(path)
+    return str(path)
+
+
+def save_rescan(path, original):
+    """The same page downscaled and re-encoded as JPEG."""
+    with Image.open(original) as img:
+        img.resize((300, 450), Image.LANCZOS).save(path, "JPEG", quality=85)
+    return str(path)
+
+
+def test_exact_near_and_miss(tmp_path):
+    cache = PageAnalysisCache(str(tmp_path / "cache"))
+    original = save_page(tmp_path / "page1.png", seed=1)
+    cache.store(original, {"page_number": 1, "image_path": original, "summary": "first"})
+
+    copy = tmp_path / "copy.png"
+    copy.write_bytes(open(original, "rb").read())
+    assert cache.lookup(str(copy), 7) == {"page_number": 7, "image_path": str(copy), "summary": "first"}
+
+    # Re-encoded and downscaled scan of the same page
+    rescan = save_rescan(tmp_path / "rescan.jpg", original)
+    assert cache.lookup(rescan, 3)["summary"] == "first"
+
+    other = save_page(tmp_path / "other.png", seed=2)
+    assert cache.lookup(other, 2) is None
+    assert (cache.hits, cache.near_hits, cache.misses) == (1, 1, 1)
+
+
+def test_nearest_stored_page_wins(tmp_path):
+    cache = PageAnalysisCache(str(tmp_path / "cache"), max_distance=256)
+    pages = [save_page(tmp_path / f"page{seed}.png", seed) for seed in range(100)]
+    for seed, page in enumerate(pages):
+        cache.store(page, {"summary": f"page {seed}"})
+    query = save_rescan(tmp_path / "query.jpg", pages[42])
+    expected = min(range(100), key=lambda seed: (dhash(pages[seed]) ^ dhash(query)).bit_count())
+    assert cache.lookup(query, 1)["summary"] == f"page {expected}"
+
+
+def test_index_is_reloaded(tmp_path):
+    root = str(tmp_path / "cache")
+    page = save_page(tmp_path / "page1.png", seed=1)
+    PageAnalysisCache(root).store(page, {"summary": "first"})
+    with open(f"{root}/index.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"sha256": "torn')
+
+    cache = PageAnalysisCache(root)
+    rescan = save_rescan(tmp_path / "rescan.jpg", page)
+    assert cache.lookup(rescan, 1)["summary"] == "first"
+    assert json.loads(open(f"{root}/index.jsonl", encoding="utf-8").readline())["dhash"] == f"{dhash(page):064x}"
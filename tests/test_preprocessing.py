@@ -0,0 +1,150 @@
+import json
+import re
+import threading
+import time
+import pytest
+import preprocessing
+from metrics import metrics
+
+PAGE_RE = re.compile(r"This is page (\d+) and the image path is '([^']+)'")
+BATCH_PAGE_RE = re.compile(r"Page (\d+), image path '([^']+)':")
+
+
+class Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+def page_object(page_number, image_path):
+    return {"page_number": int(page_number), "image_path": image_path,
+            "summary": f"Page {page_number}", "panels": [{"panel_id": "1", "summary": "A panel."}]}
+
+
+class StubGeminiModel:
+    """
+    Stands in for genai.GenerativeModel: answers page requests with a page object built from the
+    prompt and records how many requests were in flight at once.
+    """
+
+    def __init__(self, delay=0.02, fail_books=()):
+        self.delay = delay
+        self.fail_books = fail_books
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.page_requests = 0
+
+    def batch_response(self, pages):
+        return json.dumps(pages)
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        if stream:
+            with self.lock:
+                self.page_requests += 1
+            batch = [BATCH_PAGE_RE.match(part).groups() for part in contents
+                     if isinstance(part, str) and BATCH_PAGE_RE.match(part)]
+            if batch:
+                text = self.batch_response([page_object(*page) for page in batch])
+            else:
+                text = json.dumps(page_object(*PAGE_RE.search(contents[-1]).groups()))
+            return [Chunk(text[:10]), Chunk(text[10:])]
+        manga_name = re.search(r"The manga name is '([^']+)'", contents).group(1)
+        if manga_name in self.fail_books:
+            raise RuntimeError("503 Service Unavailable")
+        return Chunk(json.dumps({"manga_name": manga_name, "summary": f"Summary of {manga_name}"}))
+
+
+@pytest.fixture
+def manga_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "path", None)
+    monkeypatch.setattr(preprocessing, "PAGE_CACHE", False)
+    root = tmp_path / "manga_images"
+    for book in ("Alpha", "Beta", "Gamma"):
+        (root / book).mkdir(parents=True)
+        for page in (10, 2, 1, 11, 3, 9, 7, 5):
+            (root / book / f"page{page}.png").write_bytes(b"\x89PNG" + bytes([page]))
+    return root
+
+
+def test_pages_stay_in_reading_order_under_the_request_cap(manga_root):
+    model = StubGeminiModel()
+    results = preprocessing.process_all_manga(str(manga_root), book_workers=3, page_workers=4,
+                                              max_concurrent_requests=2, gemini_model=model, normalize=False)
+
+    assert sorted(results) == ["Alpha", "Beta", "Gamma"]
+    for book, manga_object in results.items():
+        assert [page["page_number"] for page in manga_object["pages"]] == list(range(1, 9))
+        assert [page["image_path"].rsplit("page", 1)[1] for page in manga_object["pages"]] == \
+            ["1.png", "2.png", "3.png", "5.png", "7.png", "9.png", "10.png", "11.png"]
+    assert model.page_requests == 24
+    assert model.max_in_flight <= 2
+
+
+def test_a_failing_book_does_not_stop_the_others(manga_root):
+    model = StubGeminiModel(fail_books=("Beta",))
+    results = preprocessing.process_all_manga(str(manga_root), book_workers=2, page_workers=2,
+                                              max_concurrent_requests=3, gemini_model=model, normalize=False)
+
+    assert sorted(results) == ["Alpha", "Gamma"]
+    assert model.max_in_flight <= 3
+    # Beta's pages are checkpointed, so the next run only repeats its book summary
+    model = StubGeminiModel()
+    results = preprocessing.process_all_manga(str(manga_root), gemini_model=model, normalize=False)
+    assert sorted(results) == ["Beta"]
+    assert model.page_requests == 0
+
+
+class ProseBatchModel(StubGeminiModel):
+    def batch_response(self, pages):
+        return "Here are the pages:\n" + json.dumps(pages) + "\nLet me know if you need more."
+
+
+class SkippingBatchModel(StubGeminiModel):
+    def batch_response(self, pages):
+        return json.dumps(pages[:1] + pages[2:])
+
+
+class TruncatingBatchModel(StubGeminiModel):
+    def batch_response(self, pages):
+        text = json.dumps(pages)
+        return text[:text.rindex('"summary": "A panel."')]
+
+
+def batch_of(tmp_path, count):
+    batch = []
+    for idx in range(count):
+        path = tmp_path / f"page{idx + 1}.png"
+        path.write_bytes(b"\x89PNG" + bytes([idx]))
+        batch.append((idx, str(path)))
+    return batch
+
+
+@pytest.mark.parametrize("model_class, requests", [
+    (StubGeminiModel, 1),
+    # Lossless repairs keep every page
+    (ProseBatchModel, 1),
+    # Only the page the model left out is requested again
+    (SkippingBatchModel, 2),
+    # The cut-off last page is requested again
+    (TruncatingBatchModel, 2),
+])
+def test_batch_requests_only_missing_pages_again(tmp_path, monkeypatch, model_class, requests):
+    monkeypatch.setattr(metrics, "path", None)
+    batch = batch_of(tmp_path, 3)
+    model = model_class(delay=0)
+    results = preprocessing.analyze_page_batch(model, batch, "Alpha", {})
+
+    assert model.page_requests == requests
+    assert sorted(results) == [0, 1, 2]
+    for idx, image_path in batch:
+        assert results[idx]["page_number"] == idx + 1
+        assert results[idx]["image_path"] == image_path
+        assert results[idx]["panels"] == [{"panel_id": "1", "summary": "A panel."}]
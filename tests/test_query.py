@@ -0,0 +1,115 @@
+import conftest
+
+
+class CountingEmbedding(conftest.HashEmbedding):
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        return super().__call__(texts)
+
+
+def ids(results):
+    return [r["id"] for r in results]
+
+
+def test_search_many_matches_single_searches(retriever, rerank_llm):
+    queries = ["Book 3 festival", "rain on the rooftop", "Book 3 festival", "shaaake"]
+    retriever._embedding_function = embed = CountingEmbedding()
+    ranked = retriever.search_many(queries, n_results=3, filter_level="panel")
+    # One embedding batch of the distinct queries, one rerank per query
+    assert embed.batches == [["Book 3 festival", "rain on the rooftop", "shaaake"]]
+    assert len(rerank_llm.prompts) == len(queries)
+    for query, results in zip(queries, ranked):
+        assert len(results) == 3
+        assert ids(results) == ids(retriever.search(query, n_results=3, filter_level="panel"))
+    assert retriever.search_many([]) == []
+
+
+def test_raw_search_many_matches_raw_search(retriever):
+    queries = ["Book 3 festival", "Page 2 of Book 4", "Book 5 rain"]
+    for level in (None, "page"):
+        batched = retriever.raw_search_many(queries, n_results=6, filter_level=level)
+        assert [len(candidates) for candidates in batched] == [6, 6, 6]
+        assert batched == [retriever.raw_search(query, n_results=6, filter_level=level) for query in queries]
+        assert all(c["metadata"]["level"] == level for candidates in batched for c in candidates if level)
+
+
+def test_lexical_hits_are_fused_by_reciprocal_rank(retriever):
+    from lexical_index import RRF_K
+    query = "shaaake"
+    fused = retriever.raw_search(query, n_results=5)
+    lexical_hits = retriever.current_lexical_index().search([query], 5)[0]
+    retriever.lexical_search = False
+    vector_only = retriever.raw_search(query, n_results=5)
+    assert all("lexical_score" not in c for c in vector_only)
+
+    scores = {c["id"]: 1.0 / (RRF_K + rank + 1) for rank, c in enumerate(vector_only)}
+    for rank, (doc_id, _) in enumerate(lexical_hits):
+        scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    assert ids(fused) == sorted(scores, key=scores.get, reverse=True)[:5]
+    # The panel with the onomatopoeia comes first; BM25-only hits are fetched without a similarity
+    assert fused[0]["id"] == "Book 7_page_4_panel_2"
+    assert dict(lexical_hits)[fused[0]["id"]] == fused[0]["lexical_score"]
+    lexical_only = [c for c in fused if c["id"] not in ids(vector_only)]
+    assert lexical_only and all(c["similarity"] is None and c["content"].startswith("Manga: Book 7")
+                                for c in lexical_only)
+
+
+def test_entity_filters_are_planned_by_selectivity(retriever, monkeypatch):
+    import entity_index
+    retriever.lexical_search = False
+    entities = retriever.current_entity_index()
+    searches = [
+        ("Book 3 festival", {"characters": "Misaki"}, "prefilter"),  # 1 of 80 panels
+        ("Book 3 festival", {"characters": "Hina"}, "postfilter"),  # 40 of 80 panels
+        # Half the panels match, but none of the closest ones: redone as a pre-filtered search
+        ("Kokoro on the rooftop", {"location": "classroom"}, "postfilter_fallback"),
+    ]
+    for query, filters, plan in searches:
+        before = dict(retriever.filter_plans)
+        results = retriever.raw_search(query, n_results=10, filter_level="panel", **filters)
+        assert retriever.filter_plans[plan] == before[plan] + 1
+        allowed = set(entities.match(entity_index.entity_filters(**filters), level="panel"))
+        assert results and {c["id"] for c in results} <= allowed
+        # Every plan finds what a pre-filtered search finds
+        with monkeypatch.context() as m:
+            m.setattr(entity_index, "PREFILTER_MAX_SELECTIVITY", 1.0)
+            assert ids(results) == ids(retriever.raw_search(query, n_results=10, filter_level="panel", **filters))
+
+
+def test_entity_filters_without_matches(retriever, rerank_llm):
+    assert retriever.raw_search("Book 3", n_results=5, characters="Nobody") == []
+    assert retriever.search("Book 3", n_results=5, characters=["Hina", "Misaki"], filter_level="panel") == []
+    assert rerank_llm.prompts == []
+    # Names match whole words only, case-insensitively
+    assert sorted(ids(retriever.raw_search("Book 3", n_results=5, characters="misaki"))) == [
+        "Book 3_book", "Book 3_page_2", "Book 3_page_2_panel_2"]
+
+
+def test_sharded_index_searches_like_one_collection(tmp_path, monkeypatch, retriever):
+    import vectorize
+    from vector_store import ShardedVectorStore
+    monkeypatch.setattr(vectorize, "EmbeddingEngine", conftest.HashEmbeddingEngine)
+    monkeypatch.setattr(vectorize, "EMBEDDING_CACHE", False)
+    (tmp_path / "manga_images").mkdir()
+    (tmp_path / "manga_analyses").mkdir()
+    for book in range(conftest.BOOKS):
+        conftest.write_book(str(tmp_path / "manga_analyses"), book)
+    vectorize.vectorize_manga_schemas(str(tmp_path / "chroma"), str(tmp_path / "manga_images"), shards=3)
+
+    sharded = conftest.make_retriever(str(tmp_path / "chroma"))
+    # BM25 ties are ordered by segment, and a sharded build writes one segment per shard
+    retriever.lexical_search = sharded.lexical_search = False
+    try:
+        assert isinstance(sharded.current_vector_store(), ShardedVectorStore)
+        for query, kwargs in [("Book 3 festival", {}), ("Book 5 rain", {"filter_level": "page"}),
+                              ("shaaake", {"filter_level": "panel"}),
+                              ("Book 3 festival", {"filter_level": "panel", "characters": "Hina"}),
+                              ("Book 3 festival", {"characters": "Misaki"})]:
+            expected = retriever.raw_search(query, n_results=6, **kwargs)
+            assert expected
+            assert ids(sharded.raw_search(query, n_results=6, **kwargs)) == ids(expected)
+    finally:
+        sharded.current_vector_store().close()
@@ -0,0 +1,106 @@
+import json
+import pytest
+from query import MangaRetrieval
+from query_cache import QueryEmbeddingCache, SemanticQueryCache
+
+
+def test_lru_eviction_and_stats():
+    cache = QueryEmbeddingCache("model", max_entries=2)
+    cache.put("a", [1, 0])
+    cache.put("b", [0, 1])
+    assert cache.get("a") == [1.0, 0.0]  # "b" is now the least recently used
+    cache.put("c", [1, 1])
+    assert cache.get("b") is None
+    assert cache.get("c") == [1.0, 1.0]
+    assert cache.stats() == {"entries": 2, "hits": 2, "misses": 1, "hit_rate": 2 / 3}
+
+
+def test_persisted_queries_are_reloaded_per_model(tmp_path):
+    path = str(tmp_path / "chroma" / "query_embeddings.jsonl")
+    cache = QueryEmbeddingCache("model", max_entries=2, path=path)
+    for i, query in enumerate(["a", "b", "c"]):
+        cache.put(query, [float(i)])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"model_id": "model", "query": "torn')
+
+    reloaded = QueryEmbeddingCache("model", max_entries=2, path=path)
+    assert list(reloaded.entries) == ["b", "c"]
+    assert QueryEmbeddingCache("other model", path=path).entries == {}
+
+
+def test_file_is_compacted(tmp_path):
+    path = tmp_path / "query_embeddings.jsonl"
+    cache = QueryEmbeddingCache("model", max_entries=3, path=str(path))
+    for i in range(20):
+        cache.put(f"q{i}", [float(i)])
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert len(lines) <= 2 * 3
+    assert [json.loads(line)["query"] for line in lines][-3:] == ["q17", "q18", "q19"]
+    assert list(QueryEmbeddingCache("model", max_entries=3, path=str(path)).entries) == ["q17", "q18", "q19"]
+
+
+class CountingEmbeddingFunction:
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def test_retrieval_embeds_only_uncached_queries(tmp_path):
+    retriever = MangaRetrieval(str(tmp_path / "chroma"))
+    retriever._embedding_function = embed = CountingEmbeddingFunction()
+    assert retriever.embed_queries(["ab", "abc", "ab"]) == [[2.0, 1.0], [3.0, 1.0], [2.0, 1.0]]
+    assert retriever.embed_query("abc") == [3.0, 1.0]
+    assert retriever.embed_queries(["abc", "abcd"])[1] == [4.0, 1.0]
+    assert embed.batches == [["ab", "abc"], ["abcd"]]
+
+    # Persisted next to the index, so a new process starts warm
+    retriever = MangaRetrieval(str(tmp_path / "chroma"))
+    retriever._embedding_function = embed = CountingEmbeddingFunction()
+    assert retriever.embed_queries(["ab", "abcd"]) == [[2.0, 1.0], [4.0, 1.0]]
+    assert embed.batches == []
+
+
+def test_semantic_cache_reuses_close_queries_of_the_same_group():
+    cache = SemanticQueryCache(threshold=0.95, max_entries=2)
+    cache.store("two girls", [1.0, 0.0], 5, "panel", 1, [{"id": "a"}], ["a", "b"])
+    entry, similarity = cache.lookup([0.99, 0.1], 5, "panel", 1)
+    assert entry["query"] == "two girls" and similarity == pytest.approx(0.995, abs=1e-3)
+    entry["results"].append({"id": "mutated"})
+    assert cache.lookup([1.0, 0.0], 5, "panel", 1)[0]["results"] == [{"id": "a"}]
+    assert cache.lookup([0.8, 0.6], 5, "panel", 1) is None
+    assert cache.lookup([1.0, 0.0], 3, "panel", 1) is None
+    assert cache.lookup([1.0, 0.0], 5, None, 1) is None
+    # A new index version drops the old entries
+    assert cache.lookup([1.0, 0.0], 5, "panel", 2) is None
+    assert cache.lookup([1.0, 0.0], 5, "panel", 1) is None
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (0, 2, 5)
+
+
+def test_search_reuses_results_of_near_duplicate_queries(retriever, rerank_llm):
+    retriever.semantic_cache = SemanticQueryCache(threshold=0.9)
+    first = retriever.search("Book 3 festival scene", n_results=3)
+    assert retriever.search("book 3 festival scene!", n_results=3) == first
+    assert len(rerank_llm.prompts) == 1
+    # Other filters or result counts are searched again
+    retriever.search("Book 3 festival scene", n_results=3, characters="Hina")
+    retriever.search("Book 3 festival scene", n_results=2)
+    assert len(rerank_llm.prompts) == 3
+
+
+def test_rerank_new_mode_sends_only_unseen_candidates(retriever, rerank_llm):
+    retriever.semantic_cache = SemanticQueryCache(threshold=0.5)
+    retriever.semantic_cache_mode = "rerank_new"
+    first = retriever.search("Book 3 festival scene", n_results=3)
+    seen = {c["id"] for c in retriever.raw_search("Book 3 festival scene", n_results=6)}
+    results = retriever.search("Book 3 rain scene", n_results=3)
+    assert len(rerank_llm.prompts) == 2
+    prompt = rerank_llm.prompts[1]
+    new_ids = {c["id"] for c in json.loads(prompt.split("Here are the candidate results:\n", 1)[1].split("\n\nFor each", 1)[0])}
+    assert new_ids and not new_ids & seen
+    # The cached ranking and the new one are merged by relevance score
+    assert len(results) == 3
+    assert {r["id"] for r in results} <= {r["id"] for r in first} | new_ids
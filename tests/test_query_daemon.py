@@ -0,0 +1,75 @@
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer
+import pytest
+from query_daemon import MicroBatcher, QueryRequestHandler, daemon_search
+
+
+class StubRetriever:
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    def search_many(self, queries, n_results=5, filter_level=None, characters=None, location=None, emotion=None):
+        self.calls.append((list(queries), n_results, filter_level, characters))
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return [[{"identifier": query, "n_results": n_results}] for query in queries]
+
+
+@pytest.fixture
+def daemon():
+    servers = []
+
+    def start(retriever, batch_wait=0.05):
+        handler = type("Handler", (QueryRequestHandler,), {"batcher": MicroBatcher(retriever, batch_wait=batch_wait)})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_batcher_groups_requests_with_the_same_parameters():
+    retriever = StubRetriever()
+    batcher = MicroBatcher(retriever, batch_wait=0.2)
+    futures = [batcher.submit("a", 5), batcher.submit("b", 5), batcher.submit("c", 3),
+               batcher.submit("d", 5, characters="Hina")]
+    assert [f.result(timeout=5)[0]["identifier"] for f in futures] == ["a", "b", "c", "d"]
+    assert sorted(retriever.calls) == [(["a", "b"], 5, None, None), (["c"], 3, None, None),
+                                       (["d"], 5, None, ("hina",))]
+
+
+def test_batcher_fails_every_request_of_a_failed_batch():
+    batcher = MicroBatcher(StubRetriever(error=ValueError("boom")), batch_wait=0.1)
+    futures = [batcher.submit("a"), batcher.submit("b")]
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+
+def test_daemon_search(daemon):
+    url = daemon(StubRetriever())
+    assert daemon_search("shaaake", n_results=3, url=url) == [{"identifier": "shaaake", "n_results": 3}]
+
+
+def test_no_daemon_listening_returns_none():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    assert daemon_search("shaaake", url=f"http://127.0.0.1:{port}") is None
+
+
+def test_daemon_timeouts_and_errors_are_not_retried_locally(daemon):
+    # The search already ran on the daemon, so the caller must not fall back to a local search
+    with pytest.raises(RuntimeError, match="did not answer"):
+        daemon_search("slow", url=daemon(StubRetriever(delay=1.0)), timeout=0.3)
+    with pytest.raises(RuntimeError, match="boom"):
+        daemon_search("broken", url=daemon(StubRetriever(error=ValueError("boom"))))
@@ -0,0 +1,93 @@
+import json
+import time
+import pytest
+import query
+from metrics import metrics
+from rerank_cache import RerankCache, rerank_cache_key
+
+
+def test_key_ignores_case_whitespace_and_candidate_order():
+    key = rerank_cache_key("Two girls  talking", ["b", "a"], 5, "1")
+    assert key == rerank_cache_key(" two GIRLS talking", ["a", "b"], 5, "1")
+    assert key != rerank_cache_key("two girls talking", ["a", "b"], 3, "1")
+    assert key != rerank_cache_key("two girls talking", ["a", "b"], 5, "2")
+    assert key != rerank_cache_key("two girls talking", ["a", "c"], 5, "1")
+
+
+def test_entries_persist_per_index_version(tmp_path):
+    path = str(tmp_path / "rerank_cache.sqlite3")
+    cache = RerankCache(path, index_version=1)
+    cache.put("k", [{"id": "a"}])
+    assert cache.get("k") == [{"id": "a"}]
+    assert RerankCache(path, index_version=1).get("k") == [{"id": "a"}]
+    # Re-indexing drops the entries of the old index
+    cache.set_index_version(2)
+    assert cache.get("k") is None
+    assert RerankCache(path, index_version=1).get("k") is None
+    assert cache.stats() == {"entries": 0, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_expiry_and_least_recently_used_eviction(tmp_path):
+    cache = RerankCache(str(tmp_path / "rerank_cache.sqlite3"), max_entries=2)
+    cache.put("a", [1])
+    time.sleep(0.01)
+    cache.put("b", [2])
+    time.sleep(0.01)
+    assert cache.get("a") == [1]
+    cache.put("c", [3])
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ([1], None, [3])
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get("a") is None
+
+
+class FakeGenAI:
+    def __init__(self, *texts):
+        self.texts = list(texts)
+        self.requests = 0
+
+    def GenerativeModel(self, model_name):
+        return self
+
+    def generate_content(self, contents, generation_config=None):
+        self.requests += 1
+        return type("Response", (), {"text": self.texts.pop(0), "usage_metadata": None})()
+
+
+def candidates():
+    return [{"id": f"doc{i}", "content": f"Page {i}.", "similarity": 1 - i / 10,
+             "metadata": {"level": "page", "manga_title": "Alpha", "page_number": i, "image_path": f"a/{i}.png"}}
+            for i in range(3)]
+
+
+def ranking(*ids):
+    return json.dumps({"ranked_results": [{"id": doc_id, "relevance_score": 90 - i, "explanation": "fits"}
+                                          for i, doc_id in enumerate(ids)]})
+
+
+@pytest.fixture
+def retriever(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "path", None)
+    return query.MangaRetrieval(str(tmp_path / "chroma"))
+
+
+def test_rerank_results_are_served_from_the_cache(retriever, monkeypatch):
+    genai = FakeGenAI(ranking("doc2", "doc0"), ranking("doc1"))
+    monkeypatch.setattr(query, "get_genai", lambda: genai)
+    first = retriever.rerank_results("two girls", candidates(), n=2)
+    assert [r["id"] for r in first] == ["doc2", "doc0"]
+    assert first[0]["image_path"] == "a/2.png" and first[0]["vector_similarity"] == pytest.approx(0.8)
+    # Same query up to case and candidate order
+    assert retriever.rerank_results("Two  girls", candidates()[::-1], n=2) == first
+    assert genai.requests == 1
+    assert retriever.rerank_cache.stats()["hits"] == 1
+
+
+def test_truncated_and_fallback_rankings_are_not_cached(retriever, monkeypatch):
+    genai = FakeGenAI(ranking("doc2", "doc0")[:-30], "not json", ranking("doc1"))
+    monkeypatch.setattr(query, "get_genai", lambda: genai)
+    assert retriever.rerank_results("q", candidates(), n=2)[0]["id"] == "doc2"
+    fallback = retriever.rerank_results("q", candidates(), n=2)
+    assert [r["explanation"] for r in fallback] == [query.FALLBACK_EXPLANATION] * 2
+    assert [r["id"] for r in retriever.rerank_results("q", candidates(), n=2)] == ["doc1"]
+    assert genai.requests == 3
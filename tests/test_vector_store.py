@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+import chromadb
+from index_manifest import save_index_manifest
+from vector_store import NumpyVectorStore, ShardedVectorStore, SHARDS_FILE, LEVELS, shard_path
+from checkpoint import write_json_atomic
+
+DIM = 8
+
+
+def make_documents(titles, pages=4):
+    """ids, levels and unit vectors of a small library: one book document and some page documents per title."""
+    rng = np.random.default_rng(0)
+    docs = []
+    for title in titles:
+        docs.append((f"{title}_book", "book", title))
+        docs.extend((f"{title}_page_{p}", "page", title) for p in range(1, pages + 1))
+    vectors = rng.normal(size=(len(docs), DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return docs, vectors
+
+
+def brute_force(vectors, rows, query, k):
+    distances = ((vectors[rows] - query) ** 2).sum(axis=1)
+    return [rows[i] for i in np.argsort(distances, kind="stable")[:k]]
+
+
+@pytest.fixture(scope="module")
+def sharded_index(tmp_path_factory):
+    """Three Chroma shard collections with the shard manifests vectorize.py writes."""
+    chroma_path = str(tmp_path_factory.mktemp("chroma"))
+    titles = [f"Book {i}" for i in range(6)]
+    docs, vectors = make_documents(titles)
+    for shard in range(3):
+        rows = [i for i, (_, _, title) in enumerate(docs) if titles.index(title) % 3 == shard]
+        collection = chromadb.PersistentClient(path=shard_path(chroma_path, shard)).create_collection(
+            "manga_collection", embedding_function=None)
+        collection.add(ids=[docs[i][0] for i in rows], embeddings=vectors[rows].tolist(),
+                       documents=[docs[i][0] for i in rows],
+                       metadatas=[{"level": docs[i][1], "manga_title": docs[i][2]} for i in rows])
+        files = {}
+        for i in rows:
+            files.setdefault(f"{docs[i][2]}_schema.json", {"hash": "", "ids": []})["ids"].append(docs[i][0])
+        save_index_manifest(shard_path(chroma_path, shard), {"version": 1, "files": files})
+    write_json_atomic(f"{chroma_path}/{SHARDS_FILE}", {"shards": 3})
+    store = ShardedVectorStore(chroma_path, 3, workers=2)
+    yield store, docs, vectors
+    store.close()
+
+
+def test_sharded_store_counts(sharded_index):
+    store, docs, _ = sharded_index
+    assert store.count == len(docs)
+    assert store.level_counts == {level: sum(1 for d in docs if d[1] == level) for level in LEVELS}
+
+
+def test_sharded_query_merges_shards(sharded_index):
+    store, docs, vectors = sharded_index
+    results = store.query(vectors[:2], n_results=5)
+    for q in range(2):
+        expected = brute_force(vectors, list(range(len(docs))), vectors[q], 5)
+        assert results["ids"][q] == [docs[i][0] for i in expected]
+
+
+def test_sharded_prefilter_sends_each_shard_its_own_ids(sharded_index):
+    store, docs, vectors = sharded_index
+    # Allowed documents spread over all shards, plus an id that is not indexed anywhere
+    allowed = [0, 6, 12, 13, 20, 27]
+    ids = [docs[i][0] for i in allowed] + ["Unknown_page_1"]
+    results = store.query(vectors[[3]], n_results=4, ids=ids)
+    assert results["ids"][0] == [docs[i][0] for i in brute_force(vectors, allowed, vectors[3], 4)]
+
+    # A shard with fewer allowed ids than n_results returns what it has
+    results = store.query(vectors[[3]], n_results=10, ids=ids)
+    assert sorted(results["ids"][0]) == sorted(docs[i][0] for i in allowed)
+
+    page_ids = [docs[i][0] for i in allowed if docs[i][1] == "page"]
+    results = store.query(vectors[[3]], n_results=10, level="page", ids=page_ids)
+    assert sorted(results["ids"][0]) == sorted(page_ids)
+
+
+def test_sharded_get_routes_ids(sharded_index):
+    store, docs, _ = sharded_index
+    ids = [docs[1][0], docs[7][0], docs[14][0], "Unknown_book"]
+    assert sorted(store.get(ids)["ids"]) == sorted(ids[:3])
+
+
+@pytest.fixture(scope="module", params=["l2", "cosine"])
+def numpy_store(tmp_path_factory, request):
+    """A Chroma collection and the NumPy store exported from it."""
+    path = tmp_path_factory.mktemp("numpy")
+    docs, vectors = make_documents([f"Book {i}" for i in range(20)])
+    vectors *= np.linspace(0.5, 2.0, len(docs), dtype=np.float32)[:, None]  # unequal norms tell l2 from cosine
+    collection = chromadb.PersistentClient(path=str(path / "chroma")).create_collection(
+        "manga_collection", embedding_function=None, metadata={"hnsw:space": request.param})
+    metadatas = [{"level": level, "manga_title": title} for _, level, title in docs]
+    collection.add(ids=[d[0] for d in docs], embeddings=vectors.tolist(), documents=[d[0] for d in docs],
+                   metadatas=metadatas)
+    NumpyVectorStore.write(str(path / "store"), [d[0] for d in docs], vectors, metadatas, [d[0] for d in docs],
+                           space=request.param, index_version=3)
+    return str(path / "store"), collection, docs, vectors
+
+
+def test_numpy_store_matches_chroma(numpy_store):
+    path, collection, docs, vectors = numpy_store
+    store = NumpyVectorStore(path)
+    assert (store.count, store.index_version, NumpyVectorStore.stored_index_version(path)) == (len(docs), 3, 3)
+    assert store.level_counts == {level: sum(1 for d in docs if d[1] == level) for level in LEVELS}
+    queries = vectors[[0, 7, 33]] + 0.1
+    allowed = [docs[i][0] for i in range(0, len(docs), 3)]
+    for kwargs in [{}, {"level": "page"}, {"ids": allowed}, {"level": "book", "ids": allowed}]:
+        chroma_kwargs = {"where": {"level": kwargs["level"]} if "level" in kwargs else None, "ids": kwargs.get("ids")}
+        expected = collection.query(query_embeddings=queries.tolist(), n_results=6, **chroma_kwargs)
+        actual = store.query(queries, n_results=6, **kwargs)
+        assert actual["ids"] == expected["ids"]
+        assert actual["metadatas"] == expected["metadatas"]
+        for a, e in zip(actual["distances"], expected["distances"]):
+            assert a == pytest.approx(e, abs=1e-4)
+    assert store.get([docs[5][0], "Unknown_book"])["ids"] == [docs[5][0]]
+
+
+@pytest.mark.parametrize("quantization", ["float16", "int8"])
+def test_quantized_first_pass_rescores_exactly(numpy_store, quantization):
+    path, _, docs, vectors = numpy_store
+    exact = NumpyVectorStore(path)
+    store = NumpyVectorStore(path, quantization=quantization, rescore_factor=4)
+    assert store.memory_bytes() < exact.memory_bytes()
+    queries = vectors[[1, 8, 40]] + 0.05
+    for kwargs in [{}, {"level": "page"}, {"ids": [d[0] for d in docs[::2]]}]:
+        expected = exact.query(queries, n_results=5, **kwargs)
+        actual = store.query(queries, n_results=5, **kwargs)
+        assert actual["ids"] == expected["ids"]
+        # Distances come from the float32 vectors, not the quantized ones
+        for a, e in zip(actual["distances"], expected["distances"]):
+            assert a == pytest.approx(e, abs=1e-6)
+
+
+def test_unknown_quantization(numpy_store):
+    with pytest.raises(ValueError):
+        NumpyVectorStore(numpy_store[0], quantization="int4")
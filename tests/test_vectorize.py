@@ -0,0 +1,78 @@
+import json
+import pytest
+import vectorize
+from entity_index import EntityIndex, ENTITY_INDEX_DIR
+from lexical_index import LexicalIndex, LEXICAL_INDEX_DIR
+
+
+def write_schema(analyses_dir, title, pages):
+    manga = {
+        "manga_name": title,
+        "summary": f"The story of {title}.",
+        "pages": [{
+            "page_number": p + 1,
+            "image_path": f"./manga_images/{title}/{p + 1}.png",
+            "summary": f"Page {p + 1} of {title}.",
+            "panels": [{
+                "panel_id": "1",
+                "characters": [{"name": f"{title} hero", "expression": "smiling", "pose": "standing"}],
+                "setting": {"location": "classroom" if p % 2 else "street", "background_elements": []},
+                "narrative": {"actions": ["waves"], "dialogue": [f"hello from {title}"], "emotion": "happy"},
+                "text_elements": ["shaaake"] if p == 0 else [],
+                "summary": "A wave.",
+            }],
+        } for p in range(pages)],
+    }
+    with open(analyses_dir / f"{title}_schema.json", "w", encoding="utf-8") as f:
+        json.dump(manga, f)
+    return f"{title}_schema.json"
+
+
+@pytest.fixture
+def library(tmp_path):
+    analyses_dir = tmp_path / "manga_analyses"
+    analyses_dir.mkdir()
+    files = [write_schema(analyses_dir, f"book{i}", pages=3) for i in range(6)]
+    return tmp_path, analyses_dir, files
+
+
+def all_document_ids(analyses_dir, files):
+    return [doc_id for schema_file in files
+            for doc_id, _, _, _ in vectorize.iter_side_index_documents(
+                vectorize.load_manga_schema_file(str(analyses_dir / schema_file)))]
+
+
+def test_side_indexes_are_written_in_segments(library):
+    tmp_path, analyses_dir, files = library
+    chroma_path = tmp_path / "chroma"
+    # 7 documents per book: 1 book, 3 pages, 3 panels
+    vectorize.build_side_indexes(str(chroma_path), str(analyses_dir), files, 1, segment_docs=10)
+
+    lexical = LexicalIndex(str(chroma_path / LEXICAL_INDEX_DIR))
+    entities = EntityIndex(str(chroma_path / ENTITY_INDEX_DIR))
+    assert len(lexical.segments) == 3
+    assert entities.meta["segments"] == 3
+    assert [doc_id for segment in lexical.segments for doc_id in segment.ids] == all_document_ids(analyses_dir, files)
+    assert entities.ids == all_document_ids(analyses_dir, files)
+    assert [doc_id for doc_id, _ in lexical.search(["hello book4"], 3, level="panel")[0]][0].startswith("book4_")
+    assert entities.match({"character": ("book2 hero",)}, level="page") == [f"book2_page_{p}" for p in (1, 2, 3)]
+
+    # Up to date: nothing is rewritten
+    meta_file = chroma_path / LEXICAL_INDEX_DIR / "meta.json"
+    mtime = meta_file.stat().st_mtime_ns
+    vectorize.build_side_indexes(str(chroma_path), str(analyses_dir), files, 1, segment_docs=10)
+    assert meta_file.stat().st_mtime_ns == mtime
+
+
+def test_sharded_side_indexes_stream_each_shard(library):
+    tmp_path, analyses_dir, files = library
+    chroma_path = tmp_path / "chroma"
+    shard_files = [files[0:1], files[1:4], [], files[4:6]]
+    vectorize.build_side_indexes(str(chroma_path), str(analyses_dir), files, 2, shard_files=shard_files)
+
+    lexical = LexicalIndex(str(chroma_path / LEXICAL_INDEX_DIR))
+    # One segment per non-empty shard, holding exactly that shard's documents
+    assert [segment.ids for segment in lexical.segments] == [
+        all_document_ids(analyses_dir, shard) for shard in shard_files if shard]
+    assert EntityIndex(str(chroma_path / ENTITY_INDEX_DIR)).meta["segments"] == 3
+    assert len(lexical.search(["shaaake"], 100, level="panel")[0]) == 6  # the first panel of every book
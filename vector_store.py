@@ -0,0 +1,415 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from checkpoint import write_json_atomic
+from index_manifest import load_index_manifest
+
+# 检索后端："chroma"（默认）或 "numpy"（内存映射矩阵上的精确检索）
+VECTOR_STORE = os.getenv("VECTOR_STORE", "chroma")
+NUMPY_STORE_DIR = "numpy_store"
+
+# NumPy 后端的压缩模式："none"、"float16" 或 "int8"；首轮用压缩向量检索，候选数为 k * RESCORE_FACTOR，
+# 再用内存映射的 float32 向量精确重排
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none")
+RESCORE_FACTOR = int(os.getenv("RESCORE_FACTOR", "4"))
+# Bumped whenever the store layout changes, so vectorize.py re-exports older stores
+STORE_FORMAT = 2
+# Quantized rows are widened to float32 in blocks of this many rows, bounding temporary memory
+SCORE_BLOCK_ROWS = 65536
+
+# Document levels written by vectorize.py
+LEVELS = ("book", "page", "panel")
+
+# 分片索引：vectorize.py 按书名哈希把书分到各分片集合（<chroma_path>/shard_NN），shards.json 记录分片数；
+# 查询时各分片在独立进程中并行检索，再合并每个分片的前 k 条。SHARD_WORKERS 为 0 时每个分片一个进程
+SHARDS_FILE = "shards.json"
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+
+
+def shard_for_title(title, num_shards):
+    """Shard of a book; a stable hash, so a book stays in its shard across runs."""
+    return int(hashlib.md5(title.encode("utf-8")).hexdigest(), 16) % num_shards
+
+
+def shard_path(chroma_path, shard):
+    return os.path.join(chroma_path, f"shard_{shard:02d}")
+
+
+def read_shard_count(chroma_path):
+    """Number of shards of the index in chroma_path (1 when it is not sharded)."""
+    try:
+        with open(os.path.join(chroma_path, SHARDS_FILE), "r", encoding="utf-8") as f:
+            return int(json.load(f)["shards"])
+    except (OSError, ValueError, KeyError):
+        return 1
+
+
+class VectorStore:
+    """
+    What MangaRetrieval needs from a vector index.
+
+    query() returns results shaped like chromadb's collection.query: a dict of "ids",
+    "metadatas", "documents" and "distances", each holding one list per query embedding.
+    With ids, only those documents are searched (pre-filtering), and fewer than n_results
+    may come back.
+    get() returns the "ids", "metadatas" and "documents" of the given ids that exist, like
+    collection.get.
+    """
+    exists = False
+    count = 0
+    level_counts = {}
+
+    def query(self, query_embeddings, n_results, level=None, ids=None):
+        raise NotImplementedError
+
+    def get(self, ids):
+        raise NotImplementedError
+
+
+class ChromaVectorStore(VectorStore):
+    """The Chroma collection, through the cached collection state of MangaRetrieval."""
+
+    def __init__(self, collection_state):
+        self.state = collection_state
+        self.exists = collection_state.exists
+        self.count = collection_state.count
+        self.level_counts = collection_state.level_counts
+
+    def query(self, query_embeddings, n_results, level=None, ids=None):
+        return self.state.collection.query(
+            query_embeddings=query_embeddings,
+            ids=list(ids) if ids is not None else None,
+            n_results=n_results,
+            where={"level": level} if level else None,
+            include=["metadatas", "documents", "distances"]
+        )
+
+    def get(self, ids):
+        return self.state.collection.get(ids=list(ids), include=["metadatas", "documents"])
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Exact search over all embeddings with one matrix multiply.
+
+    Layout:
+        <path>/meta.json     {"dim", "count", "space", "index_version", "format"}, written last
+        <path>/vectors.f32   float32 matrix, one row per document, opened as a memmap
+        <path>/vectors.f16   the same matrix as float16
+        <path>/vectors.i8    the same matrix as int8, one symmetric scale per row in scales.f32
+        <path>/norms.f32     squared L2 norm of each float32 row
+        <path>/records.json  {"ids", "metadatas", "documents"} in row order
+        <path>/levels.npz    row indices of each level, used as precomputed level masks
+
+    Distances use the same space as the Chroma collection ("l2" is squared L2), so
+    results and similarity scores are interchangeable with ChromaVectorStore.
+
+    With quantization "float16" or "int8" only the quantized matrix is loaded into memory.
+    Each query is scored against it first, and only the k * rescore_factor best rows are
+    read from the float32 memmap and re-scored exactly.
+    """
+
+    def __init__(self, path, quantization=VECTOR_QUANTIZATION, rescore_factor=RESCORE_FACTOR):
+        self.path = path
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.space = self.meta.get("space", "l2")
+        self.index_version = self.meta.get("index_version")
+        self.dim = self.meta["dim"]
+        self.count = self.meta["count"]
+        self.exists = True
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r",
+                                 shape=(self.count, self.dim)) if self.count else np.zeros((0, self.dim), np.float32)
+        with open(os.path.join(path, "records.json"), "r", encoding="utf-8") as f:
+            records = json.load(f)
+        self.ids = records["ids"]
+        self.metadatas = records["metadatas"]
+        self.documents = records["documents"]
+        with np.load(os.path.join(path, "levels.npz")) as levels:
+            self.level_rows = {level: levels[level] for level in levels.files}
+        self.level_counts = {level: len(rows) for level, rows in self.level_rows.items()}
+        self.squared_norms = np.fromfile(os.path.join(path, "norms.f32"), dtype=np.float32)
+        self.row_of_id = None
+
+        self.quantized = None
+        self.scales = None
+        if quantization == "float16":
+            self.quantized = np.fromfile(os.path.join(path, "vectors.f16"), dtype=np.float16).reshape(self.count, self.dim)
+        elif quantization == "int8":
+            self.quantized = np.fromfile(os.path.join(path, "vectors.i8"), dtype=np.int8).reshape(self.count, self.dim)
+            self.scales = np.fromfile(os.path.join(path, "scales.f32"), dtype=np.float32)
+        elif quantization != "none":
+            raise ValueError(f"Unknown quantization: {quantization}")
+
+    def memory_bytes(self):
+        """Bytes of vector data kept in memory for the first-pass search (the float32 memmap is not counted when quantized)."""
+        resident = self.squared_norms.nbytes
+        if self.quantized is None:
+            return resident + self.count * self.dim * 4
+        return resident + self.quantized.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def query(self, query_embeddings, n_results, level=None, ids=None):
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim)
+        rows = self.level_rows.get(level, np.zeros(0, dtype=np.int64)) if level else None
+        if ids is not None:
+            row_of_id = self._row_of_id()
+            id_rows = np.array(sorted(row_of_id[doc_id] for doc_id in ids if doc_id in row_of_id), dtype=np.int64)
+            rows = id_rows if rows is None else np.intersect1d(rows, id_rows)
+        num_rows = len(rows) if rows is not None else self.count
+        k = min(n_results, num_rows)
+
+        if self.quantized is None:
+            # Only the rows of the level (or allowed ids) are read and multiplied
+            scores = queries @ (self.vectors if rows is None else np.asarray(self.vectors[rows])).T
+            distances = self._distances(scores, queries, self.squared_norms if rows is None else self.squared_norms[rows])
+            shortlists = None
+        else:
+            distances = self._distances(self._approx_scores(queries, rows), queries,
+                                        self.squared_norms if rows is None else self.squared_norms[rows])
+            shortlist_size = min(max(k * self.rescore_factor, k), num_rows)
+            shortlists = [self._top(distances[q], shortlist_size) for q in range(len(queries))]
+
+        results = {"ids": [], "metadatas": [], "documents": [], "distances": []}
+        for q in range(len(queries)):
+            if shortlists is None:
+                top = self._top(distances[q], k)
+                row_ids = rows[top] if rows is not None else top
+                top_distances = distances[q][top]
+            else:
+                # Re-score the shortlist against the full-precision vectors
+                candidates = shortlists[q]
+                row_ids = np.sort(rows[candidates] if rows is not None else candidates)
+                exact_scores = np.asarray(self.vectors[row_ids]) @ queries[q]
+                exact = self._distances(exact_scores[None, :], queries[q:q + 1], self.squared_norms[row_ids])[0]
+                top = self._top(exact, k)
+                row_ids = row_ids[top]
+                top_distances = exact[top]
+            results["ids"].append([self.ids[r] for r in row_ids])
+            results["metadatas"].append([self.metadatas[r] for r in row_ids])
+            results["documents"].append([self.documents[r] for r in row_ids])
+            results["distances"].append(top_distances.tolist())
+        return results
+
+    def _row_of_id(self):
+        if self.row_of_id is None:
+            self.row_of_id = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        return self.row_of_id
+
+    def get(self, ids):
+        row_of_id = self._row_of_id()
+        rows = [row_of_id[doc_id] for doc_id in ids if doc_id in row_of_id]
+        return {
+            "ids": [self.ids[r] for r in rows],
+            "metadatas": [self.metadatas[r] for r in rows],
+            "documents": [self.documents[r] for r in rows],
+        }
+
+    @staticmethod
+    def _top(distances, k):
+        """Indices of the k smallest distances, closest first."""
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        top = np.argpartition(distances, k - 1)[:k]
+        return top[np.argsort(distances[top])]
+
+    def _approx_scores(self, queries, rows):
+        """Dot products against the quantized vectors, widened to float32 block by block."""
+        quantized = self.quantized if rows is None else self.quantized[rows]
+        scales = None if self.scales is None else (self.scales if rows is None else self.scales[rows])
+        scores = np.empty((len(queries), len(quantized)), dtype=np.float32)
+        for start in range(0, len(quantized), SCORE_BLOCK_ROWS):
+            block = quantized[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        if scales is not None:
+            scores *= scales[None, :]
+        return scores
+
+    def _distances(self, scores, queries, squared_norms):
+        if self.space == "ip":
+            return 1.0 - scores
+        query_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+        if self.space == "cosine":
+            denominator = np.sqrt(query_norms) * np.sqrt(squared_norms)[None, :]
+            return 1.0 - scores / np.maximum(denominator, 1e-12)
+        return np.maximum(query_norms + squared_norms[None, :] - 2.0 * scores, 0.0)
+
+    @staticmethod
+    def stored_index_version(path):
+        """Index version a store was exported from, or None if there is no complete store."""
+        try:
+            with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta.get("index_version") if meta.get("format") == STORE_FORMAT else None
+
+    @staticmethod
+    def write(path, ids, embeddings, metadatas, documents, space="l2", index_version=None):
+        """
+        Write a store; meta.json goes last, so readers never see a half-written store
+        as complete.
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_file = os.path.join(path, "meta.json")
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        dim = int(embeddings.shape[1]) if len(embeddings) else 0
+
+        max_abs = np.abs(embeddings).max(axis=1) if len(embeddings) else np.zeros(0, dtype=np.float32)
+        scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+        arrays = {
+            "vectors.f32": embeddings,
+            "vectors.f16": embeddings.astype(np.float16),
+            "vectors.i8": np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8),
+            "scales.f32": scales,
+            "norms.f32": np.einsum("ij,ij->i", embeddings, embeddings).astype(np.float32),
+        }
+        for name, array in arrays.items():
+            tmp_path = os.path.join(path, f"{name}.{os.getpid()}.tmp")
+            array.tofile(tmp_path)
+            os.replace(tmp_path, os.path.join(path, name))
+        write_json_atomic(os.path.join(path, "records.json"),
+                          {"ids": list(ids), "metadatas": list(metadatas), "documents": list(documents)})
+        level_of_row = np.array([(m or {}).get("level", "") for m in metadatas])
+        tmp_path = os.path.join(path, f"levels.{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, **{level: np.flatnonzero(level_of_row == level) for level in LEVELS})
+        os.replace(tmp_path, os.path.join(path, "levels.npz"))
+        write_json_atomic(meta_file, {
+            "dim": dim,
+            "count": len(ids),
+            "space": space,
+            "index_version": index_version,
+            "format": STORE_FORMAT,
+        })
+
+
+# Collections opened by a shard worker process, by shard path
+_shard_collections = {}
+
+
+def _shard_collection(path):
+    collection = _shard_collections.get(path)
+    if collection is None:
+        import chromadb
+        collection = chromadb.PersistentClient(path=path).get_collection("manga_collection")
+        _shard_collections[path] = collection
+    return collection
+
+
+def _shard_stats(path):
+    """(count, per-level counts) of one shard, run in a shard worker."""
+    try:
+        collection = _shard_collection(path)
+    except Exception:
+        return 0, {}
+    count = collection.count()
+    return count, {
+        level: len(collection.get(where={"level": level}, include=[])["ids"]) if count else 0
+        for level in LEVELS
+    }
+
+
+def _query_shard(path, query_embeddings, n_results, level, ids):
+    return _shard_collection(path).query(
+        query_embeddings=query_embeddings,
+        ids=ids,
+        n_results=n_results,
+        where={"level": level} if level else None,
+        include=["metadatas", "documents", "distances"]
+    )
+
+
+def _get_from_shard(path, ids):
+    return _shard_collection(path).get(ids=ids, include=["metadatas", "documents"])
+
+
+class ShardedVectorStore(VectorStore):
+    """
+    Scatter-gather search over the shard collections written by vectorize.py with INDEX_SHARDS > 1.
+
+    Every query batch is sent to all shards at once; each shard is searched by a worker
+    process that keeps its Chroma client open, and the per-shard top-k lists are merged
+    by distance. All shards use the same embedding model and space, so their distances
+    are comparable.
+
+    Shard i always goes to worker i % workers, so each worker opens only its own shards.
+    Pre-filtered searches send each shard only the allowed ids it holds, looked up in the
+    shard manifests; Chroma rejects ids it does not have.
+    """
+
+    def __init__(self, chroma_path, num_shards, workers=SHARD_WORKERS):
+        self.paths = [shard_path(chroma_path, shard) for shard in range(num_shards)]
+        # One single-process pool per worker; spawn: the caller may have threads running,
+        # and forking those is unsafe
+        context = multiprocessing.get_context("spawn")
+        self.executors = [ProcessPoolExecutor(max_workers=1, mp_context=context)
+                          for _ in range(min(workers or num_shards, num_shards))]
+        self.shard_stats = [future.result() for future in
+                            [self._submit(shard, _shard_stats, path) for shard, path in enumerate(self.paths)]]
+        self.count = sum(count for count, _ in self.shard_stats)
+        self.exists = self.count > 0
+        self.level_counts = {level: sum(levels.get(level, 0) for _, levels in self.shard_stats) for level in LEVELS}
+        self.shard_of_id = {}
+        for shard, path in enumerate(self.paths):
+            manifest = load_index_manifest(path) or {"files": {}}
+            for entry in manifest["files"].values():
+                self.shard_of_id.update(dict.fromkeys(entry["ids"], shard))
+
+    def _submit(self, shard, fn, *args):
+        return self.executors[shard % len(self.executors)].submit(fn, *args)
+
+    def _split_ids(self, ids):
+        """The given ids grouped by the shard holding them; unknown ids are dropped."""
+        shard_ids = [[] for _ in self.paths]
+        for doc_id in ids:
+            shard = self.shard_of_id.get(doc_id)
+            if shard is not None:
+                shard_ids[shard].append(doc_id)
+        return shard_ids
+
+    def query(self, query_embeddings, n_results, level=None, ids=None):
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32).tolist()
+        shard_ids = self._split_ids(ids) if ids is not None else [None] * len(self.paths)
+        futures = []
+        for shard, (path, (count, levels)) in enumerate(zip(self.paths, self.shard_stats)):
+            available = levels.get(level, 0) if level else count
+            if shard_ids[shard] is not None:
+                available = min(available, len(shard_ids[shard]))
+            if available:
+                futures.append(self._submit(shard, _query_shard, path, query_embeddings,
+                                            min(n_results, available), level, shard_ids[shard]))
+        shard_results = [future.result() for future in futures]
+
+        results = {"ids": [], "metadatas": [], "documents": [], "distances": []}
+        for q in range(len(query_embeddings)):
+            merged = []
+            for shard_result in shard_results:
+                merged.extend(zip(shard_result["distances"][q], shard_result["ids"][q],
+                                  shard_result["metadatas"][q], shard_result["documents"][q]))
+            merged.sort(key=lambda row: row[0])
+            merged = merged[:n_results]
+            results["distances"].append([row[0] for row in merged])
+            results["ids"].append([row[1] for row in merged])
+            results["metadatas"].append([row[2] for row in merged])
+            results["documents"].append([row[3] for row in merged])
+        return results
+
+    def get(self, ids):
+        futures = [self._submit(shard, _get_from_shard, path, shard_ids)
+                   for shard, (path, shard_ids) in enumerate(zip(self.paths, self._split_ids(ids))) if shard_ids]
+        results = {"ids": [], "metadatas": [], "documents": []}
+        for future in futures:
+            shard_result = future.result()
+            for key in results:
+                results[key].extend(shard_result[key])
+        return results
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False)
@@ -1,39 +1,287 @@
 import os
 import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import chromadb
 from chromadb.utils import embedding_functions
 import uuid
+from index_manifest import load_index_manifest, save_index_manifest
+from vector_store import (NumpyVectorStore, NUMPY_STORE_DIR, SHARDS_FILE, read_shard_count, shard_for_title,
+                          shard_path)
+from checkpoint import write_json_atomic
+from embedding_cache import EmbeddingCache, EMBEDDING_MODEL_ID
+from lexical_index import LexicalIndex, LexicalIndexWriter, LEXICAL_INDEX_DIR, LEXICAL_SEARCH
+from entity_index import EntityIndex, EntityIndexWriter, ENTITY_INDEX_DIR, ENTITY_FIELDS
 
-def load_manga_schema_files(manga_root_folder="./manga_images"):
+# Documents are built lazily and written to the collection in batches of this size
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "1024"))
+
+# Embedding stage: documents per model call, worker processes, and ONNX threads per worker (0 = ONNX default)
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "0")) or os.cpu_count()
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "1"))
+
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "1") == "1"
+
+# Number of shard collections; 1 keeps the single collection in the Chroma directory
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+
+# The BM25 and entity indexes are written in segments of this many documents, bounding the memory of a build
+SIDE_INDEX_SEGMENT_DOCS = int(os.getenv("SIDE_INDEX_SEGMENT_DOCS", "50000"))
+
+# Also export the index to the NumPy vector store (done anyway once the store exists)
+EXPORT_NUMPY_STORE = os.getenv("EXPORT_NUMPY_STORE", "0") == "1"
+
+def get_analyses_dir(manga_root_folder="./manga_images"):
     """
-    Load all manga schema files from the manga_analyses folder
+    The manga_analyses folder that sits next to manga_images
     """
-    analyses_dir = os.path.join(manga_root_folder, "..", "manga_analyses")
-    
-    # Get all files ending with _schema.json
-    schema_files = [f for f in os.listdir(analyses_dir) if f.endswith("_schema.json")]
+    return os.path.join(manga_root_folder, "..", "manga_analyses")
+
+def list_schema_files(manga_root_folder="./manga_images"):
+    """
+    Get all files ending with _schema.json, sorted by name
+    """
+    analyses_dir = get_analyses_dir(manga_root_folder)
+    return sorted(f for f in os.listdir(analyses_dir) if f.endswith("_schema.json"))
+
+def load_manga_schema_file(manga_file):
+    """
+    Load one schema file as {"title": ..., "data": ...}, or None if it is missing
+    """
+    manga_title = os.path.basename(manga_file).replace("_schema.json", "")
+    try:
+        with open(manga_file, 'r', encoding='utf-8') as f:
+            manga_data = json.load(f)
+    except FileNotFoundError:
+        print(f"Warning: Schema file for {manga_title} not found")
+        return None
+    print(f"Loaded schema data for manga: {manga_title}")
+    return {
+        "title": manga_title,
+        "data": manga_data
+    }
+
+def iter_manga_schema_files(manga_root_folder="./manga_images"):
+    """
+    Yield manga schema files from the manga_analyses folder one at a time
+    """
+    analyses_dir = get_analyses_dir(manga_root_folder)
+    schema_files = list_schema_files(manga_root_folder)
     print(f"Found {len(schema_files)} manga schema files to process")
     
-    all_manga_data = []
-    
     # Process each schema file
     for schema_file in schema_files:
-        manga_file = os.path.join(analyses_dir, schema_file)
-        manga_title = schema_file.replace("_schema.json", "")
-        
-        try:
-            with open(manga_file, 'r', encoding='utf-8') as f:
-                manga_data = json.load(f)
-                all_manga_data.append({
-                    "title": manga_title,
-                    "data": manga_data
-                })
-                print(f"Loaded schema data for manga: {manga_title}")
-        except FileNotFoundError:
-            print(f"Warning: Schema file for {manga_title} not found")
-            continue
+        manga = load_manga_schema_file(os.path.join(analyses_dir, schema_file))
+        if manga is not None:
+            yield manga
+
+def load_manga_schema_files(manga_root_folder="./manga_images"):
+    """
+    Load all manga schema files from the manga_analyses folder
+    """
+    return list(iter_manga_schema_files(manga_root_folder))
+
+def file_hash(path):
+    """
+    SHA-256 of a schema file, used to detect changed books
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def iter_manga_documents(manga):
+    """
+    Yield (document, metadata, id) for one manga at book, page, and panel levels
+    """
+    manga_title = manga["title"]
+    manga_obj = manga["data"]
+    if not manga_obj:
+        return
+    # Create a book-level document
+    book_summary = manga_obj.get("summary", "")
+    if book_summary:
+        book_doc = f"Manga: {manga_obj['manga_name']}. Summary: {book_summary}"
+        yield book_doc, {
+            "manga_title": manga_title,
+            "type": "book_summary",
+            "level": "book"
+        }, f"{manga_title}_book"
     
-    return all_manga_data
+    # Create page-level documents
+    for page_index, page in enumerate(manga_obj.get("pages", [])):
+        page_number = page.get("page_number", "unknown")
+        page_summary = page.get("summary", "")
+        
+        # Create a descriptive page-level document
+        page_doc = f"Manga: {manga_obj['manga_name']}. Page {page_number}. {page_summary}"
+        yield page_doc, {
+            "manga_title": manga_title,
+            "type": "page",
+            "page_number": page_number,
+            "level": "page",
+            "image_path": page.get("image_path", "")
+        }, f"{manga_title}_page_{page_index+1}"
+        
+        # Create panel-level documents
+        for panel_idx, panel in enumerate(page.get("panels", [])):
+            panel_id = panel.get("panel_id", f"{panel_idx+1}")
+            panel_summary = panel.get("summary", "")
+            
+            # Combine character information
+            characters_text = ""
+            for char in panel.get("characters", []):
+                char_name = char.get("name", "")
+                char_expr = char.get("expression", "")
+                char_pose = char.get("pose", "")
+                if char_name:
+                    characters_text += f"{char_name} with {char_expr} expression, {char_pose}. "
+            
+            # Combine setting information
+            setting = panel.get("setting", {})
+            location = setting.get("location", "")
+            bg_elements = ", ".join(setting.get("background_elements", []))
+            setting_text = f"Location: {location}. Background elements: {bg_elements}. "
+            
+            # Combine narrative information
+            narrative = panel.get("narrative", {})
+            actions = ", ".join(narrative.get("actions", []))
+            dialogue = ". ".join(narrative.get("dialogue", []))
+            emotion = narrative.get("emotion", "")
+            narrative_text = f"Actions: {actions}. Dialogue: {dialogue}. Emotion: {emotion}. "
+            
+            # Combine text elements
+            text_elements = ", ".join(panel.get("text_elements", []))
+            text_elements_text = f"Text elements: {text_elements}. " if text_elements else ""
+            
+            # Create a descriptive panel-level document
+            panel_doc = f"Manga: {manga_obj['manga_name']}. Page {page_number}, Panel {panel_id}. {panel_summary} {characters_text}{setting_text}{narrative_text}{text_elements_text}"
+            yield panel_doc, {
+                "manga_title": manga_title,
+                "type": "panel",
+                "page_number": page_number,
+                "panel_id": panel_id,
+                "level": "panel",
+                "image_path": page.get("image_path", "")
+            }, f"{manga_title}_page_{page_index+1}_panel_{panel_id}"
+
+def iter_side_index_documents(manga):
+    """
+    Yield (id, level, text, entities) for the lexical and entity indexes of one manga.
+
+    text holds the dialogue, text elements and character names of a panel; entities maps
+    "character", "location" and "emotion" to the values of the panel's schema fields.
+    Pages get the text and entities of all their panels and the book those of all pages;
+    ids are the same as in iter_manga_documents.
+    """
+    manga_title = manga["title"]
+    manga_obj = manga["data"]
+    if not manga_obj:
+        return
+    book_texts = []
+    book_entities = {field: [] for field in ENTITY_FIELDS}
+    for page_index, page in enumerate(manga_obj.get("pages", [])):
+        page_texts = []
+        page_entities = {field: [] for field in ENTITY_FIELDS}
+        for panel_idx, panel in enumerate(page.get("panels", [])):
+            panel_id = panel.get("panel_id", f"{panel_idx+1}")
+            names = [char.get("name", "") for char in panel.get("characters", []) if char.get("name", "")]
+            narrative = panel.get("narrative", {})
+            panel_text = " ".join(narrative.get("dialogue", []) + panel.get("text_elements", []) + names)
+            panel_entities = {
+                "character": names,
+                "location": [panel.get("setting", {}).get("location", "")],
+                "emotion": [narrative.get("emotion", "")],
+            }
+            page_texts.append(panel_text)
+            for field, values in panel_entities.items():
+                page_entities[field].extend(values)
+            yield f"{manga_title}_page_{page_index+1}_panel_{panel_id}", "panel", panel_text, panel_entities
+        page_text = " ".join(page_texts)
+        book_texts.append(page_text)
+        for field, values in page_entities.items():
+            book_entities[field].extend(values)
+        yield f"{manga_title}_page_{page_index+1}", "page", page_text, page_entities
+    if manga_obj.get("summary", ""):
+        yield f"{manga_title}_book", "book", " ".join(book_texts), book_entities
+
+def build_side_indexes(chroma_path, analyses_dir, schema_files, index_version, segment_docs=SIDE_INDEX_SEGMENT_DOCS,
+                       shard_files=None):
+    """
+    Rebuild the BM25 and entity indexes over all books where they are older than index_version.
+    Only text is read, so a full rebuild after each indexing run is cheap compared with embedding.
+    Documents are streamed book by book into the index writers, which keep one segment in memory.
+
+    Args:
+        shard_files: for a sharded index, the schema files of each shard; every shard is then
+            streamed on its own and ends a segment, so a segment never spans shards
+    """
+    lexical_dir = os.path.join(chroma_path, LEXICAL_INDEX_DIR)
+    entity_dir = os.path.join(chroma_path, ENTITY_INDEX_DIR)
+    build_lexical = LEXICAL_SEARCH and LexicalIndex.stored_index_version(lexical_dir) != index_version
+    build_entities = EntityIndex.stored_index_version(entity_dir) != index_version
+    if not (build_lexical or build_entities):
+        return
+
+    writers = []
+    if build_lexical:
+        lexical_writer = LexicalIndexWriter(lexical_dir, index_version=index_version)
+        writers.append(lexical_writer)
+    if build_entities:
+        entity_writer = EntityIndexWriter(entity_dir, index_version=index_version)
+        writers.append(entity_writer)
+    for files in shard_files or [schema_files]:
+        segment_count = 0
+        for schema_file in files:
+            manga = load_manga_schema_file(os.path.join(analyses_dir, schema_file))
+            if manga is None:
+                continue
+            for doc_id, level, text, doc_entities in iter_side_index_documents(manga):
+                if build_lexical:
+                    lexical_writer.add(doc_id, level, text)
+                if build_entities:
+                    entity_writer.add(doc_id, level, doc_entities)
+                segment_count += 1
+            # Segments end between books, so a book's documents stay together
+            if segment_count >= segment_docs:
+                for writer in writers:
+                    writer.flush()
+                segment_count = 0
+        for writer in writers:
+            writer.flush()
+    for writer in writers:
+        writer.close()
+    if build_lexical:
+        print(f"Built lexical index over {lexical_writer.count} documents in {lexical_writer.segments} segments")
+    if build_entities:
+        print(f"Built entity index over {entity_writer.count} documents in {entity_writer.segments} segments")
+
+def iter_documents_from_manga_schema(manga_data):
+    """
+    Stream (document, metadata, id) for every manga, checking ids with a running set
+    """
+    seen_ids = set()
+    for manga in manga_data:
+        for document, metadata, doc_id in iter_manga_documents(manga):
+            if doc_id in seen_ids:
+                raise ValueError(f"Duplicate IDs found: {[doc_id]}")
+            seen_ids.add(doc_id)
+            yield document, metadata, doc_id
+
+def batch_documents(document_stream, batch_size=UPSERT_BATCH_SIZE):
+    """
+    Group a (document, metadata, id) stream into (documents, metadatas, ids) batches
+    """
+    documents, metadatas, ids = [], [], []
+    for document, metadata, doc_id in document_stream:
+        documents.append(document)
+        metadatas.append(metadata)
+        ids.append(doc_id)
+        if len(ids) >= batch_size:
+            yield documents, metadatas, ids
+            documents, metadatas, ids = [], [], []
+    if ids:
+        yield documents, metadatas, ids
 
 def create_documents_from_manga_schema(manga_data):
     """
@@ -42,109 +290,160 @@ def create_documents_from_manga_schema(manga_data):
     documents = []
     metadatas = []
     ids = []
-    
-    for manga in manga_data:
-        manga_title = manga["title"]
-        manga_obj = manga["data"]
-        if manga_obj:
-            # Create a book-level document
-            book_summary = manga_obj.get("summary", "")
-            if book_summary:
-                book_doc = f"Manga: {manga_obj['manga_name']}. Summary: {book_summary}"
-                documents.append(book_doc)
-                metadatas.append({
-                    "manga_title": manga_title,
-                    "type": "book_summary",
-                    "level": "book"
-                })
-                ids.append(f"{manga_title}_book")
-            
-            # Create page-level documents
-            for page_index, page in enumerate(manga_obj.get("pages", [])):
-                page_number = page.get("page_number", "unknown")
-                page_summary = page.get("summary", "")
-                
-                # Create a descriptive page-level document
-                page_doc = f"Manga: {manga_obj['manga_name']}. Page {page_number}. {page_summary}"
-                documents.append(page_doc)
-                metadatas.append({
-                    "manga_title": manga_title,
-                    "type": "page",
-                    "page_number": page_number,
-                    "level": "page",
-                    "image_path": page.get("image_path", "")
-                })
-                ids.append(f"{manga_title}_page_{page_index+1}")
-                
-                # Create panel-level documents
-                for panel_idx, panel in enumerate(page.get("panels", [])):
-                    panel_id = panel.get("panel_id", f"{panel_idx+1}")
-                    panel_summary = panel.get("summary", "")
-                    
-                    # Combine character information
-                    characters_text = ""
-                    for char in panel.get("characters", []):
-                        char_name = char.get("name", "")
-                        char_expr = char.get("expression", "")
-                        char_pose = char.get("pose", "")
-                        if char_name:
-                            characters_text += f"{char_name} with {char_expr} expression, {char_pose}. "
-                    
-                    # Combine setting information
-                    setting = panel.get("setting", {})
-                    location = setting.get("location", "")
-                    bg_elements = ", ".join(setting.get("background_elements", []))
-                    setting_text = f"Location: {location}. Background elements: {bg_elements}. "
-                    
-                    # Combine narrative information
-                    narrative = panel.get("narrative", {})
-                    actions = ", ".join(narrative.get("actions", []))
-                    dialogue = ". ".join(narrative.get("dialogue", []))
-                    emotion = narrative.get("emotion", "")
-                    narrative_text = f"Actions: {actions}. Dialogue: {dialogue}. Emotion: {emotion}. "
-                    
-                    # Combine text elements
-                    text_elements = ", ".join(panel.get("text_elements", []))
-                    text_elements_text = f"Text elements: {text_elements}. " if text_elements else ""
-                    
-                    # Create a descriptive panel-level document
-                    panel_doc = f"Manga: {manga_obj['manga_name']}. Page {page_number}, Panel {panel_id}. {panel_summary} {characters_text}{setting_text}{narrative_text}{text_elements_text}"
-                    documents.append(panel_doc)
-                    metadatas.append({
-                        "manga_title": manga_title,
-                        "type": "panel",
-                        "page_number": page_number,
-                        "panel_id": panel_id,
-                        "level": "panel",
-                        "image_path": page.get("image_path", "")
-                    })
-                    ids.append(f"{manga_title}_page_{page_index+1}_panel_{panel_id}")
-        if len(set(ids)) != len(ids):
-            print(ids)
-            duplicate_ids = [id for id in ids if ids.count(id) > 1]
-            raise ValueError(f"Duplicate IDs found: {duplicate_ids[:5]}")
+    for document, metadata, doc_id in iter_documents_from_manga_schema(manga_data):
+        documents.append(document)
+        metadatas.append(metadata)
+        ids.append(doc_id)
     return documents, metadatas, ids
 
-def vectorize_manga_schemas(chroma_path="_chroma"):
+# Maximum tokens per document, as in chromadb's all-MiniLM-L6-v2 embedding function
+EMBEDDING_MAX_TOKENS = 256
+
+def embedding_model_dir():
+    """Directory of the ONNX model files, downloaded by chromadb's embedding function if missing."""
+    model_dir = os.path.join(embedding_functions.ONNXMiniLM_L6_V2.DOWNLOAD_PATH,
+                             embedding_functions.ONNXMiniLM_L6_V2.EXTRACTED_FOLDER_NAME)
+    if not os.path.exists(os.path.join(model_dir, "model.onnx")):
+        # chromadb downloads and verifies the model on first use
+        embedding_functions.ONNXMiniLM_L6_V2()(["download"])
+    return model_dir
+
+class MiniLMEmbedder:
     """
-    Vectorize manga schema data and store in ChromaDB
+    The collection's default embedding model (all-MiniLM-L6-v2, ONNX), run directly.
+
+    chromadb's embedding function pads every document to 256 tokens; this one pads each
+    batch only to its longest document, which is what makes length-bucketed batches
+    cheaper. Mean pooling is masked, so the embeddings are the same either way. Only the
+    model files chromadb downloads are shared with it, so changes to chromadb internals
+    fail loudly here instead of silently changing how documents are embedded.
+    """
+
+    def __init__(self, threads=EMBEDDING_THREADS):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_dir = embedding_model_dir()
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=EMBEDDING_MAX_TOKENS)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        so = onnxruntime.SessionOptions()
+        so.log_severity_level = 3
+        so.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            so.intra_op_num_threads = threads
+            so.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, "model.onnx"),
+                                                    providers=["CPUExecutionProvider"], sess_options=so)
+
+    def __call__(self, documents):
+        encoded = self.tokenizer.encode_batch(documents)
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        last_hidden_state = self.session.run(None, {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids),
+        })[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        embeddings = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1e-12
+        return (embeddings / norms).astype(np.float32)
+
+# Embedding function of the current worker process, set by _init_embedding_worker
+_worker_embedding_function = None
+
+def _init_embedding_worker(threads=EMBEDDING_THREADS):
+    """Load the embedding model once per process."""
+    global _worker_embedding_function
+    _worker_embedding_function = MiniLMEmbedder(threads)
+
+def _embed_batch(documents):
+    """Embed one batch in the current process."""
+    return np.asarray(_worker_embedding_function(documents), dtype=np.float32)
+
+class EmbeddingEngine:
+    """
+    Embeds documents with length-bucketed batches spread over a process pool.
+
+    Documents are sorted by length before batching, so each batch holds documents of
+    similar length and little work is spent on padding; results come back in input order.
+    With an EmbeddingCache only texts that were never embedded before reach the model,
+    and the model is not even loaded when everything is cached.
+
+    Usage:
+        with EmbeddingEngine(cache=EmbeddingCache(EMBEDDING_MODEL_ID)) as engine:
+            embeddings = engine.embed(documents)  # float32 array, one row per document
+    """
+
+    def __init__(self, batch_size=EMBEDDING_BATCH_SIZE, workers=EMBEDDING_WORKERS, threads=EMBEDDING_THREADS,
+                 cache=None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.threads = threads
+        self.cache = cache
+        self.executor = None
+        self.started = False
+
+    def __enter__(self):
+        return self
+
+    def _start(self):
+        self.started = True
+        if self.workers > 1:
+            # Download the model once here, not concurrently in every worker
+            embedding_model_dir()
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_embedding_worker,
+                initargs=(self.threads,),
+            )
+        else:
+            _init_embedding_worker(self.threads)
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def embed(self, documents):
+        if not documents:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.cache is None:
+            return self._embed_uncached(documents)
+
+        embeddings, missing = self.cache.lookup(documents)
+        if missing:
+            new_documents = [documents[i] for i in missing]
+            new_embeddings = self._embed_uncached(new_documents)
+            self.cache.store(new_documents, new_embeddings)
+            if embeddings is None:
+                return new_embeddings
+            embeddings[missing] = new_embeddings
+        return embeddings
+
+    def _embed_uncached(self, documents):
+        if not self.started:
+            self._start()
+        order = sorted(range(len(documents)), key=lambda i: len(documents[i]))
+        buckets = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        batches = [[documents[i] for i in bucket] for bucket in buckets]
+        if self.executor is not None:
+            results = list(self.executor.map(_embed_batch, batches))
+        else:
+            results = [_embed_batch(batch) for batch in batches]
+
+        embeddings = np.empty((len(documents), results[0].shape[1]), dtype=np.float32)
+        for bucket, result in zip(buckets, results):
+            embeddings[bucket] = result
+        return embeddings
+
+def get_or_create_manga_collection(chroma_client):
+    """
+    Get the manga collection, creating it with the default embedding function if needed
     """
-    # Load manga schema data
-    manga_data = load_manga_schema_files()
-    if not manga_data:
-        print("No manga schema data found to vectorize")
-        return
-    
-    # Create documents for vectorization
-    documents, metadatas, ids = create_documents_from_manga_schema(manga_data)
-    
-    print(f"Created {len(documents)} documents for vectorization")
-    for i in range(min(3, len(documents))):
-        print(f"Sample document {i+1}: {documents[i][:100]}...")
-    
-    # Initialize ChromaDB
-    chroma_client = chromadb.PersistentClient(path=chroma_path)
-    
     # Create or get collection
     try:
         # Try to get existing collection
@@ -159,15 +458,198 @@ def vectorize_manga_schemas(chroma_path="_chroma"):
             embedding_function=default_ef,
             metadata={"description": "Manga summaries collection"}
         )
-    
-    # Add documents to collection
-    if documents:
-        collection.add(
+    return collection
+
+def collection_space(collection):
+    """Distance space of a Chroma collection ("l2", "cosine" or "ip")."""
+    configuration = getattr(collection, "configuration_json", None) or {}
+    space = (configuration.get("hnsw") or {}).get("space")
+    return space or (collection.metadata or {}).get("hnsw:space", "l2")
+
+def export_numpy_store(collection, store_dir, index_version=None, page_size=UPSERT_BATCH_SIZE):
+    """
+    Copy every document, its metadata and its embedding from the collection into a NumpyVectorStore
+    """
+    ids, embeddings, metadatas, documents = [], [], [], []
+    total = collection.count()
+    for offset in range(0, total, page_size):
+        page = collection.get(include=["embeddings", "metadatas", "documents"], limit=page_size, offset=offset)
+        ids.extend(page["ids"])
+        embeddings.append(np.asarray(page["embeddings"], dtype=np.float32))
+        metadatas.extend(page["metadatas"])
+        documents.extend(page["documents"])
+    matrix = np.vstack(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+    NumpyVectorStore.write(store_dir, ids, matrix, metadatas, documents,
+                           space=collection_space(collection), index_version=index_version)
+    print(f"Exported {len(ids)} documents to NumPy vector store {store_dir}")
+
+def index_schema_files(chroma_path, analyses_dir, schema_files, engine):
+    """
+    Bring the collection in chroma_path in line with schema_files.
+
+    Indexing is incremental: a manifest of schema-file hashes records which ids each
+    book produced, so only new or changed books are re-embedded (with upsert), and ids
+    of removed books, or of pages/panels a book no longer has, are deleted.
+
+    Returns:
+        (collection, manifest, upserted, deleted)
+    """
+    # Initialize ChromaDB
+    chroma_client = chromadb.PersistentClient(path=chroma_path)
+    collection = get_or_create_manga_collection(chroma_client)
+
+    manifest = load_index_manifest(chroma_path)
+    unmanaged_ids = set()
+    if manifest is None:
+        # First incremental run over an existing collection: anything not re-produced below is stale
+        manifest = {"version": 0, "files": {}}
+        if collection.count() > 0:
+            unmanaged_ids = set(collection.get(include=[])["ids"])
+    indexed_files = manifest["files"]
+
+    changed = False
+    upserted = 0
+    deleted = 0
+    changed_files = {}  # manga title -> (schema file, hash)
+    for schema_file in schema_files:
+        current_hash = file_hash(os.path.join(analyses_dir, schema_file))
+        previous = indexed_files.get(schema_file)
+        if previous and previous["hash"] == current_hash:
+            unmanaged_ids -= set(previous["ids"])
+            continue
+        changed_files[schema_file.replace("_schema.json", "")] = (schema_file, current_hash)
+
+    # Books that could be loaded, including those that now yield no documents at all
+    loaded_titles = set()
+
+    def iter_changed_manga():
+        for schema_file, _ in changed_files.values():
+            manga = load_manga_schema_file(os.path.join(analyses_dir, schema_file))
+            if manga is not None:
+                loaded_titles.add(manga["title"])
+                yield manga
+
+    # Stream the documents of all changed books through the embedding engine batch by batch
+    new_ids = {title: [] for title in changed_files}
+    for documents, metadatas, ids in batch_documents(iter_documents_from_manga_schema(iter_changed_manga())):
+        collection.upsert(
+            ids=ids,
+            embeddings=engine.embed(documents),
             documents=documents,
-            metadatas=metadatas,
-            ids=ids
+            metadatas=metadatas
         )
-        print(f"Added {len(documents)} documents to ChromaDB collection")
+        upserted += len(ids)
+        for metadata, doc_id in zip(metadatas, ids):
+            new_ids[metadata["manga_title"]].append(doc_id)
+
+    for title, (schema_file, current_hash) in changed_files.items():
+        if title not in loaded_titles:
+            continue  # schema file vanished before it could be loaded
+        ids = new_ids[title]
+        previous = indexed_files.get(schema_file)
+
+        # Pages or panels that disappeared from a re-analysed book (all of them if it is now empty)
+        stale_ids = set(previous["ids"]) - set(ids) if previous else set()
+        if stale_ids:
+            collection.delete(ids=sorted(stale_ids))
+            deleted += len(stale_ids)
+        unmanaged_ids -= set(ids)
+        indexed_files[schema_file] = {"hash": current_hash, "ids": ids}
+        changed = True
+
+    # Books whose schema file was removed (or that now belong to another shard)
+    for schema_file in sorted(set(indexed_files) - set(schema_files)):
+        removed_ids = indexed_files.pop(schema_file)["ids"]
+        if removed_ids:
+            collection.delete(ids=removed_ids)
+            deleted += len(removed_ids)
+        changed = True
+    if unmanaged_ids:
+        collection.delete(ids=sorted(unmanaged_ids))
+        deleted += len(unmanaged_ids)
+        changed = True
+
+    if changed:
+        manifest["version"] += 1
+        save_index_manifest(chroma_path, manifest)
+    return collection, manifest, upserted, deleted
+
+def vectorize_manga_schemas(chroma_path="_chroma", manga_root_folder="./manga_images", shards=INDEX_SHARDS):
+    """
+    Vectorize manga schema data and store in ChromaDB.
+
+    With shards > 1 every book goes to one of the shard collections under chroma_path
+    (chosen by a hash of its title); each shard is indexed incrementally on its own and
+    the top-level manifest version changes whenever any shard changed.
+    """
+    analyses_dir = get_analyses_dir(manga_root_folder)
+    schema_files = list_schema_files(manga_root_folder)
+    if not schema_files:
+        print("No manga schema data found to vectorize")
+        return
+    print(f"Found {len(schema_files)} manga schema files to process")
+
+    cache = EmbeddingCache(EMBEDDING_MODEL_ID) if EMBEDDING_CACHE else None
+    shard_files = None
+    with EmbeddingEngine(cache=cache) as engine:
+        if shards <= 1:
+            if read_shard_count(chroma_path) > 1:
+                print(f"Note: {chroma_path} held a sharded index; searches now use the unsharded collection")
+                os.remove(os.path.join(chroma_path, SHARDS_FILE))
+                # Running retrievers switch vector stores when the index version changes
+                manifest = load_index_manifest(chroma_path) or {"version": 0, "files": {}}
+                manifest.pop("shards", None)
+                manifest.pop("shard_versions", None)
+                manifest["version"] += 1
+                save_index_manifest(chroma_path, manifest)
+            collection, manifest, upserted, deleted = index_schema_files(chroma_path, analyses_dir, schema_files, engine)
+            total = collection.count()
+
+            store_dir = os.path.join(chroma_path, NUMPY_STORE_DIR)
+            if EXPORT_NUMPY_STORE or os.path.exists(store_dir):
+                if NumpyVectorStore.stored_index_version(store_dir) != manifest["version"]:
+                    export_numpy_store(collection, store_dir, index_version=manifest["version"])
+        else:
+            shard_files = [[] for _ in range(shards)]
+            for schema_file in schema_files:
+                shard_files[shard_for_title(schema_file.replace("_schema.json", ""), shards)].append(schema_file)
+
+            manifest = load_index_manifest(chroma_path) or {"version": 0, "files": {}}
+            shard_versions = manifest.get("shard_versions", [])
+            layout_changed = manifest.get("shards") != shards
+            if manifest["files"]:
+                # The shards replace the unsharded collection: empty it, so switching back starts clean
+                print(f"Note: {chroma_path} held an unsharded index; removing it from the top-level collection")
+                top_collection = get_or_create_manga_collection(chromadb.PersistentClient(path=chroma_path))
+                old_ids = [doc_id for entry in manifest["files"].values() for doc_id in entry["ids"]]
+                for start in range(0, len(old_ids), UPSERT_BATCH_SIZE):
+                    top_collection.delete(ids=old_ids[start:start + UPSERT_BATCH_SIZE])
+                manifest["files"] = {}
+                layout_changed = True
+            collection, versions = [], []
+            upserted = deleted = 0
+            for shard, files in enumerate(shard_files):
+                print(f"Shard {shard}: {len(files)} manga schema files")
+                shard_collection, shard_manifest, shard_upserted, shard_deleted = index_schema_files(
+                    shard_path(chroma_path, shard), analyses_dir, files, engine)
+                collection.append(shard_collection)
+                versions.append(shard_manifest["version"])
+                upserted += shard_upserted
+                deleted += shard_deleted
+            # shards.json first: searches pick up the new layout once the manifest version changes
+            write_json_atomic(os.path.join(chroma_path, SHARDS_FILE), {"shards": shards})
+            if versions != shard_versions or layout_changed:
+                manifest.update({"version": manifest["version"] + 1, "shards": shards, "shard_versions": versions})
+                save_index_manifest(chroma_path, manifest)
+            total = sum(c.count() for c in collection)
+
+    build_side_indexes(chroma_path, analyses_dir, schema_files, manifest["version"],
+                       shard_files=shard_files)
+
+    print(f"Upserted {upserted} documents, deleted {deleted} stale documents "
+          f"(index version {manifest['version']}, {total} documents in total)")
+    if cache is not None and upserted:
+        print(f"Embedding cache: {cache.hits} hits, {cache.misses} newly embedded ({len(cache)} cached texts)")
     return collection
 
 if __name__ == "__main__":